@@ -0,0 +1,53 @@
+"""Measures the startup cost of the addon: the time to import and register
+it, and the heavy modules that registering loads.
+
+Run with Blender, for example:
+    blender --background --factory-startup --python benchmark.py
+"""
+import os
+import sys
+import time
+
+heavy_modules = (
+    'numpy',
+    'bmesh',
+    'vgio',
+    'io_scene_bsp.api',
+    'io_scene_bsp.import_bsp',
+    'io_scene_bsp.export_bsp',
+    'io_scene_bsp.nodes'
+)
+
+
+def main(repeat=20):
+    import bpy
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    preloaded = {m for m in heavy_modules if m in sys.modules}
+
+    start = time.perf_counter()
+    import io_scene_bsp
+    io_scene_bsp.register()
+    first_time = time.perf_counter() - start
+
+    loaded = [m for m in heavy_modules if m in sys.modules and m not in preloaded]
+
+    # Registering again measures the class registration alone
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        io_scene_bsp.unregister()
+        io_scene_bsp.register()
+
+    register_time = (time.perf_counter() - start) / repeat
+
+    io_scene_bsp.unregister()
+
+    print(f'Blender {bpy.app.version_string}')
+    print(f'Import and register: {first_time * 1000:.1f} ms')
+    print(f'Register again: {register_time * 1000:.1f} ms')
+    print(f'Heavy modules loaded: {", ".join(loaded) or "none"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -24,9 +24,9 @@ else:
 
 
 def register():
-    from .patch import ensure_modules_dir_on_path
-    ensure_modules_dir_on_path()
-
+    # Only the operator and panel classes are loaded here. The importer,
+    # exporter and their dependencies are imported on first use, see
+    # patch.import_module.
     from . import operators
     operators.register()
 
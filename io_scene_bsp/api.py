@@ -1,10 +1,37 @@
+import fnmatch
+import hashlib
+
 from collections import namedtuple
-from functools import lru_cache
+from functools import wraps
 from math import ceil, floor
 
-from vgio.quake.bsp import Bsp as BspFile
-from vgio.quake.bsp import is_bspfile
-from vgio.quake import map as Map
+import numpy
+
+from vgio.quake import palette as quake_palette
+
+from . import entities as entity_lump
+from . import hulls
+from . import lumps
+from .lumps import is_bspfile
+
+
+def cached_property(func):
+    """A property that is computed once per instance. Values are kept in the
+    instance's _cache dict, so they are released along with the instance or
+    when the dict is cleared."""
+    name = func.__name__
+
+    @wraps(func)
+    def getter(self):
+        try:
+            return self._cache[name]
+
+        except KeyError:
+            value = self._cache[name] = func(self)
+
+            return value
+
+    return property(getter)
 
 
 def dot3(a, b):
@@ -16,73 +43,567 @@ def sub2(a, b):
 
 LightMapImage = namedtuple('LightMapImage', 'size pixels')
 
+Image = namedtuple('Image', 'width height pixels')
+"""Decoded RGBA texture data. Pixels are a flat uint8 array with rows ordered
+bottom to top."""
 
-class Face:
-    def __init__(self, bsp, face):
-        self._bsp_file = bsp
-        self._face = face
+PointEntities = namedtuple('PointEntities', 'classname entities origins angles')
+"""The point entities of one classname.
 
-    @property
-    @lru_cache(maxsize=1)
-    def edges(self):
-        return self._bsp_file.surf_edges[self._face.first_edge:self._face.first_edge + self._face.number_of_edges]
+Attributes:
+    classname: The classname shared by the entities.
 
-    @property
-    @lru_cache(maxsize=1)
-    def vertices(self):
-        verts = []
-        for edge in self.edges:
-            v = self._bsp_file.edges[abs(edge)].vertexes
+    entities: A list of the entity objects.
+
+    origins: An (N, 3) array of entity origins.
+
+    angles: An (N, 3) array of entity pitch, yaw and roll angles in
+        degrees. Entities with only an angle key have just a yaw.
+"""
+
+Miptexture = namedtuple('Miptexture', 'name width height offset offsets')
+"""A miptexture header.
+
+Attributes:
+    name: The texture name.
+
+    width: The width of mip level 0.
+
+    height: The height of mip level 0.
+
+    offset: The offset of the miptexture from the start of the lump.
+
+    offsets: The offsets of the four mip levels from the start of the
+        miptexture. Zero if the texture is stored externally.
+"""
+
+MeshData = namedtuple('MeshData', 'face_indices vertices loop_totals loop_vertices uvs texture_numbers')
+"""Flat arrays describing the polygons of a set of faces.
+
+Attributes:
+    face_indices: The index of each polygon's face in the faces lump.
+
+    vertices: An (N, 3) array of the unique vertex positions used.
+
+    loop_totals: The number of loops of each polygon.
+
+    loop_vertices: The index into vertices of each loop.
+
+    uvs: An (N, 2) array of the texture coordinates of each loop.
+
+    texture_numbers: The miptexture number of each polygon.
+"""
+
+FaceBatch = namedtuple('FaceBatch', 'face_indices positions loop_totals uvs texture_numbers light_offsets')
+"""Flat arrays for a batch of faces, see Bsp.face_batches. Vertices aren't
+shared between faces, so every batch stands on its own.
+
+Attributes:
+    face_indices: The index of each face in the faces lump.
+
+    positions: An (N, 3) array of the position of each loop.
+
+    loop_totals: The number of loops of each face.
+
+    uvs: An (N, 2) array of the texture coordinates of each loop.
+
+    texture_numbers: The miptexture number of each face.
+
+    light_offsets: The offset of each face's lightmap into the lighting
+        lump, or -1 if it has none.
+"""
+
+
+CONTENTS_EMPTY = -1
+CONTENTS_SOLID = -2
+CONTENTS_WATER = -3
+CONTENTS_SLIME = -4
+CONTENTS_LAVA = -5
+CONTENTS_SKY = -6
+
+contents_names = {
+    CONTENTS_EMPTY: 'EMPTY',
+    CONTENTS_SOLID: 'SOLID',
+    CONTENTS_WATER: 'WATER',
+    CONTENTS_SLIME: 'SLIME',
+    CONTENTS_LAVA: 'LAVA',
+    CONTENTS_SKY: 'SKY',
+}
+"""Names of the leaf contents values."""
+
+
+texture_classes = {
+    'SKY': lambda name: name.startswith('sky'),
+    'LIQUID': lambda name: name.startswith('*'),
+    'FENCE': lambda name: name.startswith('{'),
+    'TRIGGER': lambda name: name == 'trigger',
+    'CLIP': lambda name: name == 'clip',
+}
+"""Tests for classifying textures by name. Liquid covers all turbulent
+textures, such as *water, *slime, *lava and *teleport."""
+
+
+def texture_class(name):
+    """Gets the class of the given texture name.
+
+    Args:
+        name: A miptexture name
+
+    Returns:
+        A key of texture_classes or None
+    """
+    name = name.lower()
+
+    for class_name, test in texture_classes.items():
+        if test(name):
+            return class_name
+
+    return None
+
+
+def animation_groups(names):
+    """Groups the frames of animated textures. Frames are named '+0name'
+    to '+9name', and alternate frames '+aname' to '+jname'.
+
+    Args:
+        names: A sequence of miptexture names
+
+    Returns:
+        A dict of each sequence's first frame name to its frame names in
+        order. Only sequences with more than one frame are included.
+    """
+    sequences = {}
+
+    for name in names:
+        if len(name) < 3 or name[0] != '+':
+            continue
+
+        frame = name[1].lower()
+
+        if frame.isdigit():
+            key, number = ('0', name[2:].lower()), int(frame)
+
+        elif 'a' <= frame <= 'j':
+            key, number = ('a', name[2:].lower()), ord(frame) - ord('a')
+
+        else:
+            continue
+
+        sequences.setdefault(key, {})[number] = name
+
+    result = {}
+
+    for frames in sequences.values():
+        if len(frames) > 1:
+            ordered = [frames[n] for n in sorted(frames)]
+            result[ordered[0]] = ordered
+
+    return result
+
+
+def point_entities(entities, exclude_patterns=()):
+    """Groups the entities that have an origin by classname and gathers their
+    origins and angles into arrays. The angles key is used when present,
+    otherwise the angle key gives the yaw.
+
+    Args:
+        entities: An entities.Entities object
+
+        exclude_patterns: Classname patterns to skip, see match_classname
+
+    Returns:
+        A dict of classnames to PointEntities objects
+    """
+    result = {}
+
+    for classname, group in entities.by_classname.items():
+        group = [e for e in group if hasattr(e, 'origin')]
+
+        if not group or match_classname(classname, exclude_patterns):
+            continue
+
+        origins = numpy.array([e.origin for e in group], dtype=numpy.float64).reshape(-1, 3)
+        angles = numpy.array(
+            [getattr(e, 'angles', None) or (0.0, getattr(e, 'angle', 0.0), 0.0) for e in group],
+            dtype=numpy.float64
+        ).reshape(-1, 3)
+        result[classname] = PointEntities(classname, group, origins, angles)
+
+    return result
+
+
+def select_mip_level(width, height, mip_level=0, max_size=0):
+    """Picks the mip level to decode for a texture.
+
+    Args:
+        width: The width of mip level 0
+
+        height: The height of mip level 0
+
+        mip_level: The minimum mip level, 0-3
+
+        max_size: The largest width or height allowed. Zero for no limit.
+
+    Returns:
+        A mip level in the range [0, 3]
+    """
+    level = min(max(mip_level, 0), 3)
+
+    while max_size and level < 3 and max(width, height) >> level > max_size:
+        level += 1
+
+    return level
+
+
+ImportCounts = namedtuple('ImportCounts', 'faces loops vertices models texture_sizes luxels entities')
+"""The amount of work in a BSP file, see import_counts.
+
+Attributes:
+    faces: The number of faces.
+
+    loops: The number of face corners.
+
+    vertices: The number of vertices.
+
+    models: The number of brush models.
+
+    texture_sizes: An (N, 2) array of the width and height of each embedded
+        miptexture.
+
+    luxels: The number of lightmap samples.
+
+    entities: The number of entities.
+"""
+
+ImportEstimate = namedtuple('ImportEstimate', 'seconds memory')
+"""The predicted cost of an import, see estimate_import.
+
+Attributes:
+    seconds: The import time in seconds.
+
+    memory: The peak memory used in bytes.
+"""
+
+import_costs = {
+    'loop': (0.5e-6, 180),
+    'texel': (0.08e-6, 24),
+    'texture': (0.3e-3, 20000),
+    'model': (1e-3, 10000),
+    'empty': (155e-6, 2100),
+    'point': (2e-6, 100),
+    'lightmap_face': (70e-6, 3200),
+    'lightmap_loop': (0.06e-6, 20),
+}
+"""Calibrated (seconds, bytes) costs of each unit of import work. Measured
+in Blender 4.2 on a desktop, so laptops can take around twice as long."""
+
+max_chunk_loops = 1000000
+"""The number of loops above which fit_import_options splits worldspawn."""
+
+
+def import_counts(filepath):
+    """Counts the work in a BSP file. Only the header, the miptexture
+    headers and the entities lump are read.
+
+    Args:
+        filepath: Path to the BSP file
+
+    Returns:
+        An ImportCounts object
+    """
+    with open(filepath, 'rb') as file:
+        schema, directory = lumps.read_directory(file)
+
+        def count(name):
+            return directory[name][1] // schema.dtypes[name].itemsize
+
+        # Texture sizes come from the miptexture headers alone
+        offset, length = directory['miptextures']
+        file.seek(offset)
+        data = file.read(min(length, 4))
+        texture_count = int(numpy.frombuffer(data, dtype='<i4', count=1)[0]) if len(data) == 4 else 0
+        offsets = numpy.frombuffer(file.read(4 * texture_count), dtype='<i4').tolist()
+        texture_sizes = []
+
+        for texture_offset in offsets:
+            if texture_offset < 0:
+                continue
+
+            file.seek(offset + texture_offset)
+            header = numpy.frombuffer(file.read(lumps.miptexture_header_dtype.itemsize), lumps.miptexture_header_dtype)
 
-            # Flip edges with negative ids
-            v0, v1 = v if edge > 0 else reversed(v)
+            # Externally stored textures aren't decoded
+            if len(header) and header['offsets'][0][0]:
+                texture_sizes.append((int(header['width'][0]), int(header['height'][0])))
 
-            if len(verts) == 0:
-                verts.append(v0)
+        offset, length = directory['entities']
+        file.seek(offset)
+        entity_count = file.read(length).count(b'{')
 
-            if v1 != verts[0]:
-                verts.append(v1)
+    return ImportCounts(
+        count('faces'),
+        count('surf_edges'),
+        count('vertexes'),
+        count('models'),
+        numpy.array(texture_sizes, dtype=numpy.int64).reshape(-1, 2),
+        directory['lighting'][1] // schema.lighting_channels,
+        entity_count
+    )
+
+
+def estimate_import(counts,
+                    use_worldspawn_entity=True,
+                    use_brush_entities=True,
+                    use_point_entities=True,
+                    point_entity_mode='EMPTIES',
+                    load_lightmap=False,
+                    lightmap_mode='ATLAS',
+                    lightmap_storage='BYTE',
+                    mip_level=0,
+                    max_texture_size=0,
+                    merge_coplanar_faces=False,
+                    **options):
+    """Predicts the time and memory of an import from import_costs. Takes the
+    same keyword arguments as import_bsp.load, and ignores the ones that
+    don't affect the cost much.
+
+    Args:
+        counts: An ImportCounts object
+
+    Returns:
+        An ImportEstimate object
+    """
+    units = {}
+
+    if use_worldspawn_entity or use_brush_entities:
+        units['loop'] = counts.loops
+        units['model'] = counts.models
+        units['texture'] = len(counts.texture_sizes)
+        units['texel'] = sum(
+            (w >> level) * (h >> level)
+            for w, h in counts.texture_sizes.tolist()
+            for level in [select_mip_level(w, h, mip_level, max_texture_size)]
+        )
+
+        if load_lightmap and not merge_coplanar_faces:
+            if lightmap_mode == 'COLORS':
+                units['lightmap_loop'] = counts.loops
+
+            else:
+                units['lightmap_face'] = counts.faces
+
+    if use_point_entities:
+        units['empty' if point_entity_mode == 'EMPTIES' else 'point'] = counts.entities
+
+    seconds = sum(import_costs[k][0] * n for k, n in units.items())
+    memory = sum(import_costs[k][1] * n for k, n in units.items())
+
+    # Atlas images hold four channels per luxel
+    if units.get('lightmap_face'):
+        memory += counts.luxels * (4 if lightmap_storage == 'BYTE' else 16)
+
+    return ImportEstimate(seconds, memory)
+
+
+def fit_import_options(counts, options, max_seconds):
+    """Downgrades import options until the estimated import time fits.
+    Lightmaps switch to color attributes and then are skipped, and textures
+    are decoded from smaller mip levels. Very large maps also split
+    worldspawn into chunks.
+
+    Args:
+        counts: An ImportCounts object
+
+        options: A dict of import_bsp.load keyword arguments
+
+        max_seconds: The time to fit the import in
+
+    Returns:
+        A dict of the changed options
+    """
+    changes = {}
+
+    def seconds():
+        return estimate_import(counts, **dict(options, **changes)).seconds
+
+    if options.get('load_lightmap') and seconds() > max_seconds:
+        if options.get('lightmap_mode', 'ATLAS') == 'ATLAS':
+            changes['lightmap_mode'] = 'COLORS'
+
+        if seconds() > max_seconds:
+            changes['load_lightmap'] = False
+
+    level = options.get('mip_level', 0)
+
+    while level < 3 and seconds() > max_seconds:
+        level += 1
+        changes['mip_level'] = level
+
+    if counts.loops > max_chunk_loops and options.get('worldspawn_chunking', 'NONE') == 'NONE':
+        changes['worldspawn_chunking'] = 'NODES'
+
+    return changes
+
+
+def match_classname(classname, patterns):
+    """Tests a classname against a sequence of fnmatch style patterns such
+    as 'trigger_*'."""
+    return any(fnmatch.fnmatchcase(classname, p) for p in patterns)
+
+
+def _ranges(starts, lengths):
+    """Concatenates the ranges [start, start + length) into one array."""
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    offsets = numpy.cumsum(lengths) - lengths
+
+    return numpy.repeat(starts - offsets, lengths) + numpy.arange(lengths.sum())
+
+
+def _group_by_rows(values, keys, name):
+    """Groups values by the rows of keys.
+
+    Args:
+        values: An array of values to group
+
+        keys: A two-dimensional array with one row per value
+
+        name: A function that takes a key row and returns a name
+
+    Returns:
+        A dict of names to arrays of values
+    """
+    if not len(values):
+        return {}
+
+    unique_keys, inverse = numpy.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = numpy.argsort(inverse, kind='stable')
+    splits = numpy.cumsum(numpy.bincount(inverse, minlength=len(unique_keys)))[:-1]
+
+    return {name(k): v for k, v in zip(unique_keys, numpy.split(values[order], splits))}
+
+
+def _union_find(count, a, b):
+    """Vectorized union-find. Joins elements a[i] and b[i] for all i.
+
+    Args:
+        count: The number of elements
+
+        a: An array of element indices
+
+        b: An array of element indices
+
+    Returns:
+        An array with the smallest element index of each element's set
+    """
+    labels = numpy.arange(count)
+
+    while True:
+        label_a = labels[a]
+        label_b = labels[b]
+        differ = label_a != label_b
+
+        if not differ.any():
+            return labels
+
+        # Hook the larger root under the smaller one
+        numpy.minimum.at(
+            labels,
+            numpy.maximum(label_a, label_b)[differ],
+            numpy.minimum(label_a, label_b)[differ]
+        )
+
+        # Pointer jumping until every element points at its root
+        while True:
+            jumped = labels[labels]
+
+            if numpy.array_equal(jumped, labels):
+                break
+
+            labels = jumped
+
+
+def _trace_outline(starts, ends):
+    """Chains directed boundary edges into a single closed loop.
+
+    Args:
+        starts: The start vertex of each edge
+
+        ends: The end vertex of each edge
+
+    Returns:
+        An array of vertex indices, or None if the edges don't form exactly
+        one simple loop.
+    """
+    following = dict(zip(starts.tolist(), ends.tolist()))
+
+    # A vertex with two outgoing edges pinches the outline
+    if len(following) != len(starts):
+        return None
+
+    outline = [starts[0]]
+    vertex = following[outline[0]]
+
+    while vertex != outline[0]:
+        if vertex not in following or len(outline) > len(starts):
+            return None
+
+        outline.append(vertex)
+        vertex = following[vertex]
+
+    if len(outline) != len(starts):
+        return None
+
+    return numpy.array(outline)
+
+
+class Face:
+    def __init__(self, bsp, face_index):
+        self._bsp = bsp
+        self._face_index = face_index
+        self._face = bsp.face_array[face_index]
+        self._cache = {}
+
+    @cached_property
+    def vertices(self):
+        loop_totals, loop_vertices = self._bsp.face_loops(numpy.array([self._face_index]))
 
         # Ignore degenerate faces
-        if len(verts) < 3:
+        if loop_totals[0] < 3:
             return None
 
-        # Convert Vertexes to three-tuples and reverse their order
-        return tuple(tuple(self._bsp_file.vertexes[i][:]) for i in reversed(verts))
+        return tuple(map(tuple, self._bsp.vertex_array[loop_vertices].tolist()))
 
-    @property
-    @lru_cache(maxsize=1)
+    @cached_property
     def uvs(self):
-        texture_info = self._bsp_file.texture_infos[self._face.texture_info]
-        miptex = self._bsp_file.miptextures[texture_info.miptexture_number]
-        s, t = texture_info.s, texture_info.t
-        ds, dt = texture_info.s_offset, texture_info.t_offset
-        w, h = miptex.width, miptex.height
+        texture_info = self._bsp.texture_info_array[self._face['texture_info']]
+        s, t = texture_info['s'].tolist(), texture_info['t'].tolist()
+        ds, dt = float(texture_info['s_offset']), float(texture_info['t_offset'])
+        w, h = self._bsp.miptexture_size_array[texture_info['miptexture_number']].tolist()
 
         return tuple(((dot3(v, s) + ds) / w, -(dot3(v, t) + dt) / h) for v in self.vertices)
 
-    @property
-    @lru_cache(maxsize=1)
+    @cached_property
     def lightmap_sts(self):
-        plane = self._bsp_file.planes[self._face.plane_number]
-        axis = plane.type % 3
+        axis = int(self._bsp.plane_array['type'][self._face['plane_number']]) % 3
         projected_verts = [v[:axis] + v[axis + 1:] for v in self.vertices]
 
         return projected_verts
 
-    @property
-    @lru_cache(maxsize=1)
+    @cached_property
     def lightmap_uvs(self):
-        #texture_info = self._bsp_file.texture_infos[self._face.texture_info]
-        #miptex = self._bsp_file.miptextures[texture_info.miptexture_number]
-        #w, h = miptex.width, miptex.height
-        #sts = self.lightmap_sts
         w, h = 16, 16
         return [(st[0] / w, st[1] / h) for st in self.lightmap_sts]
 
-    @property
-    @lru_cache(maxsize=1)
+    @cached_property
     def lightmap_image(self):
+        size, luxels = self.lightmap_luxels
+
+        return LightMapImage(size, luxels / 255)
+
+    @cached_property
+    def lightmap_luxels(self):
+        """The lightmap as a LightMapImage of flat uint8 RGBA pixels."""
         min_x, min_y = self.lightmap_sts[0]
         max_x, max_y = self.lightmap_sts[0]
 
@@ -98,67 +619,969 @@ class Face:
         size = scale[0] + 1, scale[1] + 1
         length = size[0] * size[1]
 
-        offset = self._face.light_offset
-        pixels = []
+        offset = int(self._face['light_offset'])
+        pixels = numpy.zeros((length, 4), dtype=numpy.uint8)
+        pixels[:, 3] = 255
 
         if offset >= 0:
-            light_data = self._bsp_file.lighting[offset:offset + length]
-            for luxel in light_data:
-                r = g = b = luxel / 255
-                pixels += r, g, b, 1.0
+            # Samples are grayscale or RGB depending on the format
+            channels = self._bsp._lumps.schema.lighting_channels
+            light_data = self._bsp._lumps.raw('lighting')[offset:offset + length * channels]
+            luxels = numpy.frombuffer(light_data, dtype=numpy.uint8).reshape(-1, channels)
+            pixels[:len(luxels), :3] = luxels
 
-        else:
-            pixels = (0, 0, 0, 1.0) * length
-
-        return LightMapImage(size, pixels)
+        return LightMapImage(size, pixels.ravel())
 
-    @property
-    @lru_cache(maxsize=1)
+    @cached_property
     def texture_name(self):
-        texture_info = self._bsp_file.texture_infos[self._face.texture_info]
-        miptex = self._bsp_file.miptextures[texture_info.miptexture_number]
+        texture_info = self._bsp.texture_info_array[self._face['texture_info']]
 
-        return miptex.name if miptex else ''
+        return self._bsp.miptexture_name(texture_info['miptexture_number'])
 
 
 class Model:
     def __init__(self, bsp, model):
-        self._bsp_file = bsp
+        self._bsp = bsp
         self._model = model
-        self._faces = bsp.faces[model.first_face:model.first_face + model.number_of_faces]
 
     def get_face(self, face_index):
-        return Face(self._bsp_file, self._faces[face_index])
+        return Face(self._bsp, int(self._model['first_face']) + face_index)
 
     @property
     def faces(self):
-        for face in self._faces:
-            if face:
-                yield Face(self._bsp_file, face)
+        for face_index in self.face_indices:
+            yield Face(self._bsp, face_index)
+
+    def face_batches(self, batch_size=16384):
+        """Yields the model's faces as FaceBatch objects, see
+        Bsp.face_batches."""
+        return self._bsp.face_batches(self.face_indices, batch_size)
+
+    @property
+    def face_indices(self):
+        """The indices of the model's faces into the faces lump."""
+        first_face = int(self._model['first_face'])
+
+        return numpy.arange(first_face, first_face + int(self._model['number_of_faces']))
+
+    @property
+    def head_node(self):
+        """The index of the root node of the model's BSP tree."""
+        return int(self._model['head_node'][0])
+
+    @property
+    def digest(self):
+        """A hash of the model's face geometry, texture mapping and texture
+        names. Identical models in different compiles hash the same."""
+        bsp = self._bsp
+        digest = hashlib.sha1()
+
+        for batch in self.face_batches():
+            texture_infos = bsp.texture_info_array[bsp.face_array['texture_info'][batch.face_indices]]
+            texture_names = [bsp.miptexture_name(i) for i in batch.texture_numbers]
+
+            digest.update(batch.loop_totals.tobytes())
+            digest.update(batch.positions.tobytes())
+            digest.update(texture_infos.tobytes())
+            digest.update('\0'.join(texture_names).encode())
+
+        return digest.hexdigest()
+
+
 
 
 class Bsp:
+    """A BSP file of any format registered in the lumps module. Lumps are
+    read as NumPy arrays on first use.
+
+    Arrays derived from the lumps are cached on the instance. Use release to
+    drop them once they are no longer needed, and close, or a with
+    statement, to also drop the file data.
+    """
+
     def __init__(self, file):
-        self._bsp_file = BspFile.open(file)
-        self._bsp_file.close()
+        self._lumps = lumps.Lumps.open(file)
+        self._cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def release(self, *names):
+        """Drops cached data. It is rebuilt from the file if used again.
+
+        Args:
+            names: The names of the cached properties to drop, such as
+                'face_array'. If none are given, everything is dropped.
+        """
+        if not names:
+            self._cache.clear()
+
+        for name in names:
+            self._cache.pop(name, None)
+
+    def close(self):
+        """Drops all cached data and the file data. The Bsp can't be used
+        afterwards."""
+        self._cache.clear()
+        self._lumps.close()
+
+    @property
+    def format(self):
+        """The name of the file's format, see lumps.Schema."""
+        return self._lumps.schema.name
 
     def get_model(self, model_index):
-        return Model(self._bsp_file, self._bsp_file.models[model_index])
+        return Model(self, self.model_array[model_index])
+
+    def get_face(self, face_index):
+        return Face(self, face_index)
 
     @property
     def models(self):
-        for model in self._bsp_file.models:
-            yield Model(self._bsp_file, model)
+        for model in self.model_array:
+            yield Model(self, model)
 
     @property
     def images(self):
-        return self._bsp_file.images()
+        return [self.image(i) for i in range(len(self.miptextures))]
 
-    @property
+    def image(self, miptexture_number, mip_level=0):
+        """Decodes a single mip level of a miptexture. Only that level's
+        pixels are read.
+
+        Args:
+            miptexture_number: The index of the miptexture
+
+            mip_level: The mip level to decode, 0-3. Each level halves the
+                width and height.
+
+        Returns:
+            An Image object or None if the miptexture is missing or stored
+            externally.
+        """
+        miptex = self.miptextures[miptexture_number]
+
+        if miptex is None or not miptex.offsets[mip_level]:
+            return None
+
+        width, height = miptex.width >> mip_level, miptex.height >> mip_level
+        indices = numpy.frombuffer(
+            self._lumps.raw('miptextures'),
+            dtype=numpy.uint8,
+            count=width * height,
+            offset=miptex.offset + miptex.offsets[mip_level]
+        )
+
+        # Flip rows to bottom to top
+        indices = indices.reshape(height, width)[::-1]
+
+        return Image(width, height, self.miptexture_palette(miptexture_number)[indices].ravel())
+
+    def image_strip(self, miptexture_numbers, mip_level=0):
+        """Decodes several miptextures side by side as one image, such as
+        the frames of an animated texture.
+
+        Args:
+            miptexture_numbers: The miptextures to decode from left to right
+
+            mip_level: The mip level to decode
+
+        Returns:
+            An Image object or None if any frame is missing or the frame
+            sizes differ.
+        """
+        frames = [self.image(i, mip_level) for i in miptexture_numbers]
+
+        if not frames or None in frames or len({(f.width, f.height) for f in frames}) > 1:
+            return None
+
+        width, height = frames[0].width, frames[0].height
+        pixels = numpy.concatenate([f.pixels.reshape(height, width, 4) for f in frames], axis=1)
+
+        return Image(width * len(frames), height, pixels.ravel())
+
+    def miptexture_palette(self, miptexture_number):
+        """The RGBA palette of a miptexture as a (256, 4) array. Index 255 is
+        transparent."""
+        miptex = self.miptextures[miptexture_number]
+
+        if self._lumps.schema.has_palettes:
+            # The palette follows the last mip level, prefixed by its size
+            last_level = (miptex.width // 8) * (miptex.height // 8)
+            offset = miptex.offset + miptex.offsets[3] + last_level + 2
+            colors = numpy.frombuffer(self._lumps.raw('miptextures'), dtype=numpy.uint8, count=768, offset=offset)
+
+        else:
+            colors = numpy.array(quake_palette, dtype=numpy.uint8)
+
+        palette = numpy.full((256, 4), 255, dtype=numpy.uint8)
+        palette[:, :3] = colors.reshape(256, 3)
+        palette[255, 3] = 0
+
+        return palette
+
+    @cached_property
     def miptextures(self):
-        return self._bsp_file.miptextures[:]
+        """The miptexture headers as a list of Miptexture objects. Missing
+        miptextures are None."""
+        data = self._lumps.raw('miptextures')
 
-    @property
-    @lru_cache(maxsize=1)
+        if len(data) < 4:
+            return []
+
+        count = int(numpy.frombuffer(data, dtype='<i4', count=1)[0])
+        offsets = numpy.frombuffer(data, dtype='<i4', count=count, offset=4).tolist()
+        headers = [
+            numpy.frombuffer(data, dtype=lumps.miptexture_header_dtype, count=1, offset=o)[0] if o >= 0 else None
+            for o in offsets
+        ]
+
+        return [
+            Miptexture(
+                h['name'].split(b'\x00')[0].decode('ascii', 'replace'),
+                int(h['width']),
+                int(h['height']),
+                o,
+                tuple(h['offsets'].tolist())
+            ) if h is not None else None
+            for h, o in zip(headers, offsets)
+        ]
+
+    @cached_property
     def entities(self):
-        return Map.loads(self._bsp_file.entities)
+        """The entities lump as an entities.Entities object."""
+        return entity_lump.loads(bytes(self._lumps.raw('entities')).decode('cp437').strip('\x00'))
+
+    def miptexture_name(self, miptexture_number):
+        miptex = self.miptextures[miptexture_number]
+
+        return miptex.name if miptex else ''
+
+    @cached_property
+    def vertex_array(self):
+        """The vertexes lump as an (N, 3) array."""
+        return self._lumps.array('vertexes')
+
+    @cached_property
+    def edge_array(self):
+        """The edges lump as an (N, 2) array of vertex indices."""
+        return self._lumps.array('edges')
+
+    @cached_property
+    def surf_edge_array(self):
+        """The surfedges lump as an array of signed edge indices."""
+        return self._lumps.array('surf_edges')
+
+    @cached_property
+    def face_array(self):
+        """The faces lump as a structured array."""
+        return self._lumps.array('faces')
+
+    @cached_property
+    def texture_info_array(self):
+        """The texture infos lump as a structured array."""
+        return self._lumps.array('texture_infos')
+
+    @cached_property
+    def plane_array(self):
+        """The planes lump as a structured array."""
+        return self._lumps.array('planes')
+
+    @cached_property
+    def model_array(self):
+        """The models lump as a structured array."""
+        return self._lumps.array('models')
+
+    def face_loops(self, face_indices):
+        """Gets the polygon loops of the given faces.
+
+        Args:
+            face_indices: An array of indices into the faces lump
+
+        Returns:
+            A two-tuple of arrays. The number of loops of each face, and the
+            vertex index of each loop. Loops are ordered the same as
+            Face.vertices.
+        """
+        faces = self.face_array[face_indices]
+        loop_totals = faces['number_of_edges'].astype(numpy.int64)
+        loop_starts = numpy.cumsum(loop_totals) - loop_totals
+
+        # Faces list their edges in reverse loop order
+        loop_number = numpy.arange(loop_totals.sum()) - numpy.repeat(loop_starts, loop_totals)
+        last_edges = faces['first_edge'] + loop_totals - 1
+        surf_edges = self.surf_edge_array[numpy.repeat(last_edges, loop_totals) - loop_number]
+
+        # Flip edges with negative ids
+        edges = self.edge_array[numpy.abs(surf_edges)]
+        loop_vertices = numpy.where(surf_edges > 0, edges[:, 0], edges[:, 1])
+
+        return loop_totals, loop_vertices
+
+    def lightmap_colors(self, face_indices, batch_size=16384):
+        """Samples the lightmap of each face at its loops with bilinear
+        filtering. Lightmap extents are computed the same way as the engine
+        does, from the texture projection of the face. Faces are sampled in
+        batches, see face_batches.
+
+        Args:
+            face_indices: An array of indices into the faces lump
+
+            batch_size: The maximum number of faces sampled at once
+
+        Returns:
+            An (N, 4) uint8 array with an RGBA color for each loop, ordered
+            the same as face_loops. Faces without lightmaps are fully bright.
+        """
+        loop_count = int(self.face_array['number_of_edges'][face_indices].sum())
+        colors = numpy.full((loop_count, 4), 255, dtype=numpy.uint8)
+        lighting = numpy.frombuffer(self._lumps.raw('lighting'), dtype=numpy.uint8)
+        start = 0
+
+        for batch in self.face_batches(face_indices, batch_size):
+            end = start + len(batch.positions)
+
+            if len(lighting):
+                colors[start:end, :3] = self._sample_lightmaps(batch, lighting)
+
+            start = end
+
+        return colors
+
+    def _sample_lightmaps(self, batch, lighting):
+        """Bilinearly samples the lightmaps of a FaceBatch at its loops."""
+        loop_totals = batch.loop_totals
+        loop_starts = numpy.cumsum(loop_totals) - loop_totals
+        texture_infos = self.texture_info_array[
+            numpy.repeat(self.face_array['texture_info'][batch.face_indices], loop_totals)]
+        positions = batch.positions.astype(numpy.float64)
+        st = numpy.column_stack((
+            numpy.einsum('ij,ij->i', positions, texture_infos['s']) + texture_infos['s_offset'],
+            numpy.einsum('ij,ij->i', positions, texture_infos['t']) + texture_infos['t_offset']
+        ))
+
+        # Luxels are 16 texels apart, starting from the floored minimum
+        mins = numpy.floor(numpy.minimum.reduceat(st, loop_starts) / 16)
+        maxs = numpy.ceil(numpy.maximum.reduceat(st, loop_starts) / 16)
+        extents = numpy.repeat(maxs - mins, loop_totals, axis=0)
+        luxels = numpy.clip(st / 16 - numpy.repeat(mins, loop_totals, axis=0), 0, extents)
+
+        low = numpy.floor(luxels)
+        fractions = luxels - low
+        low = low.astype(numpy.int64)
+        high = numpy.minimum(low + 1, extents.astype(numpy.int64))
+        widths = extents[:, 0].astype(numpy.int64) + 1
+
+        channels = self._lumps.schema.lighting_channels
+        light_offsets = numpy.repeat(batch.light_offsets, loop_totals)
+
+        def sample(x, y):
+            index = light_offsets + (y * widths + x) * channels
+            index = index[:, None] + numpy.arange(channels)
+
+            return lighting[numpy.clip(index, 0, len(lighting) - 1)]
+
+        fx, fy = fractions[:, :1], fractions[:, 1:]
+        values = (
+            sample(low[:, 0], low[:, 1]) * (1 - fx) * (1 - fy)
+            + sample(high[:, 0], low[:, 1]) * fx * (1 - fy)
+            + sample(low[:, 0], high[:, 1]) * (1 - fx) * fy
+            + sample(high[:, 0], high[:, 1]) * fx * fy
+        )
+
+        colors = numpy.full((len(positions), 3), 255, dtype=numpy.uint8)
+        is_lit = light_offsets >= 0
+        colors[is_lit] = numpy.rint(values[is_lit]).astype(numpy.uint8)
+
+        return colors
+
+    @cached_property
+    def miptexture_size_array(self):
+        """The width and height of each miptexture as an (N, 2) array. Missing
+        miptextures have a size of one by one."""
+        return numpy.array(
+            [(m.width, m.height) if m else (1, 1) for m in self.miptextures],
+            dtype='<i4'
+        ).reshape(-1, 2)
+
+    def filter_faces(self, face_indices, exclude_texture_classes=()):
+        """Removes degenerate faces and faces with excluded textures.
+
+        Args:
+            face_indices: An array of indices into the faces lump
+
+            exclude_texture_classes: A sequence of texture_classes keys
+
+        Returns:
+            The remaining face indices
+        """
+        faces = self.face_array[face_indices]
+        keep = faces['number_of_edges'] >= 3
+
+        if exclude_texture_classes:
+            miptexture_count = len(self.miptextures)
+            excluded = numpy.array(
+                [texture_class(self.miptexture_name(i)) in exclude_texture_classes for i in range(miptexture_count)],
+                dtype=bool
+            )
+            miptexture_numbers = self.texture_info_array['miptexture_number'][faces['texture_info']]
+            keep &= ~excluded[miptexture_numbers]
+
+        return face_indices[keep]
+
+    def mesh_data(self, face_indices, merge_coplanar=False):
+        """Builds flat polygon data for the given faces with vectorized
+        operations.
+
+        Args:
+            face_indices: An array of indices into the faces lump. Degenerate
+                faces should already be removed with filter_faces.
+
+            merge_coplanar: If True, adjacent faces that share a plane and
+                texture info are merged into single polygons, see
+                merge_coplanar_faces.
+
+        Returns:
+            A MeshData object
+        """
+        loop_totals, loop_vertices = self.face_loops(face_indices)
+
+        if merge_coplanar:
+            face_indices, loop_totals, loop_vertices = self.merge_coplanar_faces(
+                face_indices, loop_totals, loop_vertices)
+
+        vertex_indices, loop_vertices = numpy.unique(loop_vertices, return_inverse=True)
+        vertices = self.vertex_array[vertex_indices]
+
+        texture_infos = self.texture_info_array[self.face_array['texture_info'][face_indices]]
+        uvs = self._loop_uvs(texture_infos, loop_totals, vertices[loop_vertices])
+
+        return MeshData(face_indices, vertices, loop_totals, loop_vertices, uvs, texture_infos['miptexture_number'])
+
+    def _loop_uvs(self, texture_infos, loop_totals, positions):
+        """Projects loop positions with the texture info of their faces."""
+        loop_texture_infos = numpy.repeat(texture_infos, loop_totals)
+        loop_sizes = self.miptexture_size_array[loop_texture_infos['miptexture_number']]
+        positions = positions.astype(numpy.float64)
+        s = numpy.einsum('ij,ij->i', positions, loop_texture_infos['s']) + loop_texture_infos['s_offset']
+        t = numpy.einsum('ij,ij->i', positions, loop_texture_infos['t']) + loop_texture_infos['t_offset']
+
+        return numpy.column_stack((s / loop_sizes[:, 0], -t / loop_sizes[:, 1]))
+
+    def face_batches(self, face_indices, batch_size=16384):
+        """Yields the given faces in batches of flat arrays. Only one batch
+        is held at a time, so consumers that write out and drop each batch
+        stay within a bounded amount of memory.
+
+        Args:
+            face_indices: An array of indices into the faces lump
+
+            batch_size: The maximum number of faces in a batch
+
+        Yields:
+            FaceBatch objects, in the order of face_indices
+        """
+        face_indices = numpy.asarray(face_indices)
+
+        for start in range(0, len(face_indices), batch_size):
+            batch_indices = face_indices[start:start + batch_size]
+            loop_totals, loop_vertices = self.face_loops(batch_indices)
+            faces = self.face_array[batch_indices]
+            texture_infos = self.texture_info_array[faces['texture_info']]
+            positions = self.vertex_array[loop_vertices]
+
+            yield FaceBatch(
+                batch_indices,
+                positions,
+                loop_totals,
+                self._loop_uvs(texture_infos, loop_totals, positions),
+                texture_infos['miptexture_number'],
+                faces['light_offset'].astype(numpy.int64)
+            )
+
+    def merge_coplanar_faces(self, face_indices, loop_totals, loop_vertices, dissolve_collinear=True):
+        """Merges adjacent faces that share a plane, side and texture info
+        into larger polygons. Compiling splits surfaces at leaf and
+        subdivision boundaries, and this undoes most of that.
+
+        Faces are joined with a union-find over the edges they share. The
+        outline of each group is then traced into a single polygon. Groups
+        whose outline is not one simple loop, such as a ring around a hole,
+        are left unmerged.
+
+        Note:
+            A merged polygon no longer maps to a single face in the lighting
+            lump, so it is not suitable for lightmapping.
+
+        Args:
+            face_indices: An array of indices into the faces lump
+
+            loop_totals: The number of loops of each face, see face_loops
+
+            loop_vertices: The vertex index of each loop, see face_loops
+
+            dissolve_collinear: If True, vertices on straight runs of a merged
+                outline are removed.
+
+        Returns:
+            A three-tuple of face_indices, loop_totals and loop_vertices
+            arrays for the merged polygons. Each merged polygon takes the
+            face index of the first face in its group.
+        """
+        face_count = len(face_indices)
+        loop_count = len(loop_vertices)
+
+        if face_count < 2:
+            return face_indices, loop_totals, loop_vertices
+
+        loop_starts = numpy.cumsum(loop_totals) - loop_totals
+        loop_faces = numpy.repeat(numpy.arange(face_count), loop_totals)
+
+        # Directed edge from each loop to the next one in its face
+        next_loops = numpy.arange(1, loop_count + 1)
+        next_loops[loop_starts + loop_totals - 1] = loop_starts
+        edge_starts = loop_vertices
+        edge_ends = loop_vertices[next_loops]
+
+        # Faces can only merge with faces in the same group
+        faces = self.face_array[face_indices]
+        group_keys = numpy.column_stack((faces['plane_number'], faces['side'], faces['texture_info']))
+        _, groups = numpy.unique(group_keys, axis=0, return_inverse=True)
+        loop_groups = groups.ravel()[loop_faces]
+
+        # Find loops that share an undirected edge within a group
+        low = numpy.minimum(edge_starts, edge_ends)
+        high = numpy.maximum(edge_starts, edge_ends)
+        order = numpy.lexsort((high, low, loop_groups))
+        same_edge = (
+            (loop_groups[order][1:] == loop_groups[order][:-1]) &
+            (low[order][1:] == low[order][:-1]) &
+            (high[order][1:] == high[order][:-1])
+        )
+        first_loops = order[:-1][same_edge]
+        second_loops = order[1:][same_edge]
+
+        # Consistently wound neighbors traverse a shared edge in opposite
+        # directions
+        opposite = edge_starts[first_loops] == edge_ends[second_loops]
+        first_loops = first_loops[opposite]
+        second_loops = second_loops[opposite]
+
+        if not len(first_loops):
+            return face_indices, loop_totals, loop_vertices
+
+        labels = _union_find(face_count, loop_faces[first_loops], loop_faces[second_loops])
+
+        interior = numpy.zeros(loop_count, dtype=bool)
+        interior[first_loops] = True
+        interior[second_loops] = True
+
+        group_sizes = numpy.bincount(labels, minlength=face_count)
+        merged = group_sizes[labels] > 1
+
+        result_faces = []
+        result_totals = []
+        result_loops = []
+
+        # Single faces pass through unchanged
+        for face in numpy.flatnonzero(~merged):
+            result_faces.append(face)
+            result_totals.append(loop_totals[face])
+            result_loops.append(loop_vertices[loop_starts[face]:loop_starts[face] + loop_totals[face]])
+
+        # Trace the outline of each merged group
+        boundary = ~interior & merged[loop_faces]
+        boundary_loops = numpy.flatnonzero(boundary)
+        boundary_loops = boundary_loops[numpy.argsort(labels[loop_faces[boundary_loops]], kind='stable')]
+        boundary_labels = labels[loop_faces[boundary_loops]]
+        splits = numpy.flatnonzero(numpy.diff(boundary_labels)) + 1
+
+        # Faces of each merged group, in face order
+        merged_faces = numpy.flatnonzero(merged)
+        merged_faces = merged_faces[numpy.argsort(labels[merged_faces], kind='stable')]
+        group_labels, group_starts = numpy.unique(labels[merged_faces], return_index=True)
+        faces_by_label = dict(zip(group_labels.tolist(), numpy.split(merged_faces, group_starts[1:])))
+
+        for group_loops in numpy.split(boundary_loops, splits):
+            group_faces = faces_by_label[int(labels[loop_faces[group_loops[0]]])]
+            outline = _trace_outline(edge_starts[group_loops], edge_ends[group_loops])
+
+            if outline is not None and dissolve_collinear:
+                outline = self._dissolve_collinear(outline)
+
+            if outline is None:
+                for face in group_faces:
+                    result_faces.append(face)
+                    result_totals.append(loop_totals[face])
+                    result_loops.append(loop_vertices[loop_starts[face]:loop_starts[face] + loop_totals[face]])
+
+                continue
+
+            result_faces.append(group_faces[0])
+            result_totals.append(len(outline))
+            result_loops.append(outline)
+
+        # Keep the original face order
+        order = numpy.argsort(result_faces, kind='stable')
+        result_loops = [result_loops[i] for i in order]
+
+        return (
+            face_indices[numpy.array(result_faces, dtype=numpy.int64)[order]],
+            numpy.array(result_totals, dtype=numpy.int64)[order],
+            numpy.concatenate(result_loops).astype(loop_vertices.dtype)
+        )
+
+    def _dissolve_collinear(self, outline, epsilon=1e-3):
+        """Removes vertices of a polygon outline that lie on a straight line
+        between their neighbors."""
+        points = self.vertex_array[outline].astype(numpy.float64)
+        incoming = points - numpy.roll(points, 1, axis=0)
+        outgoing = numpy.roll(points, -1, axis=0) - points
+        area = numpy.linalg.norm(numpy.cross(incoming, outgoing), axis=1)
+        length = numpy.linalg.norm(incoming, axis=1) * numpy.linalg.norm(outgoing, axis=1)
+        keep = area > epsilon * length
+
+        if keep.sum() < 3:
+            return outline
+
+        return outline[keep]
+
+    @cached_property
+    def node_array(self):
+        """The nodes lump as a structured array. Negative children are leafs,
+        where leaf index = -1 - child."""
+        return self._lumps.array('nodes')
+
+    def face_centroids(self, face_indices):
+        """Computes the average vertex position of each of the given faces.
+
+        Args:
+            face_indices: An array of indices into the faces lump
+
+        Returns:
+            An (N, 3) array
+        """
+        loop_totals, loop_vertices = self.face_loops(face_indices)
+
+        if not len(loop_totals):
+            return numpy.zeros((0, 3))
+
+        loop_starts = numpy.cumsum(loop_totals) - loop_totals
+        sums = numpy.add.reduceat(self.vertex_array[loop_vertices].astype(numpy.float64), loop_starts)
+
+        return sums / loop_totals[:, numpy.newaxis]
+
+    def chunk_faces_by_grid(self, face_indices, size):
+        """Groups faces by the world space grid cell their centroid falls in.
+
+        Args:
+            face_indices: An array of indices into the faces lump
+
+            size: The edge length of a grid cell
+
+        Returns:
+            A dict of cell names to face index arrays
+        """
+        cells = numpy.floor(self.face_centroids(face_indices) / size).astype(numpy.int64)
+
+        return _group_by_rows(face_indices, cells, lambda c: '{}_{}_{}'.format(*c))
+
+    def chunk_faces_by_node(self, face_indices, head_node, depth):
+        """Groups faces by the BSP node subtree they belong to. Each face is
+        owned by a single node, and faces are grouped by that node's ancestor
+        at the given depth below head_node.
+
+        Args:
+            face_indices: An array of indices into the faces lump
+
+            head_node: The root node of the tree, see Model.head_node
+
+            depth: The depth of the subtrees used as chunks
+
+        Returns:
+            A dict of node names to face index arrays
+        """
+        nodes = self.node_array
+        node_count = len(nodes)
+
+        # Models without a tree, such as those written by export_bsp
+        if head_node < 0 or not node_count:
+            return {'other': face_indices}
+
+        # Owning node of each face
+        face_owners = numpy.full(len(self.face_array), -1, dtype=numpy.int64)
+        face_owners[_ranges(nodes['first_face'], nodes['number_of_faces'])] = numpy.repeat(
+            numpy.arange(node_count), nodes['number_of_faces'])
+
+        # Parent of each node
+        children = nodes['children'].ravel()
+        is_node = children >= 0
+        parents = numpy.full(node_count, -1, dtype=numpy.int64)
+        parents[children[is_node]] = numpy.repeat(numpy.arange(node_count), 2)[is_node]
+
+        # Depth of each node below the head node
+        depths = numpy.full(node_count, -1, dtype=numpy.int64)
+        frontier = numpy.array([head_node])
+        level = 0
+
+        while frontier.size:
+            depths[frontier] = level
+            frontier = nodes['children'][frontier].ravel()
+            frontier = frontier[frontier >= 0]
+            level += 1
+
+        # Climb from each owner to its ancestor at the chunk depth
+        owners = face_owners[face_indices]
+        valid = owners >= 0
+        ancestors = owners[valid]
+
+        for _ in range(max(level - 1 - depth, 0)):
+            ancestors = numpy.where(depths[ancestors] > depth, parents[ancestors], ancestors)
+
+        chunks = numpy.full(len(face_indices), -1, dtype=numpy.int64)
+        chunks[valid] = ancestors
+
+        return _group_by_rows(face_indices, chunks[:, numpy.newaxis], lambda c: f'node{c[0]}' if c[0] >= 0 else 'other')
+
+    @cached_property
+    def leaf_array(self):
+        """The leafs lump as a structured array. Leaf 0 is the shared solid
+        leaf."""
+        return self._lumps.array('leafs')
+
+    @cached_property
+    def mark_surface_array(self):
+        """The mark surfaces lump as an array of face indices."""
+        return self._lumps.array('mark_surfaces')
+
+    @cached_property
+    def clip_node_array(self):
+        """The clip nodes lump as a structured array. Negative children are
+        contents values."""
+        return self._lumps.array('clip_nodes')
+
+    def hull_data(self, model_index, hull=1):
+        """Reconstructs the surface of a model's collision hull, see
+        hulls.hull_polygons.
+
+        Args:
+            model_index: The index of the model
+
+            hull: The hull number, from 1 to 3. Hull 0 is the drawn geometry
+                and has no clip nodes.
+
+        Returns:
+            A hulls.HullData object
+        """
+        model = self.model_array[model_index]
+
+        # Wider than any hull's extents
+        margin = 64
+
+        return hulls.hull_polygons(
+            self.plane_array['normal'],
+            self.plane_array['distance'],
+            self.clip_node_array,
+            int(model['head_node'][hull]),
+            model['bounding_box_min'] - margin,
+            model['bounding_box_max'] + margin
+        )
+
+    @property
+    def has_visibility_data(self):
+        """True if the worldspawn BSP tree, its leafs, their mark surfaces
+        and the visibility lump are all present and consistent, so faces can
+        be culled by visibility. Files written by export_bsp have none of
+        them."""
+        if not len(self.model_array) or len(self.leaf_array) < 2 or not len(self.mark_surface_array):
+            return False
+
+        if not len(self._lumps.raw('visibilities')):
+            return False
+
+        nodes = self.node_array
+        head_node = int(self.model_array['head_node'][0][0])
+        children = nodes['children'].astype(numpy.int64)
+
+        return bool(
+            head_node < len(nodes) and -1 - head_node < len(self.leaf_array) and
+            numpy.all(children < len(nodes)) and numpy.all(-1 - children < len(self.leaf_array)) and
+            numpy.all(nodes['plane_number'] < len(self.plane_array))
+        )
+
+    def _node_planes(self, head_node):
+        """Gets the head node and the plane normal and distance of every
+        node."""
+        if head_node is None:
+            head_node = self.get_model(0).head_node if len(self.model_array) else -1
+
+        planes = self.plane_array[self.node_array['plane_number']]
+
+        return head_node, planes['normal'].astype(numpy.float64), planes['distance'].astype(numpy.float64)
+
+    def point_leafs(self, points, head_node=None):
+        """Finds the leaf containing each point. All points descend the tree
+        together, one level per step.
+
+        Args:
+            points: An (N, 3) array of points in map units
+
+            head_node: The root node of the tree. Defaults to the worldspawn
+                model's.
+
+        Returns:
+            An array of leaf indices
+        """
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+        head_node, normals, distances = self._node_planes(head_node)
+
+        if head_node < 0:
+            return numpy.full(len(points), -1 - head_node, dtype=numpy.int64)
+
+        children = self.node_array['children'].astype(numpy.int64)
+        current = numpy.full(len(points), head_node, dtype=numpy.int64)
+        active = numpy.arange(len(points))
+
+        while active.size:
+            nodes = current[active]
+            sides = numpy.einsum('ij,ij->i', points[active], normals[nodes]) < distances[nodes]
+            current[active] = children[nodes, sides.astype(numpy.int64)]
+            active = active[current[active] >= 0]
+
+        return -1 - current
+
+    def box_leafs(self, mins, maxs, head_node=None):
+        """Finds the leafs that touch an axis-aligned box.
+
+        Args:
+            mins: The minimum corner of the box in map units
+
+            maxs: The maximum corner of the box in map units
+
+            head_node: The root node of the tree. Defaults to the worldspawn
+                model's.
+
+        Returns:
+            A sorted array of unique leaf indices
+        """
+        mins = numpy.asarray(mins, dtype=numpy.float64)
+        maxs = numpy.asarray(maxs, dtype=numpy.float64)
+        center, extent = (mins + maxs) / 2, (maxs - mins) / 2
+        head_node, normals, distances = self._node_planes(head_node)
+
+        if head_node < 0:
+            return numpy.array([-1 - head_node], dtype=numpy.int64)
+
+        children = self.node_array['children'].astype(numpy.int64)
+        frontier = numpy.array([head_node], dtype=numpy.int64)
+        leafs = []
+
+        # Every node has one parent, so a node is never visited twice
+        while frontier.size:
+            offsets = normals[frontier] @ center - distances[frontier]
+            radii = numpy.abs(normals[frontier]) @ extent
+            nodes = numpy.concatenate((
+                children[frontier[offsets + radii >= 0], 0],
+                children[frontier[offsets - radii < 0], 1]
+            ))
+            leafs.append(-1 - nodes[nodes < 0])
+            frontier = nodes[nodes >= 0]
+
+        return numpy.unique(numpy.concatenate(leafs))
+
+    def leaf_contents(self, leaf_indices):
+        """Gets the contents of each leaf, see contents_names."""
+        return self.leaf_array['contents'][leaf_indices]
+
+    def point_contents(self, points, head_node=None):
+        """Gets the contents at each point, see contents_names."""
+        return self.leaf_contents(self.point_leafs(points, head_node))
+
+    def leaf_faces(self, leaf_indices):
+        """Finds the faces marked by the given leafs.
+
+        Args:
+            leaf_indices: An array of indices into the leafs lump
+
+        Returns:
+            A sorted array of unique face indices
+        """
+        leafs = self.leaf_array[numpy.asarray(leaf_indices, dtype=numpy.int64)]
+        marks = _ranges(leafs['first_mark_surface'].astype(numpy.int64), leafs['number_of_mark_surfaces'])
+
+        return numpy.unique(self.mark_surface_array[marks].astype(numpy.int64))
+
+    def box_faces(self, mins, maxs, head_node=None):
+        """Finds the faces marked by the leafs that touch an axis-aligned
+        box. Faces are only marked by the leafs they border, so faces of brush
+        models other than worldspawn are not included."""
+        return self.leaf_faces(self.box_leafs(mins, maxs, head_node))
+
+    @cached_property
+    def visibility_rows(self):
+        """The decompressed potentially visible set of every leaf as an
+        (N, M) array of bytes. Bit i of a row is set when leaf i + 1 may be
+        visible. Leafs without visibility data see every leaf.
+
+        The lump is run-length encoded: a zero byte is followed by a count
+        of zero bytes. Counts are never zero, so every byte after a zero is
+        a count and the whole lump is expanded at once. Rows are then
+        sliced out at each leaf's offset.
+        """
+        leafs = self.leaf_array
+        visleafs = int(self.model_array['visleafs'][0]) if len(self.model_array) else 0
+        row_size = (visleafs + 7) // 8
+        rows = numpy.full((len(leafs), row_size), 0xff, dtype=numpy.uint8)
+        data = numpy.frombuffer(self._lumps.raw('visibilities'), dtype=numpy.uint8)
+
+        if not len(data) or not row_size:
+            return rows
+
+        markers = data == 0
+        counts = numpy.zeros(len(data), dtype=numpy.int64)
+        counts[:-1] = markers[:-1] * data[1:]
+        is_count = numpy.zeros(len(data), dtype=bool)
+        is_count[1:] = markers[:-1]
+        lengths = numpy.where(markers, counts, (~is_count).astype(numpy.int64))
+        starts = numpy.cumsum(lengths) - lengths
+
+        # Literal bytes are copied, zero runs stay zero. Rows running off the
+        # end of the lump are padded with zeros.
+        expanded = numpy.zeros(starts[-1] + lengths[-1] + row_size, dtype=numpy.uint8)
+        literals = lengths == 1
+        expanded[starts[literals]] = data[literals]
+
+        offsets = leafs['visibility_offset'].astype(numpy.int64)
+        valid = (offsets >= 0) & (offsets < len(data))
+        valid[0] = False
+        rows[valid] = expanded[starts[offsets[valid]][:, numpy.newaxis] + numpy.arange(row_size)]
+
+        return rows
+
+    def visible_leafs(self, leaf_indices):
+        """Finds the leafs potentially visible from any of the given leafs.
+
+        Args:
+            leaf_indices: An array of indices into the leafs lump
+
+        Returns:
+            A sorted array of unique leaf indices, including the given ones
+        """
+        leaf_indices = numpy.unique(numpy.asarray(leaf_indices, dtype=numpy.int64))
+        rows = numpy.bitwise_or.reduce(self.visibility_rows[leaf_indices], axis=0)
+        bits = numpy.unpackbits(numpy.atleast_1d(rows), bitorder='little')[:len(self.leaf_array) - 1]
+
+        return numpy.union1d(numpy.flatnonzero(bits) + 1, leaf_indices)
+
+    def visible_faces(self, points):
+        """Finds the faces potentially visible from any of the given points,
+        see visible_leafs."""
+        return self.leaf_faces(self.visible_leafs(self.point_leafs(points)))
+
+    def contents_faces(self, contents):
+        """Finds the faces bordering leafs with the given contents, such as
+        the surfaces of every CONTENTS_WATER volume."""
+        return self.leaf_faces(numpy.flatnonzero(self.leaf_array['contents'] == contents))
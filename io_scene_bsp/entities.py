@@ -0,0 +1,173 @@
+"""This module parses the entities lump.
+
+The lump is tokenized in a single pass. Entity records keep their raw string
+values, and the numeric fields origin, angle and angles are converted to
+floats as they are parsed. The parsed entities are indexed by classname,
+targetname, target and brush model number.
+"""
+import re
+
+__all__ = ['Entity', 'Entities', 'loads']
+
+
+# Quoted strings, comments, braces and bare words, in that order of priority
+_token_pattern = re.compile(r'"([^"]*)"|(//[^\n]*)|([{}])|([^\s{}"]+)')
+
+_vector_keys = ('origin', 'angles')
+
+_float_keys = ('angle',)
+
+
+def _float(value, default=0.0):
+    try:
+        return float(value)
+
+    except ValueError:
+        return default
+
+
+def _vector(value):
+    try:
+        x, y, z = map(float, value.split())
+        return x, y, z
+
+    except ValueError:
+        pass
+
+    # Pad, truncate or zero malformed components
+    components = value.split()[:3]
+    components += ['0'] * (3 - len(components))
+
+    return tuple(_float(c) for c in components)
+
+
+class Entity(dict):
+    """Key value pairs of an entity.
+
+    Note:
+        Values are the raw strings from the lump. Keys can also be read as
+        attributes. The origin and angles attributes are three-tuples of
+        floats and angle is a float. Missing keys raise AttributeError.
+
+    Attributes:
+        index: The position of the entity in the lump.
+    """
+
+    __slots__ = ('index', 'origin', 'angle', 'angles')
+
+    def __init__(self, index=0):
+        super().__init__()
+        self.index = index
+
+    def __getattr__(self, name):
+        # Unset numeric attributes mean the key is missing
+        if name in Entity.__slots__:
+            raise AttributeError(name)
+
+        try:
+            return self[name]
+
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def convert(self):
+        """Converts the numeric fields from their string values."""
+        for key in _vector_keys:
+            if key in self:
+                setattr(self, key, _vector(self[key]))
+
+        for key in _float_keys:
+            if key in self:
+                setattr(self, key, _float(self[key]))
+
+    @property
+    def model_number(self):
+        """The brush model number of a '*N' model key, or None."""
+        model = self.get('model', '')
+
+        if model.startswith('*') and model[1:].isdigit():
+            return int(model[1:])
+
+        return None
+
+
+class Entities(list):
+    """A list of Entity objects with lookup indexes.
+
+    Attributes:
+        by_classname: A dict of classnames to lists of entities.
+
+        by_targetname: A dict of targetnames to lists of entities.
+
+        by_target: A dict of targets to lists of entities.
+
+        by_model: A dict of brush model numbers to entities.
+    """
+
+    def __init__(self, entities=()):
+        super().__init__()
+        self.by_classname = {}
+        self.by_targetname = {}
+        self.by_target = {}
+        self.by_model = {}
+
+        for entity in entities:
+            self.append(entity)
+
+    def append(self, entity):
+        super().append(entity)
+
+        self.by_classname.setdefault(entity.get('classname', ''), []).append(entity)
+
+        if 'targetname' in entity:
+            self.by_targetname.setdefault(entity['targetname'], []).append(entity)
+
+        if 'target' in entity:
+            self.by_target.setdefault(entity['target'], []).append(entity)
+
+        model_number = entity.model_number
+
+        if model_number is not None:
+            self.by_model[model_number] = entity
+
+    def targets_of(self, entity):
+        """The entities targeted by the given entity."""
+        return self.by_targetname.get(entity.get('target'), [])
+
+
+def loads(text):
+    """Parses the text of an entities lump.
+
+    Args:
+        text: The lump as a string
+
+    Returns:
+        An Entities object
+    """
+    result = Entities()
+    entity = None
+    key = None
+
+    for quoted, comment, brace, bare in _token_pattern.findall(text):
+        if brace:
+            if brace == '{':
+                entity = Entity(len(result))
+
+            elif entity is not None:
+                entity.convert()
+                result.append(entity)
+                entity = None
+
+            key = None
+
+        elif comment or entity is None:
+            continue
+
+        elif key is None:
+            key = quoted or bare
+
+        else:
+            entity[key] = quoted or bare
+            key = None
+
+    return result
@@ -1,2 +1,578 @@
-def save(operator, context, **kwargs):
-    raise NotImplementedError('Export of BSP data not supported!')
\ No newline at end of file
+if 'lumps' in locals():
+    import importlib as il
+    il.reload(lumps)
+    # print('io_scene_bsp.export_bsp: reload ready.')
+
+else:
+    from . import lumps
+
+import struct
+
+import bpy
+import numpy
+
+from vgio.quake import palette
+
+CONTENTS_SOLID = -2
+TEX_SPECIAL = 1
+
+
+def _unique_rows(values, decimals):
+    """Welds nearly equal rows of a float array.
+
+    Returns:
+        A two-tuple of the unique rows and the index of each input row into
+        them.
+    """
+    rounded = numpy.ascontiguousarray(numpy.round(values, decimals) + 0.0)
+    keys = rounded.view(numpy.dtype((numpy.void, rounded.dtype.itemsize * rounded.shape[1]))).ravel()
+    _, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+
+    return values[first], inverse.ravel()
+
+
+def mesh_arrays(ob, mesh, global_scale=1.0):
+    """Reads the geometry of an evaluated mesh in bulk with foreach_get.
+
+    Args:
+        ob: The object the mesh belongs to
+
+        mesh: The evaluated mesh
+
+        global_scale: Scale the vertex positions are divided by
+
+    Returns:
+        A dict of vertices, loop_totals, loop_vertices, uvs and texture_names
+        arrays. Vertices are in world space.
+    """
+    vertices = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float32)
+    mesh.vertices.foreach_get('co', vertices)
+    vertices = vertices.reshape(-1, 3).astype(numpy.float64)
+
+    matrix = numpy.array(ob.matrix_world, dtype=numpy.float64)
+    vertices = (vertices @ matrix[:3, :3].T + matrix[:3, 3]) / global_scale
+
+    loop_totals = numpy.empty(len(mesh.polygons), dtype=numpy.int32)
+    mesh.polygons.foreach_get('loop_total', loop_totals)
+
+    loop_vertices = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+    mesh.loops.foreach_get('vertex_index', loop_vertices)
+
+    uvs = numpy.zeros(len(mesh.loops) * 2, dtype=numpy.float32)
+
+    if mesh.uv_layers.active:
+        mesh.uv_layers.active.data.foreach_get('uv', uvs)
+
+    material_indices = numpy.empty(len(mesh.polygons), dtype=numpy.int32)
+    mesh.polygons.foreach_get('material_index', material_indices)
+
+    slot_names = [s.material.name if s.material else '' for s in ob.material_slots] or ['']
+    material_indices = numpy.clip(material_indices, 0, len(slot_names) - 1)
+
+    return {
+        'vertices': vertices,
+        'loop_totals': loop_totals.astype(numpy.int64),
+        'loop_vertices': loop_vertices.astype(numpy.int64),
+        'uvs': uvs.reshape(-1, 2).astype(numpy.float64),
+        'texture_names': numpy.array(slot_names, dtype=object)[material_indices]
+    }
+
+
+def concatenate_mesh_arrays(arrays):
+    """Joins the output of several mesh_arrays calls, offsetting the loop
+    vertex indices."""
+    vertex_offsets = numpy.cumsum([0] + [len(a['vertices']) for a in arrays])
+
+    return {
+        'vertices': numpy.concatenate([a['vertices'] for a in arrays] + [numpy.empty((0, 3))]),
+        'loop_totals': numpy.concatenate([a['loop_totals'] for a in arrays] + [numpy.empty(0, numpy.int64)]),
+        'loop_vertices': numpy.concatenate(
+            [a['loop_vertices'] + o for a, o in zip(arrays, vertex_offsets)] + [numpy.empty(0, numpy.int64)]),
+        'uvs': numpy.concatenate([a['uvs'] for a in arrays] + [numpy.empty((0, 2))]),
+        'texture_names': numpy.concatenate([a['texture_names'] for a in arrays] + [numpy.empty(0, object)])
+    }
+
+
+def polygon_planes(positions, loop_totals):
+    """Computes the plane of each polygon with Newell's method.
+
+    Args:
+        positions: An (N, 3) array of the position of each loop
+
+        loop_totals: The number of loops of each polygon
+
+    Returns:
+        A four-tuple of the canonical plane normals, distances, types and
+        the side of each face. Normals are snapped to an axis where
+        possible and their largest component is always positive, as in qbsp.
+    """
+    loop_starts = numpy.cumsum(loop_totals) - loop_totals
+
+    next_loops = numpy.arange(len(positions)) + 1
+    next_loops[loop_starts + loop_totals - 1] = loop_starts
+    current, following = positions, positions[next_loops]
+
+    terms = numpy.column_stack((
+        (current[:, 1] - following[:, 1]) * (current[:, 2] + following[:, 2]),
+        (current[:, 2] - following[:, 2]) * (current[:, 0] + following[:, 0]),
+        (current[:, 0] - following[:, 0]) * (current[:, 1] + following[:, 1])
+    ))
+    normals = numpy.add.reduceat(terms, loop_starts, axis=0) if len(loop_starts) else terms[:0]
+    lengths = numpy.linalg.norm(normals, axis=1)
+    normals /= numpy.where(lengths > 0, lengths, 1)[:, numpy.newaxis]
+
+    centers = numpy.add.reduceat(positions, loop_starts, axis=0) if len(loop_starts) else positions[:0]
+    centers /= numpy.maximum(loop_totals, 1)[:, numpy.newaxis]
+
+    # Snap nearly axial normals
+    axes = numpy.argmax(numpy.abs(normals), axis=1)
+    dominant = normals[numpy.arange(len(normals)), axes]
+    axial = numpy.abs(dominant) > 1 - 1e-6
+    normals[axial] = 0
+    normals[axial, axes[axial]] = numpy.sign(dominant[axial])
+
+    sides = dominant < 0
+    normals[sides] *= -1
+    normals += 0.0
+    types = numpy.where(axial, axes, axes + 3)
+    distances = numpy.einsum('ij,ij->i', normals, centers)
+
+    return normals, distances, types, sides
+
+
+def polygon_texture_axes(positions, uvs, normals, loop_totals, sizes):
+    """Recovers the texture projection of each polygon from its UVs.
+
+    The s and t axes are solved from the three loops spanning the largest
+    triangle, constrained to the polygon's plane.
+
+    Args:
+        positions: An (N, 3) array of the position of each loop
+
+        uvs: An (N, 2) array of the texture coordinates of each loop
+
+        normals: The normal of each polygon
+
+        loop_totals: The number of loops of each polygon
+
+        sizes: The texture width and height of each polygon
+
+    Returns:
+        An (M, 8) array of s, s_offset, t and t_offset values
+    """
+    polygon_count = len(loop_totals)
+    loop_starts = numpy.cumsum(loop_totals) - loop_totals
+    polygon_numbers = numpy.repeat(numpy.arange(polygon_count), loop_totals)
+
+    texels = uvs * numpy.repeat(sizes, loop_totals, axis=0)
+    texels[:, 1] *= -1
+
+    first = loop_starts
+    second = numpy.minimum(loop_starts + 1, loop_starts + loop_totals - 1)
+
+    # Pick the loop furthest from the line through the first two
+    edge = positions[second] - positions[first]
+    areas = numpy.linalg.norm(
+        numpy.cross(positions - positions[first][polygon_numbers], edge[polygon_numbers]), axis=1)
+    order = numpy.lexsort((areas, polygon_numbers))
+    third = order[loop_starts + loop_totals - 1]
+
+    systems = numpy.zeros((polygon_count, 4, 4))
+    systems[:, 0, :3] = positions[first]
+    systems[:, 1, :3] = positions[second]
+    systems[:, 2, :3] = positions[third]
+    systems[:, :3, 3] = 1
+    systems[:, 3, :3] = normals
+
+    targets = numpy.zeros((polygon_count, 4, 2))
+    targets[:, 0] = texels[first]
+    targets[:, 1] = texels[second]
+    targets[:, 2] = texels[third]
+
+    solutions = numpy.linalg.pinv(systems) @ targets
+
+    return numpy.column_stack((solutions[:, :, 0], solutions[:, :, 1]))
+
+
+def quantize(pixels):
+    """Maps RGBA float pixels to the Quake palette.
+
+    Fullbright colors are not used. Pixels with less than half alpha map to
+    the transparent index 255.
+
+    Args:
+        pixels: An (N, 4) array of RGBA values in the range [0, 1]
+
+    Returns:
+        An array of palette indices
+    """
+    colors = numpy.array(palette[:224], dtype=numpy.float32)
+    rgb = pixels[:, :3] * 255
+    indices = numpy.empty(len(pixels), dtype=numpy.uint8)
+    color_norms = (colors ** 2).sum(axis=1)
+
+    # Work in blocks to bound the size of the distance matrix
+    for start in range(0, len(pixels), 16384):
+        block = rgb[start:start + 16384]
+        distances = color_norms - 2 * block @ colors.T
+        indices[start:start + 16384] = numpy.argmin(distances, axis=1)
+
+    indices[pixels[:, 3] < 0.5] = 255
+
+    return indices
+
+
+def material_image(material):
+    """Finds the image used as the miptexture of a material."""
+    if not material or not material.node_tree:
+        return None
+
+    node = material.node_tree.nodes.get('Miptexture')
+
+    if node and node.type == 'TEX_IMAGE' and node.image:
+        return node.image
+
+    for node in material.node_tree.nodes:
+        if node.type == 'TEX_IMAGE' and node.image:
+            return node.image
+
+    return None
+
+
+def miptexture_data(name, image):
+    """Builds a miptexture with all four mip levels.
+
+    Images are resized to a multiple of sixteen texels with nearest
+    neighbour sampling. Materials without an image get a gray placeholder,
+    and animated texture strips export their first frame.
+
+    Args:
+        name: The texture name
+
+        image: A Blender image or None
+
+    Returns:
+        A two-tuple of the (width, height) and the miptexture bytes
+    """
+    if image and image.size[0] and image.size[1]:
+        width, height = image.size
+        pixels = numpy.empty(width * height * 4, dtype=numpy.float32)
+        image.pixels.foreach_get(pixels)
+
+        # Blender stores rows bottom to top
+        pixels = pixels.reshape(height, width, 4)[::-1]
+
+        frame_count = len(image.get('bsp_frames', ()))
+
+        if frame_count > 1:
+            width //= frame_count
+            pixels = pixels[:, :width]
+
+    else:
+        width, height = 16, 16
+        pixels = numpy.full((height, width, 4), 0.5, dtype=numpy.float32)
+
+    new_width, new_height = (max(16, (d + 15) // 16 * 16) for d in (width, height))
+
+    if (new_width, new_height) != (width, height):
+        rows = numpy.arange(new_height) * height // new_height
+        columns = numpy.arange(new_width) * width // new_width
+        pixels = pixels[rows[:, numpy.newaxis], columns]
+        width, height = new_width, new_height
+
+    levels = []
+
+    for level in range(4):
+        levels.append(quantize(pixels.reshape(-1, 4)))
+        h, w = pixels.shape[:2]
+        pixels = pixels.reshape(h // 2, 2, w // 2, 2, 4).mean(axis=(1, 3))
+
+    header = numpy.zeros(1, dtype=lumps.miptexture_header_dtype)
+    header['name'] = name.encode('ascii', 'replace')[:15]
+    header['width'] = width
+    header['height'] = height
+    header['offsets'] = lumps.miptexture_header_dtype.itemsize + numpy.cumsum([0] + [len(l) for l in levels[:-1]])
+
+    return (width, height), b''.join([header.tobytes()] + [l.tobytes() for l in levels])
+
+
+def miptextures_lump(miptextures):
+    """Serializes a sequence of miptexture bytes as a miptexture lump."""
+    count = len(miptextures)
+    sizes = numpy.array([len(m) for m in miptextures], dtype=numpy.int64)
+    offsets = 4 + 4 * count + numpy.cumsum(sizes) - sizes
+
+    return b''.join([
+        struct.pack('<i', count),
+        offsets.astype('<i4').tobytes(),
+        *miptextures
+    ])
+
+
+def entities_lump(entities):
+    """Serializes a sequence of dicts as an entities lump."""
+    blocks = []
+
+    for entity in entities:
+        pairs = ''.join(f'"{key}" "{value}"\n' for key, value in entity.items())
+        blocks.append(f'{{\n{pairs}}}\n')
+
+    return ''.join(blocks).encode('ascii', 'replace') + b'\x00'
+
+
+def is_brush_object(ob):
+    """True if the given object holds brush geometry. Collision hull
+    wireframes and point clouds have no faces of their own and are left out.
+    """
+    if ob.type != 'MESH' or not ob.data.polygons:
+        return False
+
+    return not str(ob.get('bsp_chunk', '')).startswith('hull')
+
+
+def import_roots():
+    """Maps the name of every collection made by an import to the name of
+    the import's root collection, which has a bsp_filepath property."""
+    roots = {}
+
+    def add_children(collection, root_name):
+        for child in collection.children:
+            roots[child.name] = root_name
+            add_children(child, root_name)
+
+    for collection in bpy.data.collections:
+        if 'bsp_filepath' in collection:
+            roots[collection.name] = collection.name
+            add_children(collection, collection.name)
+
+    return roots
+
+
+def model_objects(objects):
+    """Groups mesh objects by the brush model they belong to. Objects
+    without a bsp_model property are part of the worldspawn model. Brush
+    models of different imported maps are kept apart by the root collection
+    of their import.
+
+    Returns:
+        A list of (classname, objects) pairs. The first is always
+        worldspawn.
+    """
+    roots = import_roots()
+    models = {('', 0): []}
+
+    for ob in objects:
+        model = ob.get('bsp_model', 0)
+        root = next((roots[c.name] for c in ob.users_collection if c.name in roots), '')
+        key = (root, model) if model else ('', 0)
+        models.setdefault(key, []).append(ob)
+
+    result = []
+
+    for key in sorted(models, key=lambda k: (k != ('', 0), k)):
+        obs = models[key]
+        classname = 'worldspawn' if key == ('', 0) else obs[0].name.split('.')[0]
+        result.append((classname, obs))
+
+    return result
+
+
+def save(operator,
+         context,
+         filepath='',
+         use_selection=False,
+         global_scale=1.0):
+    """Exports mesh objects as a BSP file.
+
+    All mesh data is read in bulk with foreach_get. Vertices, edges, planes
+    and texture infos are deduplicated with array operations and each lump is
+    written with a single tobytes call.
+
+    Objects with a bsp_model property are written as brush models, all
+    others are merged into the worldspawn model. Collision hull objects and
+    meshes without polygons are skipped. Only geometry lumps are
+    written, no BSP tree, visibility or lighting is computed. The BSP2
+    format is used when the data exceeds the limits of BSP29.
+
+    Returns:
+        {'FINISHED'} or {'CANCELLED'}
+    """
+    objects = context.selected_objects if use_selection else context.scene.objects
+    objects = [ob for ob in objects if is_brush_object(ob)]
+
+    if not objects:
+        operator.report({'ERROR'}, 'No mesh objects to export')
+        return {'CANCELLED'}
+
+    depsgraph = context.evaluated_depsgraph_get()
+
+    models = []
+    model_arrays = []
+
+    for classname, obs in model_objects(objects):
+        arrays = []
+
+        for ob in obs:
+            ob_eval = ob.evaluated_get(depsgraph)
+            mesh = ob_eval.to_mesh()
+
+            try:
+                arrays.append(mesh_arrays(ob, mesh, global_scale))
+
+            finally:
+                ob_eval.to_mesh_clear()
+
+        models.append(classname)
+        model_arrays.append(concatenate_mesh_arrays(arrays))
+
+    data = concatenate_mesh_arrays(model_arrays)
+
+    # Drop degenerate polygons
+    loop_totals = data['loop_totals']
+    keep_loops = numpy.repeat(loop_totals >= 3, loop_totals)
+    model_face_counts = [numpy.count_nonzero(a['loop_totals'] >= 3) for a in model_arrays]
+    loop_totals = loop_totals[loop_totals >= 3]
+    texture_names = data['texture_names'][data['loop_totals'] >= 3]
+    uvs = data['uvs'][keep_loops]
+
+    # Weld vertices
+    vertices, vertex_map = _unique_rows(data['vertices'], 3)
+    loop_vertices = vertex_map[data['loop_vertices'][keep_loops]]
+    positions = vertices[loop_vertices]
+
+    # Edges. Faces list their edges in reverse loop order, so each loop
+    # contributes the edge back to its previous loop
+    loop_count = len(loop_vertices)
+    loop_starts = numpy.cumsum(loop_totals) - loop_totals
+    loop_ends = loop_starts + loop_totals - 1
+    previous_loops = numpy.arange(loop_count) - 1
+    previous_loops[loop_starts] = loop_ends
+
+    starts = loop_vertices
+    ends = loop_vertices[previous_loops]
+    low = numpy.minimum(starts, ends)
+    high = numpy.maximum(starts, ends)
+    edge_keys, first, inverse = numpy.unique(
+        low * len(vertices) + high, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    # Edge zero is unused since it can't be negated
+    edges = numpy.zeros((len(edge_keys) + 1, 2), dtype=numpy.int64)
+    edges[1:, 0] = low[first]
+    edges[1:, 1] = high[first]
+
+    loop_surf_edges = numpy.where(starts == low, inverse + 1, -(inverse + 1))
+    polygon_numbers = numpy.repeat(numpy.arange(len(loop_totals)), loop_totals)
+    surf_edges = loop_surf_edges[loop_starts[polygon_numbers] + loop_ends[polygon_numbers] - numpy.arange(loop_count)]
+
+    # Planes
+    normals, distances, types, sides = polygon_planes(positions, loop_totals)
+    planes, plane_numbers = _unique_rows(numpy.column_stack((normals, distances, types)), 4)
+
+    # Miptextures
+    texture_list, texture_numbers = numpy.unique(texture_names.astype(str), return_inverse=True)
+    texture_numbers = texture_numbers.ravel()
+    miptextures = []
+    texture_sizes = []
+
+    for name in texture_list:
+        material = bpy.data.materials.get(name)
+        size, miptexture = miptexture_data(name or 'missing', material_image(material))
+        texture_sizes.append(size)
+        miptextures.append(miptexture)
+
+    texture_sizes = numpy.array(texture_sizes, dtype=numpy.float64).reshape(-1, 2)
+
+    # Texture infos
+    flags = numpy.array(
+        [n.startswith('*') or n.lower().startswith('sky') for n in texture_list], dtype=numpy.int64)
+    axes = polygon_texture_axes(positions, uvs, normals, loop_totals, texture_sizes[texture_numbers])
+    texture_infos, texture_info_numbers = _unique_rows(
+        numpy.column_stack((axes, texture_numbers, flags[texture_numbers] * TEX_SPECIAL)), 4)
+
+    use_bsp2 = (
+        len(vertices) > 0xffff
+        or len(planes) > 0x7fff
+        or len(texture_infos) > 0x7fff
+        or loop_totals.max(initial=0) > 0x7fff
+    )
+    schema = lumps.bsp2 if use_bsp2 else lumps.bsp29
+    dtypes = schema.dtypes
+
+    lump_data = dict.fromkeys(lumps.lump_names, b'')
+
+    lump_data['entities'] = entities_lump(
+        [{'classname': 'worldspawn'}] +
+        [{'classname': classname, 'model': f'*{i}'} for i, classname in enumerate(models) if i]
+    )
+
+    plane_array = numpy.zeros(len(planes), dtype=dtypes['planes'])
+    plane_array['normal'] = planes[:, :3]
+    plane_array['distance'] = planes[:, 3]
+    plane_array['type'] = planes[:, 4]
+    lump_data['planes'] = plane_array.tobytes()
+
+    lump_data['miptextures'] = miptextures_lump(miptextures)
+    lump_data['vertexes'] = vertices.astype('<f4').tobytes()
+
+    texture_info_array = numpy.zeros(len(texture_infos), dtype=dtypes['texture_infos'])
+    texture_info_array['s'] = texture_infos[:, 0:3]
+    texture_info_array['s_offset'] = texture_infos[:, 3]
+    texture_info_array['t'] = texture_infos[:, 4:7]
+    texture_info_array['t_offset'] = texture_infos[:, 7]
+    texture_info_array['miptexture_number'] = texture_infos[:, 8]
+    texture_info_array['flags'] = texture_infos[:, 9]
+    lump_data['texture_infos'] = texture_info_array.tobytes()
+
+    face_array = numpy.zeros(len(loop_totals), dtype=dtypes['faces'])
+    face_array['plane_number'] = plane_numbers
+    face_array['side'] = sides
+    face_array['first_edge'] = loop_starts
+    face_array['number_of_edges'] = loop_totals
+    face_array['texture_info'] = texture_info_numbers
+    face_array['styles'] = 255
+    face_array['light_offset'] = -1
+    lump_data['faces'] = face_array.tobytes()
+
+    # A single solid leaf for brush models to point at
+    leaf_array = numpy.zeros(1, dtype=dtypes['leafs'])
+    leaf_array['contents'] = CONTENTS_SOLID
+    leaf_array['visibility_offset'] = -1
+    lump_data['leafs'] = leaf_array.tobytes()
+
+    lump_data['edges'] = edges.astype(dtypes['edges'].base).tobytes()
+    lump_data['surf_edges'] = surf_edges.astype('<i4').tobytes()
+
+    model_array = numpy.zeros(len(models), dtype=dtypes['models'])
+    first_faces = numpy.cumsum([0] + model_face_counts[:-1])
+    loop_boundaries = numpy.concatenate(([0], numpy.cumsum(loop_totals)))
+    model_loop_boundaries = loop_boundaries[numpy.cumsum([0] + model_face_counts)]
+
+    for i, (start, end) in enumerate(zip(model_loop_boundaries[:-1], model_loop_boundaries[1:])):
+        if end > start:
+            model_array['bounding_box_min'][i] = positions[start:end].min(axis=0)
+            model_array['bounding_box_max'][i] = positions[start:end].max(axis=0)
+
+    model_array['head_node'] = -1
+    model_array['first_face'] = first_faces
+    model_array['number_of_faces'] = model_face_counts
+    lump_data['models'] = model_array.tobytes()
+
+    # Lay out the lumps after the header on four byte boundaries
+    directory = []
+    chunks = []
+    offset = lumps.header_size
+
+    for name in lumps.lump_names:
+        lump = lump_data[name]
+        padding = -len(lump) % 4
+        directory += offset, len(lump)
+        chunks.append(lump + b'\x00' * padding)
+        offset += len(lump) + padding
+
+    with open(filepath, 'wb') as file:
+        file.write(schema.identity)
+        file.write(struct.pack(f'<{len(directory)}i', *directory))
+        file.write(b''.join(chunks))
+
+    return {'FINISHED'}
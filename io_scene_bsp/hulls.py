@@ -0,0 +1,305 @@
+"""This module reconstructs collision hull geometry from clip nodes.
+
+Clip nodes form a BSP tree whose leafs are contents values instead of leaf
+indices. The hull surface is found without building any leaf volumes:
+
+    1. Every node's portal, the cross section of its region on its plane,
+       is made by clipping a large square on the plane against the planes
+       of its ancestors.
+
+    2. Each portal is pushed down the node's back subtree and then its front
+       subtree, splitting it wherever it crosses a plane. Fragments that end
+       up with solid on one side only are part of the hull surface.
+
+Polygons are stored as padded (N, C, 3) vertex arrays with a vertex count per
+polygon, so each step clips every polygon at once.
+"""
+from collections import namedtuple
+
+import numpy
+
+__all__ = ['HullData', 'clip_polygons', 'hull_polygons']
+
+
+CONTENTS_SOLID = -2
+
+HullData = namedtuple('HullData', 'vertices loop_totals loop_vertices')
+"""Polygons of a collision hull.
+
+Attributes:
+    vertices: An (N, 3) array of unique vertex positions.
+
+    loop_totals: The number of loops of each polygon.
+
+    loop_vertices: The index into vertices of each loop.
+"""
+
+
+def clip_polygons(vertices, counts, normals, distances, epsilon=0.01):
+    """Keeps the part of each convex polygon in front of its plane.
+
+    Args:
+        vertices: An (N, C, 3) array of polygon vertices. Slots past a
+            polygon's count are ignored.
+
+        counts: The number of vertices of each polygon
+
+        normals: An (N, 3) array of plane normals
+
+        distances: The distance of each plane from the origin
+
+        epsilon: Vertices closer to a plane than this are on it
+
+    Returns:
+        A two-tuple of the clipped vertices and counts. Polygons clipped away
+        have fewer than three vertices.
+    """
+    polygon_count, capacity = vertices.shape[:2]
+    slots = numpy.arange(capacity)
+    valid = slots < counts[:, numpy.newaxis]
+
+    sides = numpy.einsum('ijk,ik->ij', vertices, normals) - distances[:, numpy.newaxis]
+    sides[numpy.abs(sides) < epsilon] = 0
+
+    # The next vertex of each edge
+    next_slots = numpy.where(slots + 1 < counts[:, numpy.newaxis], slots + 1, 0)
+    next_vertices = numpy.take_along_axis(vertices, next_slots[..., numpy.newaxis], axis=1)
+    next_sides = numpy.take_along_axis(sides, next_slots, axis=1)
+
+    keep = valid & (sides >= 0)
+    crosses = valid & (sides * next_sides < 0)
+    fractions = sides / numpy.where(crosses, sides - next_sides, 1)
+    intersections = vertices + fractions[..., numpy.newaxis] * (next_vertices - vertices)
+
+    # Each edge emits its start vertex if kept, then its crossing if any
+    candidates = numpy.stack((vertices, intersections), axis=2).reshape(polygon_count, 2 * capacity, 3)
+    emitted = numpy.stack((keep, crosses), axis=2).reshape(polygon_count, 2 * capacity)
+    new_counts = emitted.sum(axis=1)
+    new_capacity = int(new_counts.max(initial=0))
+    order = numpy.argsort(~emitted, axis=1, kind='stable')[:, :new_capacity]
+
+    return numpy.take_along_axis(candidates, order[..., numpy.newaxis], axis=1), new_counts
+
+
+def _compact(vertices, counts, *arrays):
+    """Drops polygons with fewer than three vertices."""
+    keep = counts >= 3
+
+    return (vertices[keep], counts[keep]) + tuple(a[keep] for a in arrays)
+
+
+def _base_polygons(normals, distances, mins, maxs):
+    """Makes a square on each plane large enough to cover the box. Vertices
+    wind counterclockwise around the normal."""
+    center = (mins + maxs) / 2
+    radius = numpy.linalg.norm(maxs - mins)
+
+    # Pick the world axis least aligned with each normal
+    axes = numpy.eye(3)[numpy.argmin(numpy.abs(normals), axis=1)]
+    us = numpy.cross(normals, axes)
+    us /= numpy.linalg.norm(us, axis=1)[:, numpy.newaxis]
+    vs = numpy.cross(normals, us)
+
+    centers = center - (normals @ center - distances)[:, numpy.newaxis] * normals
+    corners = numpy.array([(-1, -1), (1, -1), (1, 1), (-1, 1)], dtype=numpy.float64) * radius
+
+    return centers[:, numpy.newaxis] + corners[:, 0, numpy.newaxis] * us[:, numpy.newaxis] + \
+        corners[:, 1, numpy.newaxis] * vs[:, numpy.newaxis]
+
+
+def _push(vertices, counts, nodes, interiors, normals, distances, children, epsilon):
+    """Pushes polygons down the tree until each fragment reaches a contents
+    leaf.
+
+    Args:
+        nodes: The node each polygon starts at
+
+        interiors: A direction into the region each polygon bounds. It
+            decides the side of planes the polygon lies on.
+
+    Returns:
+        A four-tuple of fragment vertices, counts, source polygon indices and
+        contents
+    """
+    sources = numpy.arange(len(counts))
+    results = []
+
+    while True:
+        at_leaf = nodes < 0
+        results.append((vertices[at_leaf], counts[at_leaf], sources[at_leaf], nodes[at_leaf]))
+
+        vertices, counts, nodes, sources = vertices[~at_leaf], counts[~at_leaf], nodes[~at_leaf], sources[~at_leaf]
+
+        if not len(nodes):
+            break
+
+        valid = numpy.arange(vertices.shape[1]) < counts[:, numpy.newaxis]
+        sides = numpy.einsum('ijk,ik->ij', vertices, normals[nodes]) - distances[nodes, numpy.newaxis]
+        has_front = numpy.any(valid & (sides > epsilon), axis=1)
+        has_back = numpy.any(valid & (sides < -epsilon), axis=1)
+
+        # Polygons on the plane go to the side their region is on
+        on_plane = ~has_front & ~has_back
+        inward = numpy.einsum('ij,ij->i', interiors[sources], normals[nodes]) > 0
+        to_front = (has_front & ~has_back) | (on_plane & inward)
+        to_back = (has_back & ~has_front) | (on_plane & ~inward)
+        split = has_front & has_back
+
+        front_vertices, front_counts = clip_polygons(
+            vertices[split], counts[split], normals[nodes[split]], distances[nodes[split]], epsilon)
+        back_vertices, back_counts = clip_polygons(
+            vertices[split], counts[split], -normals[nodes[split]], -distances[nodes[split]], epsilon)
+
+        capacity = max(vertices.shape[1], front_vertices.shape[1], back_vertices.shape[1])
+        vertices = numpy.concatenate([_pad(v, capacity) for v in (vertices[to_front | to_back], front_vertices, back_vertices)])
+        counts = numpy.concatenate((counts[to_front | to_back], front_counts, back_counts))
+        moved = nodes[to_front | to_back]
+        nodes = numpy.concatenate((
+            children[moved, numpy.where(to_front[to_front | to_back], 0, 1)],
+            children[nodes[split], 0],
+            children[nodes[split], 1]
+        ))
+        sources = numpy.concatenate((sources[to_front | to_back], sources[split], sources[split]))
+        vertices, counts, nodes, sources = _compact(vertices, counts, nodes, sources)
+
+    capacity = max(r[0].shape[1] for r in results)
+
+    return (
+        numpy.concatenate([_pad(r[0], capacity) for r in results]),
+        numpy.concatenate([r[1] for r in results]),
+        numpy.concatenate([r[2] for r in results]),
+        numpy.concatenate([r[3] for r in results])
+    )
+
+
+def _pad(vertices, capacity):
+    return numpy.pad(vertices, ((0, 0), (0, capacity - vertices.shape[1]), (0, 0)))
+
+
+def hull_polygons(normals, distances, clip_nodes, head_node, mins, maxs, epsilon=0.01, batch_size=16384):
+    """Reconstructs the surface of a collision hull.
+
+    Args:
+        normals: An (N, 3) array of the normals of the planes lump
+
+        distances: The distances of the planes lump
+
+        clip_nodes: The clip nodes lump as a structured array
+
+        head_node: The root clip node of the hull
+
+        mins: The minimum corner of a box around the hull
+
+        maxs: The maximum corner of a box around the hull. Surfaces outside
+            of the box are not reconstructed.
+
+        epsilon: Plane distance tolerance
+
+        batch_size: The number of portals processed at once, which bounds
+            memory use
+
+    Returns:
+        A HullData object. Polygons face away from solid space.
+    """
+    empty = HullData(numpy.zeros((0, 3)), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+
+    if head_node < 0 or head_node >= len(clip_nodes):
+        return empty
+
+    mins = numpy.asarray(mins, dtype=numpy.float64)
+    maxs = numpy.asarray(maxs, dtype=numpy.float64)
+    children = clip_nodes['children'].astype(numpy.int64)
+    node_normals = normals[clip_nodes['plane_number']].astype(numpy.float64)
+    node_distances = distances[clip_nodes['plane_number']].astype(numpy.float64)
+
+    # Parent and side of every node below the head node
+    parents = numpy.full(len(clip_nodes), -1, dtype=numpy.int64)
+    parent_sides = numpy.zeros(len(clip_nodes), dtype=numpy.int64)
+    subtree = [numpy.array([head_node])]
+
+    while len(subtree[-1]):
+        frontier = subtree[-1]
+        child_nodes = children[frontier]
+        is_node = child_nodes >= 0
+        parents[child_nodes[is_node]] = numpy.repeat(frontier, 2).reshape(-1, 2)[is_node]
+        parent_sides[child_nodes[is_node]] = numpy.nonzero(is_node)[1]
+        subtree.append(child_nodes[is_node])
+
+    subtree = numpy.concatenate(subtree)
+    box_normals = numpy.vstack((numpy.eye(3), -numpy.eye(3)))
+    box_distances = numpy.concatenate((mins, -maxs))
+    polygons = []
+
+    for start in range(0, len(subtree), batch_size):
+        portal_nodes = subtree[start:start + batch_size]
+        count = len(portal_nodes)
+        vertices = _base_polygons(node_normals[portal_nodes], node_distances[portal_nodes], mins, maxs)
+        counts = numpy.full(count, 4)
+
+        # Clip portals to the box and then to their ancestors
+        for normal, distance in zip(box_normals, box_distances):
+            vertices, counts = clip_polygons(
+                vertices, counts, numpy.tile(normal, (count, 1)), numpy.full(count, distance), epsilon)
+
+        ancestors = portal_nodes.copy()
+
+        while True:
+            active = ancestors >= 0
+            sides = numpy.where(active, parent_sides[ancestors], 0)
+            ancestors = numpy.where(active, parents[ancestors], -1)
+            active = ancestors >= 0
+
+            if not active.any():
+                break
+
+            # Inactive portals are clipped by a plane behind everything
+            signs = numpy.where(sides == 0, 1.0, -1.0)
+            clip_normals = numpy.where(active[:, numpy.newaxis], node_normals[ancestors] * signs[:, numpy.newaxis], 0)
+            clip_distances = numpy.where(active, node_distances[ancestors] * signs, -1)
+            vertices, counts = clip_polygons(vertices, counts, clip_normals, clip_distances, epsilon)
+
+        vertices, counts, portal_nodes = _compact(vertices, counts, portal_nodes)
+
+        # Find the contents behind each part of each portal, then in front
+        portal_normals = node_normals[portal_nodes]
+        vertices, counts, sources, back_contents = _push(
+            vertices, counts, children[portal_nodes, 1], -portal_normals,
+            node_normals, node_distances, children, epsilon)
+        vertices, counts, fragment_sources, front_contents = _push(
+            vertices, counts, children[portal_nodes[sources], 0], portal_normals[sources],
+            node_normals, node_distances, children, epsilon)
+
+        back_solid = back_contents[fragment_sources] == CONTENTS_SOLID
+        front_solid = front_contents == CONTENTS_SOLID
+        surface = back_solid != front_solid
+
+        # Surfaces with solid in front face backwards
+        reverse = front_solid & surface
+        forward = ~front_solid & surface
+        polygons.append((vertices[forward], counts[forward], False))
+        polygons.append((vertices[reverse], counts[reverse], True))
+
+    return _weld(polygons, epsilon) if polygons else empty
+
+
+def _weld(polygons, epsilon):
+    """Flattens padded polygons into shared vertices and loops."""
+    loop_totals = numpy.concatenate([c for _, c, _ in polygons]).astype(numpy.int64)
+    loops = []
+
+    for vertices, counts, reverse in polygons:
+        slots = numpy.arange(vertices.shape[1])
+        valid = slots < counts[:, numpy.newaxis]
+
+        if reverse:
+            # Reverse each polygon's vertices in place
+            order = numpy.where(valid, counts[:, numpy.newaxis] - 1 - slots, slots)
+            vertices = numpy.take_along_axis(vertices, order[..., numpy.newaxis], axis=1)
+
+        loops.append(vertices[valid])
+
+    positions = numpy.concatenate(loops)
+    keys = numpy.round(positions / epsilon).astype(numpy.int64)
+    _, first, loop_vertices = numpy.unique(keys, axis=0, return_index=True, return_inverse=True)
+
+    return HullData(positions[first], loop_totals, loop_vertices.ravel())
@@ -3,46 +3,327 @@ if 'perfmon' in locals():
     il.reload(api)
     il.reload(nodes)
     il.reload(perfmon)
-    il.reload(utils)
+    il.reload(png)
+    il.reload(texture_atlas)
     # print('io_scene_bsp.import_bsp: reload ready.')
 
 else:
     from . import api
     from . import nodes
     from . import perfmon
-    from . import utils
+    from . import png
+    from . import texture_atlas
 
+import hashlib
 import os
 
-from math import radians
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import bpy
 import bmesh
 import numpy
 
-from mathutils import Matrix, Vector
-
 from .perfmon import PerformanceMonitor
-from .utils import datablock_lookup
 
 performance_monitor = None
 
 
-@datablock_lookup('images')
-def create_image(name, image_data):
+def image_digest(image_data):
+    """Returns a content hash of the given image data. Missing images all hash
+    the same."""
+    if image_data is None:
+        return hashlib.sha1(b'missing').hexdigest()
+
+    digest = hashlib.sha1(f'{image_data.width}x{image_data.height}'.encode())
+    digest.update(bytes(image_data.pixels))
+
+    return digest.hexdigest()
+
+
+def encode_image(image_data):
+    return png.encode(image_data.width, image_data.height, image_data.pixels)
+
+
+def get_texture_cache_directory(directory=''):
+    """Returns the directory used for the external texture cache, creating it
+    if needed.
+
+    Args:
+        directory: A user supplied directory. If empty, a directory in the
+            user's Blender datafiles is used.
+
+    Returns:
+        An absolute path
+    """
+    if not directory:
+        directory = os.path.join(bpy.utils.user_resource('DATAFILES'), 'io_scene_bsp', 'textures')
+
+    directory = os.path.abspath(bpy.path.abspath(directory))
+    os.makedirs(directory, exist_ok=True)
+
+    return directory
+
+
+def cache_images(image_datas, directory):
+    """Writes the given images to a content addressed cache as PNG files.
+    Images already in the cache are skipped, and encoding is done across a
+    thread pool.
+
+    Args:
+        image_datas: A sequence of image data objects. May contain None.
+
+        directory: The cache directory
+
+    Returns:
+        A sequence of file paths in the same order as image_datas
+    """
+    filepaths = [os.path.join(directory, f'{image_digest(i)}.png') if i else None for i in image_datas]
+
+    def write(args):
+        image_data, filepath = args
+
+        if not filepath or os.path.exists(filepath):
+            return
+
+        # Write to a temporary file first so a partial write never lands in
+        # the cache
+        temp_filepath = f'{filepath}.{os.getpid()}.tmp'
+        with open(temp_filepath, 'wb') as file:
+            file.write(encode_image(image_data))
+
+        os.replace(temp_filepath, filepath)
+
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(write, zip(image_datas, filepaths)))
+
+    return filepaths
+
+
+def pack_images(images):
+    """Packs the given images into the .blend file in one batched step. The
+    PNG encoding is done across a thread pool.
+
+    Args:
+        images: A sequence of (image, image data) pairs
+    """
+    images = [(i, d) for i, d in images if d is not None and not i.packed_file]
+
+    with ThreadPoolExecutor() as executor:
+        encoded_images = executor.map(encode_image, [d for _, d in images])
+
+        for (image, _), data in zip(images, encoded_images):
+            image.pack(data=data, data_len=len(data))
+            image.source = 'FILE'
+            image.filepath_raw = f'//{bpy.path.clean_name(image.name)}.png'
+
+
+def create_image(name, image_data, filepath=None):
     if image_data is None:
         image = bpy.data.images.new(f'{name}(Missing)', 0, 0)
 
+    elif filepath:
+        image = bpy.data.images.load(filepath, check_existing=True)
+
+        # Identical textures share one image, so only name it when first loaded
+        if image.name == os.path.basename(filepath):
+            image.name = name
+
     else:
         image = bpy.data.images.new(name, image_data.width, image_data.height)
-        image.pixels[:] = [p / 255 for p in image_data.pixels]
-        image.pack()
+        image.pixels.foreach_set(numpy.asarray(image_data.pixels, dtype=numpy.float32) / 255)
+
+    return image
+
+
+def reload_image(image, mip_level=0):
+    """Swaps the pixels of an image created by a reduced resolution import
+    with another mip level, in place. Materials using the image are left
+    untouched.
+
+    Args:
+        image: An image with 'bsp_filepath' and 'bsp_miptexture' properties
+
+        mip_level: The mip level to load
+
+    Returns:
+        True if the image was reloaded
+    """
+    filepath = image.get('bsp_filepath')
+
+    if not filepath or not api.is_bspfile(filepath):
+        return False
+
+    with api.Bsp(filepath) as bsp:
+        names = [bsp.miptexture_name(i) for i in range(len(bsp.miptextures))]
+
+        try:
+            if image.get('bsp_frames'):
+                image_data = bsp.image_strip([names.index(n) for n in image['bsp_frames']], mip_level)
+
+            else:
+                image_data = bsp.image(names.index(image.get('bsp_miptexture', image.name)), mip_level)
+
+        except ValueError:
+            return False
+
+    if image_data is None:
+        return False
+
+    image.scale(image_data.width, image_data.height)
+    image.pixels.foreach_set(numpy.asarray(image_data.pixels, dtype=numpy.float32) / 255)
+
+    # Externally stored images become packed so the shared cache file is
+    # left as is
+    if image.packed_file or image.source == 'FILE':
+        data = encode_image(image_data)
+        image.pack(data=data, data_len=len(data))
+        image.source = 'FILE'
+        image.filepath_raw = f'//{bpy.path.clean_name(image.name)}.png'
+
+    image['bsp_mip_level'] = mip_level
+    image['bsp_hash'] = image_digest(image_data)
+
+    return True
+
+
+def create_lightmap_image(name, atlas_size, lightmaps, offsets, storage='BYTE'):
+    """Composites lightmaps into a new atlas image.
+
+    'BYTE' images keep the luxels as bytes in a non-color image. 'FLOAT'
+    images hold the same values, luxels divided by 255, in a float buffer.
+
+    Args:
+        name: The image name
+
+        atlas_size: The width and height of the atlas
+
+        lightmaps: A sequence of LightMapImage with uint8 RGBA pixels
+
+        offsets: The atlas position of each lightmap, or None to skip it
+
+        storage: 'BYTE' or 'FLOAT'
+
+    Returns:
+        The new image
+    """
+    w, h = atlas_size
+    is_float = storage != 'BYTE'
+    dtype = numpy.float32 if is_float else numpy.uint8
+    one = 1 if is_float else 255
+
+    pixels = numpy.zeros((h, w, 4), dtype=dtype)
+    pixels[..., 3] = one
+
+    for (size, luxels), offset in zip(lightmaps, offsets):
+        if not offset:
+            continue
+
+        x, y = offset
+        luxels = luxels.reshape(size[1], size[0], 4)
+
+        if is_float:
+            luxels = luxels.astype(dtype) / dtype(255)
+
+        pixels[y:y + size[1], x:x + size[0]] = luxels
+
+    image = bpy.data.images.new(name, w, h, float_buffer=is_float)
+
+    if not is_float:
+        image.colorspace_settings.name = 'Non-Color'
+
+    image.pixels.foreach_set(pixels.ravel().astype(numpy.float32) / numpy.float32(one))
 
     return image
 
 
-@datablock_lookup('materials')
-def create_material(name, image, use_principled_shader=True):
+def add_lightmap_colors(mesh, colors):
+    """Adds a 'LightMap' byte color attribute with a color per loop. The
+    luxel bytes are stored as is.
+
+    Args:
+        mesh: The mesh to add the attribute to
+
+        colors: An (N, 4) uint8 array with an RGBA color for each loop
+    """
+    values = colors.astype(numpy.float32).ravel() / 255
+
+    # Color attributes replaced vertex colors in 3.2
+    if bpy.app.version < (3, 2, 0):
+        layer = mesh.vertex_colors.new(name='LightMap')
+        layer.data.foreach_set('color', values)
+        return
+
+    attribute = mesh.color_attributes.new('LightMap', 'BYTE_COLOR', 'CORNER')
+    attribute.data.foreach_set('color_srgb' if bpy.app.version >= (3, 4, 0) else 'color', values)
+    mesh.color_attributes.active_color = attribute
+
+
+def add_texture_animation(material, texture_node, frame_count, frame_rate=10):
+    """Plays an image strip of animation frames on an image texture node.
+    The frame is driven by the scene frame, advancing at frame_rate frames
+    per second like Quake's animated textures.
+
+    Only math operations available since Blender 2.80 are used, so floor(x)
+    is built as round(x - 0.5).
+
+    Args:
+        material: The material to add the nodes to
+
+        texture_node: An image texture node showing a horizontal strip of
+            frames
+
+        frame_count: The number of frames in the strip
+
+        frame_rate: Animation frames per second
+    """
+    tree = material.node_tree
+    x, y = texture_node.location
+
+    def math_node(operation, a, b=0.0):
+        node = tree.nodes.new('ShaderNodeMath')
+        node.operation = operation
+        node.hide = True
+
+        for socket, value in zip(node.inputs, (a, b)):
+            if isinstance(value, bpy.types.NodeSocket):
+                tree.links.new(value, socket)
+                node.location = value.node.location.x + 160, value.node.location.y
+
+            else:
+                socket.default_value = value
+
+        return node.outputs[0]
+
+    # Current animation frame, driven by the scene frame
+    render = bpy.context.scene.render
+    frame_node = tree.nodes.new('ShaderNodeValue')
+    frame_node.name = frame_node.label = 'Frame'
+    frame_node.location = x - 1000, y - 300
+    frame_node.outputs[0].driver_add('default_value').driver.expression = 'frame'
+
+    time = math_node('MULTIPLY', frame_node.outputs[0], frame_rate * render.fps_base / render.fps)
+    frame = math_node('MODULO', math_node('ROUND', math_node('SUBTRACT', time, 0.5)), frame_count)
+
+    # Wrap U into [0, 1) and move it into the current frame's slot
+    uv_node = tree.nodes.new('ShaderNodeTexCoord')
+    uv_node.location = x - 1000, y
+
+    separate_node = tree.nodes.new('ShaderNodeSeparateXYZ')
+    separate_node.location = x - 800, y
+    tree.links.new(uv_node.outputs['UV'], separate_node.inputs[0])
+
+    u = separate_node.outputs[0]
+    u = math_node('SUBTRACT', u, math_node('ROUND', math_node('SUBTRACT', u, 0.5)))
+    u = math_node('DIVIDE', math_node('ADD', u, frame), frame_count)
+
+    combine_node = tree.nodes.new('ShaderNodeCombineXYZ')
+    combine_node.location = x - 200, y
+    tree.links.new(u, combine_node.inputs[0])
+    tree.links.new(separate_node.outputs[1], combine_node.inputs[1])
+    tree.links.new(combine_node.outputs[0], texture_node.inputs['Vector'])
+
+
+def create_material(name, image, use_principled_shader=True, frame_count=1):
     # Create new material
     material = bpy.data.materials.new(name)
     material.diffuse_color = 1, 1, 1, 1
@@ -60,6 +341,9 @@ def create_material(name, image, use_principled_shader=True):
     texture_node.interpolation = 'Closest'
     texture_node.location = 0, 0
 
+    if frame_count > 1:
+        add_texture_animation(material, texture_node, frame_count)
+
     # Create a bsdf node
     if use_principled_shader:
         bsdf_node = material.node_tree.nodes.new('ShaderNodeBsdfPrincipled')
@@ -87,16 +371,559 @@ def create_material(name, image, use_principled_shader=True):
     return material
 
 
-def load(operator,
-         context,
-         filepath='',
-         global_scale=1.0,
-         use_worldspawn_entity=True,
-         use_brush_entities=True,
-         use_point_entities=True,
-         load_lightmap=False,
-         use_principled_shader=True):
+def remove_objects(objects):
+    """Removes the given objects along with any mesh data left unused.
+
+    Args:
+        objects: A sequence of objects
+    """
+    for ob in list(objects):
+        data = ob.data
+        bpy.data.objects.remove(ob)
+
+        if isinstance(data, bpy.types.Mesh) and not data.users:
+            bpy.data.meshes.remove(data)
+
+
+def remove_unused_materials(keep=()):
+    """Removes imported materials that are no longer used, along with their
+    images if nothing else uses them.
+
+    Args:
+        keep: Materials and images to keep even if they are unused
+    """
+    keep = set(keep)
+    unused_images = set()
+
+    for material in list(bpy.data.materials):
+        if not material.get('bsp_hash') or material.users or material in keep:
+            continue
+
+        texture_node = material.node_tree.nodes.get('Miptexture') if material.node_tree else None
+
+        if texture_node and texture_node.image:
+            unused_images.add(texture_node.image)
+
+        bpy.data.materials.remove(material)
+
+    for image in unused_images:
+        if not image.users and image not in keep:
+            bpy.data.images.remove(image)
+
+
+def remove_collection(collection):
+    """Removes the given collection along with all of its child collections,
+    objects and mesh data.
+
+    Args:
+        collection: The collection to remove
+    """
+    for child in collection.children[:]:
+        remove_collection(child)
+
+    remove_objects(collection.objects)
+    bpy.data.collections.remove(collection)
+
+
+def remove_datablocks(datablocks, unused_only=False):
+    """Removes datablocks, skipping any that were already removed.
+
+    Args:
+        datablocks: A sequence of (bpy.data collection, datablock) pairs,
+            removed in order
+
+        unused_only: If True, datablocks that still have users are kept
+    """
+    for collection, datablock in datablocks:
+        try:
+            if unused_only and datablock.users:
+                continue
+
+        except ReferenceError:
+            continue
+
+        collection.remove(datablock)
+
+
+def get_child_collection(parent_collection, name):
+    """Gets the child collection created for the given name, creating it if
+    it doesn't exist yet.
+
+    Args:
+        parent_collection: The collection to look in
+
+        name: The name the child collection was created with
+
+    Returns:
+        A collection
+    """
+    for child in parent_collection.children:
+        if child.get('bsp_name') == name:
+            return child
+
+    child = bpy.data.collections.new(name)
+    child['bsp_name'] = name
+    parent_collection.children.link(child)
+
+    return child
+
+
+def find_previous_import(filepath):
+    """Finds the root collection of a previous import of the given file.
+
+    Args:
+        filepath: The path of the BSP file
+
+    Returns:
+        A collection or None
+    """
+    filepath = os.path.abspath(filepath)
+
+    for collection in bpy.data.collections:
+        if collection.get('bsp_filepath') == filepath:
+            return collection
+
+    return None
+
+
+def hash_index(datablocks):
+    """Indexes datablocks by their 'bsp_hash' property.
+
+    Args:
+        datablocks: A bpy.data collection such as bpy.data.images
+
+    Returns:
+        A dict of hashes to datablocks
+    """
+    return {d['bsp_hash']: d for d in datablocks if d.get('bsp_hash') and not d.library}
+
+
+def outdated_datablock(datablocks, name, digest):
+    """Gets the named datablock if it was imported from different data. The
+    outdated datablock is renamed to free up its name for a replacement.
+
+    Args:
+        datablocks: A bpy.data collection such as bpy.data.images
+
+        name: The name of the datablock
+
+        digest: The hash of the data to import
+
+    Returns:
+        The outdated datablock or None
+    """
+    datablock = datablocks.get(name)
+
+    if datablock is None or datablock.get('bsp_hash') == digest:
+        return None
+
+    datablock.name = f'{name}(Outdated)'
+
+    return datablock
+
+
+def replace_datablock(datablocks, old, new):
+    """Replaces all uses of a datablock with another, removes it and gives
+    its name to the replacement.
+
+    Args:
+        datablocks: The bpy.data collection both datablocks belong to
+
+        old: The datablock to replace
 
+        new: The replacement datablock
+    """
+    name = old.name.replace('(Outdated)', '')
+    old.user_remap(new)
+    datablocks.remove(old)
+    new.name = name
+
+
+def model_mesh_data(bsp,
+                    model,
+                    exclude_texture_classes=(),
+                    chunking='NONE',
+                    chunk_size=1024.0,
+                    chunk_depth=3,
+                    merge_coplanar=False,
+                    visible_faces=None):
+    """Returns the mesh data of the given model's faces, optionally split
+    into spatial chunks. Excluded faces are dropped before any geometry is
+    computed.
+
+    Args:
+        bsp: An api.Bsp object
+
+        model: An api.Model object
+
+        exclude_texture_classes: A sequence of api.texture_classes keys
+
+        chunking: 'NONE', 'GRID' to split by a world space grid or 'NODES'
+            to split by BSP node subtrees
+
+        chunk_size: The grid cell size used by 'GRID' chunking
+
+        chunk_depth: The BSP tree depth used by 'NODES' chunking
+
+        merge_coplanar: If True, adjacent coplanar faces are merged into
+            larger polygons
+
+        visible_faces: An array of face indices to keep, or None to keep
+            every face
+
+    Returns:
+        A list of (chunk name, api.MeshData) pairs. The chunk name is empty
+        when not chunking.
+    """
+    face_indices = bsp.filter_faces(model.face_indices, exclude_texture_classes)
+
+    if visible_faces is not None:
+        face_indices = face_indices[numpy.isin(face_indices, visible_faces)]
+
+    if chunking == 'GRID':
+        chunks = bsp.chunk_faces_by_grid(face_indices, chunk_size)
+
+    elif chunking == 'NODES':
+        chunks = bsp.chunk_faces_by_node(face_indices, model.head_node, chunk_depth)
+
+    else:
+        chunks = {'': face_indices}
+
+    return [(name, bsp.mesh_data(indices, merge_coplanar)) for name, indices in chunks.items()]
+
+
+def add_polygons(mesh, vertices, loop_totals, loop_vertices):
+    """Writes vertices, loops and polygons to an empty mesh in bulk with
+    foreach_set.
+
+    Args:
+        mesh: An empty mesh
+
+        vertices: An (N, 3) array of vertex positions
+
+        loop_totals: The number of loops of each polygon
+
+        loop_vertices: The vertex index of each loop
+    """
+    loop_starts = numpy.cumsum(loop_totals) - loop_totals
+
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set('co', vertices.astype(numpy.float32).ravel())
+
+    mesh.loops.add(len(loop_vertices))
+    mesh.loops.foreach_set('vertex_index', loop_vertices.astype(numpy.int32))
+
+    mesh.polygons.add(len(loop_totals))
+    mesh.polygons.foreach_set('loop_start', loop_starts.astype(numpy.int32))
+
+    # Newer versions of Blender derive loop totals from the loop starts
+    if not bpy.types.MeshPolygon.bl_rna.properties['loop_total'].is_readonly:
+        mesh.polygons.foreach_set('loop_total', loop_totals.astype(numpy.int32))
+
+
+def create_hull_mesh(name, hull_data, global_scale=1.0):
+    """Creates a mesh from the given collision hull data.
+
+    Args:
+        name: The name of the mesh
+
+        hull_data: A hulls.HullData object
+
+        global_scale: Scale applied to the vertex positions
+
+    Returns:
+        A mesh
+    """
+    mesh = bpy.data.meshes.new(name)
+    add_polygons(mesh, hull_data.vertices * global_scale, hull_data.loop_totals, hull_data.loop_vertices)
+    mesh.update(calc_edges=True)
+    mesh.validate()
+
+    return mesh
+
+
+def mesh_data_key(bsp, mesh_data):
+    """Hashes mesh data relative to its minimum corner, so copies of a brush
+    model placed elsewhere hash the same. Texture coordinates are compared
+    up to whole texture repeats per polygon.
+
+    Args:
+        bsp: The api.Bsp object the mesh data came from
+
+        mesh_data: An api.MeshData object
+
+    Returns:
+        A two-tuple of the hex digest and the minimum corner
+    """
+    offset = mesh_data.vertices.min(axis=0)
+
+    # Adding zero turns negative zeros positive
+    digest = hashlib.sha1()
+    digest.update(numpy.round(mesh_data.vertices - offset, 3).astype(numpy.float32) + 0.0)
+    digest.update(mesh_data.loop_totals.astype(numpy.int32))
+    digest.update(mesh_data.loop_vertices.astype(numpy.int32))
+    loop_starts = numpy.cumsum(mesh_data.loop_totals) - mesh_data.loop_totals
+    tiles = numpy.repeat(numpy.floor(mesh_data.uvs[loop_starts]), mesh_data.loop_totals, axis=0)
+    digest.update(numpy.round(mesh_data.uvs - tiles, 4).astype(numpy.float32) + 0.0)
+    digest.update('\0'.join(bsp.miptexture_name(i) for i in mesh_data.texture_numbers).encode())
+
+    return digest.hexdigest(), offset
+
+
+def model_hull_data(bsp, model_index, hull_numbers):
+    """Returns a list of (hull number, hulls.HullData) pairs for a model."""
+    return [(hull, bsp.hull_data(model_index, hull)) for hull in hull_numbers]
+
+
+def create_mesh(name,
+                bsp,
+                mesh_data,
+                global_scale=1.0,
+                material_names=None,
+                atlas=None,
+                atlas_material_names=()):
+    """Creates a mesh from the given mesh data. All attributes are written in
+    bulk with foreach_set.
+
+    Args:
+        name: The name of the mesh
+
+        bsp: The api.Bsp object the mesh data came from
+
+        mesh_data: An api.MeshData object
+
+        global_scale: Scale applied to the vertex positions
+
+        material_names: A dict of miptexture names to the names of the
+            materials that show them. Defaults to the miptexture name.
+
+        atlas: A texture_atlas.Atlas object. Polygons that fit in the atlas
+            are remapped to it.
+
+        atlas_material_names: The material name of each atlas page
+
+    Returns:
+        A mesh
+    """
+    mesh = bpy.data.meshes.new(name)
+    loop_totals = mesh_data.loop_totals
+    add_polygons(mesh, mesh_data.vertices * global_scale, loop_totals, mesh_data.loop_vertices)
+
+    material_names = material_names or {}
+    miptexture_names = [bsp.miptexture_name(i) for i in mesh_data.texture_numbers]
+    texture_names = [material_names.get(n, n) for n in miptexture_names]
+    uvs = mesh_data.uvs
+
+    if atlas:
+        # Atlas placements are keyed by miptexture name, not material name
+        uvs, pages = texture_atlas.remap_uvs(atlas, miptexture_names, uvs, loop_totals)
+        texture_names = [atlas_material_names[p] if p >= 0 else n for n, p in zip(texture_names, pages.tolist())]
+
+    uv_layer = mesh.uv_layers.new()
+    uv_layer.data.foreach_set('uv', uvs.astype(numpy.float32).ravel())
+
+    # Assign material slots in order of first use
+    material_indices = {}
+
+    for texture_name in texture_names:
+        if texture_name not in material_indices:
+            material_indices[texture_name] = len(material_indices)
+            mesh.materials.append(bpy.data.materials.get(texture_name))
+
+    mesh.polygons.foreach_set(
+        'material_index',
+        numpy.array([material_indices[n] for n in texture_names], dtype=numpy.int32)
+    )
+
+    mesh.update(calc_edges=True)
+    mesh.validate(clean_customdata=False)
+
+    return mesh
+
+
+def entity_rotations(angles):
+    """Converts entity pitch, yaw and roll angles in degrees to Euler
+    rotations. Positive pitch raises the front of the entity, as the engine
+    draws models."""
+    pitch, yaw, roll = numpy.radians(angles).T
+
+    return numpy.column_stack((roll, -pitch, yaw)).astype(numpy.float32)
+
+
+def create_entity_empties(collection, groups, global_scale=1.0):
+    """Creates one empty per point entity and links them to the given
+    collection. Locations, rotations and display sizes are written for the
+    whole collection at once when it holds nothing but the new objects.
+
+    Args:
+        collection: The collection to link the empties to
+
+        groups: A sequence of api.PointEntities objects
+
+        global_scale: Scale applied to entity origins
+
+    Returns:
+        A list of objects
+    """
+    objects = []
+
+    # Unique names avoid Blender's search for a free name on every object
+    for points in groups:
+        objects += [bpy.data.objects.new(f'{points.classname}.{i:03d}', None) for i in range(len(points.entities))]
+
+    for ob in objects:
+        collection.objects.link(ob)
+        ob.empty_display_type = 'CUBE'
+        ob.select_set(True)
+
+    if not objects:
+        return objects
+
+    locations = (numpy.concatenate([p.origins for p in groups]) * global_scale).astype(numpy.float32)
+    rotations = entity_rotations(numpy.concatenate([p.angles for p in groups]))
+    sizes = numpy.full(len(objects), 16 * global_scale, dtype=numpy.float32)
+
+    if len(collection.objects) == len(objects):
+        collection.objects.foreach_set('location', locations.ravel())
+        collection.objects.foreach_set('rotation_euler', rotations.ravel())
+        collection.objects.foreach_set('empty_display_size', sizes)
+
+    else:
+        for ob, location, rotation, size in zip(objects, locations, rotations, sizes):
+            ob.location = location
+            ob.rotation_euler = rotation
+            ob.empty_display_size = size
+
+    return objects
+
+
+def create_entity_points(points, global_scale=1.0, use_instances=False):
+    """Creates a single object for all point entities of a classname, with a
+    mesh vertex per entity. The Euler rotation and index of each entity are
+    stored as the 'rotation' and 'entity_index' point attributes.
+
+    Args:
+        points: An api.PointEntities object
+
+        global_scale: Scale applied to entity origins
+
+        use_instances: Instance a cube on every point with a geometry nodes
+            modifier. Requires Blender 3.2 or newer.
+
+    Returns:
+        An object
+    """
+    mesh = bpy.data.meshes.new(points.classname)
+    mesh.vertices.add(len(points.entities))
+    mesh.vertices.foreach_set('co', (points.origins * global_scale).astype(numpy.float32).ravel())
+
+    if hasattr(mesh, 'attributes'):
+        rotations = mesh.attributes.new('rotation', 'FLOAT_VECTOR', 'POINT')
+        rotations.data.foreach_set('vector', entity_rotations(points.angles).ravel())
+
+        indices = mesh.attributes.new('entity_index', 'INT', 'POINT')
+        indices.data.foreach_set('value', numpy.arange(len(points.entities), dtype=numpy.int32))
+
+    mesh.update()
+
+    ob = bpy.data.objects.new(points.classname, mesh)
+    ob['bsp_classname'] = points.classname
+
+    if use_instances:
+        modifier = ob.modifiers.new('Entity Instances', 'NODES')
+        group = nodes.entity_instances()
+        modifier.node_group = group
+        modifier[nodes.socket_identifier(group, 'Size')] = 16 * global_scale
+
+    return ob
+
+
+def visibility_points(entities, visible_from):
+    """Finds the points named by a visible_from import option.
+
+    Args:
+        entities: An entities.Entities object
+
+        visible_from: A point as 'x y z' in map units, or the classname or
+            targetname of point entities
+
+    Returns:
+        An (N, 3) array of points, empty if nothing matched
+    """
+    try:
+        return numpy.array([tuple(map(float, visible_from.split()))], dtype=numpy.float64).reshape(-1, 3)
+
+    except ValueError:
+        pass
+
+    matches = entities.by_classname.get(visible_from, []) + entities.by_targetname.get(visible_from, [])
+
+    return numpy.array([e.origin for e in matches if hasattr(e, 'origin')], dtype=numpy.float64).reshape(-1, 3)
+
+
+def load(operator, context, **keywords):
+    """Imports the given BSP file in a single blocking call.
+
+    Returns:
+        {'FINISHED'} or {'CANCELLED'}
+    """
+    steps = load_steps(operator, context, **keywords)
+
+    while True:
+        try:
+            next(steps)
+
+        except StopIteration as result:
+            return result.value
+
+
+def load_steps(operator,
+               context,
+               filepath='',
+               global_scale=1.0,
+               use_worldspawn_entity=True,
+               use_brush_entities=True,
+               use_point_entities=True,
+               load_lightmap=False,
+               lightmap_mode='ATLAS',
+               lightmap_storage='BYTE',
+               use_principled_shader=True,
+               texture_storage='PACK',
+               texture_cache_directory='',
+               mip_level=0,
+               max_texture_size=0,
+               group_animated_textures=True,
+               use_texture_atlas=False,
+               atlas_page_size='2048',
+               update_existing=False,
+               exclude_texture_classes=(),
+               exclude_entities='',
+               point_entity_mode='EMPTIES',
+               visible_from='',
+               collision_hulls=(),
+               share_duplicate_meshes=False,
+               worldspawn_chunking='NONE',
+               chunk_size=1024.0,
+               chunk_depth=3,
+               merge_coplanar_faces=False):
+    """Imports the given BSP file in small steps so the caller can keep the
+    UI responsive. Closing the generator cancels the import and removes
+    everything it created. The other keyword arguments match the ImportBSP
+    operator properties.
+
+    Args:
+        operator: The operator to report warnings and errors to
+
+        context: The Blender context
+
+        filepath: Path to the BSP file
+
+    Yields:
+        The import progress as a float in the range [0, 1]
+
+    Returns:
+        {'FINISHED'} or {'CANCELLED'}
+    """
     if not api.is_bspfile(filepath):
         operator.report(
             {'ERROR'},
@@ -111,228 +938,638 @@ def load(operator,
     performance_monitor.push_scope()
     performance_monitor.step('Loading bsp file...')
 
-    bsp = api.Bsp(filepath)
+    executor = ThreadPoolExecutor(max_workers=1)
+    bsp_future = executor.submit(api.Bsp, filepath)
 
     map_name = os.path.basename(filepath)
 
-    root_collection = bpy.data.collections.new(map_name)
-    bpy.context.scene.collection.children.link(root_collection)
+    root_collection = find_previous_import(filepath) if update_existing else None
+    is_update = root_collection is not None
 
-    if use_worldspawn_entity or use_brush_entities:
-        brush_collection = bpy.data.collections.new('brush entities')
-        root_collection.children.link(brush_collection)
+    if not is_update:
+        root_collection = bpy.data.collections.new(map_name)
+        root_collection['bsp_filepath'] = os.path.abspath(filepath)
+        bpy.context.scene.collection.children.link(root_collection)
 
-    if use_point_entities:
-        entity_collection = bpy.data.collections.new('point entities')
-        root_collection.children.link(entity_collection)
+    # Datablocks made rather than reused by this import, as
+    # (bpy.data collection, datablock) pairs
+    created_datablocks = []
 
-    subcollections = {}
+    def record_node_groups(names_before):
+        """Records the node groups added since names_before was taken."""
+        created_datablocks.extend(
+            (bpy.data.node_groups, g) for g in bpy.data.node_groups if g.name not in names_before
+        )
 
-    def get_subcollection(parent_collection, name):
-        """Helper method for creating collections based on name.
+    try:
+        if use_worldspawn_entity or use_brush_entities:
+            brush_collection = get_child_collection(root_collection, 'brush entities')
 
-        Args:
-            parent_collection: The collection to parent the new collection to.
+        if use_point_entities:
+            entity_collection = get_child_collection(root_collection, 'point entities')
 
-            name: The entity name to use to determine the new collection name.
+        subcollections = {}
 
-        Returns:
-            A collection
-        """
-        prefix = name.split('_')[0]
+        def get_subcollection(parent_collection, name):
+            """Helper method for creating collections based on name.
 
-        try:
-            return subcollections[parent_collection.name][prefix]
+            Args:
+                parent_collection: The collection to parent the new collection to.
+
+                name: The entity name to use to determine the new collection name.
 
-        except KeyError:
-            subcollection = bpy.data.collections.new(prefix)
-            parent_collection.children.link(subcollection)
+            Returns:
+                A collection
+            """
+            prefix = name.split('_')[0]
 
-            if parent_collection.name not in subcollections:
-                subcollections[parent_collection.name] = {}
+            try:
+                return subcollections[parent_collection.name][prefix]
 
-            subcollections[parent_collection.name][prefix] = subcollection
+            except KeyError:
+                subcollection = get_child_collection(parent_collection, prefix)
 
-            return subcollection
+                if parent_collection.name not in subcollections:
+                    subcollections[parent_collection.name] = {}
 
-    if use_worldspawn_entity or use_brush_entities:
-        performance_monitor.step('Creating images...')
+                subcollections[parent_collection.name][prefix] = subcollection
 
-        # Create images
-        for i, image in enumerate(bsp.images):
-            miptex = bsp.miptextures[i]
+                return subcollection
 
-            if miptex:
-                create_image(miptex.name, image)
+        while wait((bsp_future,), timeout=0.01).not_done:
+            yield 0
 
-        performance_monitor.step('Creating materials...')
+        bsp = bsp_future.result()
+
+        exclude_texture_classes = tuple(exclude_texture_classes)
+        hull_numbers = sorted(int(h[-1]) for h in collision_hulls)
 
-        # Create materials
-        for i, image in enumerate(bsp.images):
-            miptex = bsp.miptextures[i]
+        if merge_coplanar_faces and load_lightmap:
+            operator.report({'WARNING'}, 'Lightmaps are not loaded when merging coplanar faces')
+            load_lightmap = False
 
-            if miptex:
-                create_material(
-                    miptex.name,
-                    bpy.data.images[miptex.name],
-                    use_principled_shader=use_principled_shader
+        if share_duplicate_meshes and load_lightmap:
+            operator.report({'WARNING'}, 'Meshes are not shared when loading lightmaps')
+            share_duplicate_meshes = False
+
+        exclude_entities = [p.strip() for p in exclude_entities.split(',') if p.strip()]
+
+        if point_entity_mode == 'INSTANCES' and bpy.app.version < (3, 2, 0):
+            operator.report({'WARNING'}, 'Entity instances require Blender 3.2 or newer, creating point clouds instead')
+            point_entity_mode = 'POINTS'
+
+        use_models = use_worldspawn_entity or use_brush_entities
+        miptextures = bsp.miptextures if use_models else []
+        models = list(bsp.models)
+        entities = bsp.entities
+
+        # Progress is measured in units of work: one per texture, material,
+        # entity and model, plus one per model for lightmaps and one for
+        # packing images.
+        total_steps = 2 * len(miptextures) + len(entities) + len(models) * (2 if load_lightmap else 1) + 1
+        completed_steps = 0
+
+        def progress(steps=1):
+            nonlocal completed_steps
+            completed_steps += steps
+
+            return min(completed_steps / total_steps, 1.0)
+
+        created_images = {}
+        image_datas = {}
+        missing_images = set()
+        material_names = {}
+        texture_digests = {}
+        created_materials = {}
+        atlas = None
+        atlas_material_names = []
+        atlas_digest = ''
+
+        if use_models:
+            performance_monitor.step('Creating images...')
+
+            names = [bsp.miptexture_name(i) for i in range(len(miptextures))]
+            mip_levels = [
+                api.select_mip_level(m.width, m.height, mip_level, max_texture_size) if m else 0
+                for m in miptextures
+            ]
+
+            # One (name, image data, mip level, frame names) entry per image
+            texture_entries = []
+
+            if group_animated_textures:
+                for group_name, frame_names in api.animation_groups(names).items():
+                    frame_numbers = [names.index(n) for n in frame_names]
+                    level = max(mip_levels[i] for i in frame_numbers)
+                    strip = bsp.image_strip(frame_numbers, level)
+
+                    if strip is not None:
+                        texture_entries.append((group_name, strip, level, frame_names))
+                        material_names.update(dict.fromkeys(frame_names, group_name))
+
+            texture_entries += [
+                (m.name, bsp.image(i, mip_levels[i]), mip_levels[i], ())
+                for i, m in enumerate(miptextures) if m and m.name not in material_names
+            ]
+
+            images = [e[1] for e in texture_entries]
+            filepaths = [None] * len(images)
+
+            if texture_storage == 'EXTERNAL':
+                cache_directory = get_texture_cache_directory(texture_cache_directory)
+                filepaths = cache_images(images, cache_directory)
+
+            # Images and materials are shared by content across imports
+            image_digests = {}
+            material_digests = {}
+            images_by_hash = hash_index(bpy.data.images)
+            materials_by_hash = hash_index(bpy.data.materials)
+
+            def add_image(name, image, image_filepath):
+                """Creates an image, or reuses one with the same content.
+
+                Returns:
+                    The image if it was created, otherwise None
+                """
+                # Missing textures keep their own images
+                digest = image_digest(image) if image else hashlib.sha1(f'missing:{name}'.encode()).hexdigest()
+                image_digests[name] = digest
+                new_image = images_by_hash.get(digest)
+                is_new = new_image is None
+
+                if is_new:
+                    new_image = create_image(name, image, image_filepath)
+                    new_image['bsp_hash'] = digest
+                    images_by_hash[digest] = new_image
+                    created_datablocks.append((bpy.data.images, new_image))
+
+                created_images[name] = new_image
+                image_datas[name] = image
+
+                return new_image if is_new else None
+
+            def add_material(name, frame_count=1):
+                """Creates a material for an image made by add_image, or
+                reuses one with the same image and settings."""
+                digest = hashlib.sha1(
+                    f'{image_digests[name]}:{use_principled_shader}:{frame_count}'.encode()).hexdigest()
+                material = materials_by_hash.get(digest)
+
+                if material is None:
+                    node_group_names = set(bpy.data.node_groups.keys())
+                    material = create_material(
+                        name,
+                        created_images[name],
+                        use_principled_shader=use_principled_shader,
+                        frame_count=frame_count
+                    )
+                    material['bsp_hash'] = digest
+                    materials_by_hash[digest] = material
+                    created_datablocks.append((bpy.data.materials, material))
+                    record_node_groups(node_group_names)
+
+                material_digests[name] = digest
+                created_materials[name] = material
+
+            # Create images
+            for (name, image, level, frame_names), image_filepath in zip(texture_entries, filepaths):
+                new_image = add_image(name, image, image_filepath)
+
+                if new_image:
+                    new_image['bsp_filepath'] = os.path.abspath(filepath)
+                    new_image['bsp_miptexture'] = name
+                    new_image['bsp_mip_level'] = level
+
+                    if frame_names:
+                        new_image['bsp_frames'] = list(frame_names)
+
+                yield progress()
+
+            performance_monitor.step('Creating materials...')
+
+            # Create materials
+            for name, _, _, frame_names in texture_entries:
+                add_material(name, max(len(frame_names), 1))
+
+                yield progress()
+
+            if use_texture_atlas:
+                performance_monitor.step('Creating texture atlas...')
+
+                # Animated, sky, liquid and fence textures keep their own
+                # materials
+                atlas = texture_atlas.build(
+                    {
+                        name: image for name, image, _, frame_names in texture_entries
+                        if not frame_names and api.texture_class(name) not in ('SKY', 'LIQUID', 'FENCE')
+                    },
+                    int(atlas_page_size)
                 )
+                atlas_material_names = [f'{map_name}.atlas{i}' for i in range(len(atlas.pages))]
+                atlas_filepaths = [None] * len(atlas.pages)
+
+                if texture_storage == 'EXTERNAL':
+                    atlas_filepaths = cache_images(atlas.pages, cache_directory)
+
+                for name, page, page_filepath in zip(atlas_material_names, atlas.pages, atlas_filepaths):
+                    add_image(name, page, page_filepath)
+                    add_material(name)
+
+                atlas_digest = hashlib.sha1(repr(sorted(atlas.placements.items())).encode())
+                atlas_digest.update(''.join(image_digests[n] for n in atlas_material_names).encode())
+                atlas_digest = atlas_digest.hexdigest()
+                atlas_material_names = [created_materials[n].name for n in atlas_material_names]
+
+            # Reused materials may be named after another map's textures
+            texture_digests = {n: material_digests.get(material_names.get(n, n), '') for n in names}
+            material_names = {
+                n: created_materials[material_names.get(n, n)].name
+                for n in names if material_names.get(n, n) in created_materials
+            }
+
+            if texture_storage == 'PACK':
+                performance_monitor.step('Packing images...')
+                pack_images((created_images[n], d) for n, d in image_datas.items())
+
+            # Decoded textures aren't needed once the images are made, only
+            # the atlas page sizes are
+            missing_images = {n for n, d in image_datas.items() if d is None}
+            image_datas.clear()
+            del texture_entries, images
+
+            if atlas:
+                atlas = atlas._replace(pages=[p._replace(pixels=None) for p in atlas.pages])
+
+        # Create point entities
+        if use_point_entities:
+            performance_monitor.step('Creating point entities...')
+
+            # Point entities are cheap, so an update recreates all of them
+            if is_update:
+                remove_objects(entity_collection.all_objects)
+
+            # Batch the classnames that share a collection
+            batches = {}
+
+            for points in api.point_entities(entities, exclude_entities).values():
+                entity_subcollection = get_subcollection(entity_collection, points.classname)
+                batches.setdefault(entity_subcollection.name, (entity_subcollection, []))[1].append(points)
+
+            for entity_subcollection, groups in batches.values():
+                if point_entity_mode == 'EMPTIES':
+                    create_entity_empties(entity_subcollection, groups, global_scale)
+
+                else:
+                    for points in groups:
+                        node_group_names = set(bpy.data.node_groups.keys())
+                        ob = create_entity_points(points, global_scale, point_entity_mode == 'INSTANCES')
+                        entity_subcollection.objects.link(ob)
+                        ob.select_set(True)
+                        record_node_groups(node_group_names)
+
+                yield progress(sum(len(p.entities) for p in groups))
+
+        performance_monitor.step('Creating brush entities...')
+
+        brush_entities = dict(entities.by_model)
+        brush_entities[0] = entities[0]
+
+        model_indices = [
+            i for i in range(len(models))
+            if brush_entities.get(i)
+            and not api.match_classname(brush_entities[i].classname, exclude_entities)
+            and (i > 0 or use_worldspawn_entity)
+            and (i == 0 or use_brush_entities)
+        ]
+
+        # Limit geometry to the potentially visible set
+        visible_faces = None
+        if visible_from and use_models:
+            points = visibility_points(entities, visible_from)
+
+            if not len(points):
+                operator.report({'WARNING'}, f'Nothing named {visible_from} to import the visible set of')
+
+            elif not bsp.has_visibility_data:
+                operator.report({'WARNING'}, 'The file has no visibility data, importing everything')
+
+            else:
+                visible_leafs = bsp.visible_leafs(bsp.point_leafs(points))
+                visible_faces = bsp.leaf_faces(visible_leafs)
+
+                # Brush model faces aren't marked by leafs, so test bounds
+                mins, maxs = bsp.model_array['bounding_box_min'], bsp.model_array['bounding_box_max']
+                model_indices = [
+                    i for i in model_indices
+                    if i == 0 or numpy.isin(bsp.box_leafs(mins[i], maxs[i]), visible_leafs).any()
+                ]
+
+        previous_objects = {}
+        if is_update and use_models:
+            previous_objects = {
+                (ob['bsp_model'], ob.get('bsp_chunk', '')): ob
+                for ob in brush_collection.all_objects if 'bsp_model' in ob
+            }
+
+        # Hash models up front so unchanged ones can be skipped entirely.
+        # Textures are shared by content, so models also hash the textures
+        # they use. Hashing reads all of the geometry, so it is only done
+        # when this or a later update import compares against it.
+        model_digests = {}
+        if update_existing:
+            texture_numbers = bsp.texture_info_array['miptexture_number'][bsp.face_array['texture_info']]
+
+            for model_index in model_indices:
+                model_textures = numpy.unique(texture_numbers[models[model_index].face_indices]).tolist()
+                digest = f'{models[model_index].digest}:{global_scale}:{load_lightmap}:{sorted(exclude_texture_classes)}'
+                digest += ':' + ''.join(texture_digests.get(bsp.miptexture_name(i), '') for i in model_textures)
+                digest += f':{merge_coplanar_faces}:{group_animated_textures}:{atlas_digest}:{hull_numbers}'
+                digest += f':{share_duplicate_meshes}'
+
+                if load_lightmap:
+                    digest += f':{lightmap_mode}:{lightmap_storage}'
+
+                if model_index == 0:
+                    digest += f':{worldspawn_chunking}:{chunk_size}:{chunk_depth}'
+
+                    if visible_faces is not None:
+                        digest += ':' + hashlib.sha1(visible_faces.tobytes()).hexdigest()
+
+                model_digests[model_index] = hashlib.sha1(digest.encode()).hexdigest()
+
+        kept_models = set()
+        for key, ob in list(previous_objects.items()):
+            if ob.get('bsp_hash') == model_digests.get(key[0]):
+                kept_models.add(key[0])
+                del previous_objects[key]
+
+        for _ in kept_models:
+            yield progress()
+
+        model_indices = [i for i in model_indices if i not in kept_models]
+
+        mesh_objects = []
+
+        def prepare_mesh_data(model_index):
+            """Starts building the mesh data of a model on the worker thread."""
+            return executor.submit(
+                model_mesh_data,
+                bsp,
+                models[model_index],
+                exclude_texture_classes,
+                worldspawn_chunking if model_index == 0 else 'NONE',
+                chunk_size,
+                chunk_depth,
+                merge_coplanar_faces,
+                visible_faces if model_index == 0 else None
+            )
+
+        def prepare_hull_data(model_index):
+            """Starts rebuilding the collision hulls of a model on the worker
+            thread."""
+            return executor.submit(model_hull_data, bsp, model_index, hull_numbers)
+
+        def place_mesh(model_index, chunk, mesh_name, mesh, location=(0, 0, 0)):
+            """Swaps a rebuilt mesh into the previous import's object, or
+            creates a new object for it, and moves the object to location.
 
-    global_matrix = Matrix.Scale(global_scale, 4)
+            Returns:
+                An object
+            """
+            ob = previous_objects.pop((model_index, chunk), None)
 
-    # Create point entities
-    if use_point_entities:
-        performance_monitor.step('Creating point entities...')
+            if ob:
+                # Swap in the rebuilt mesh
+                outdated_mesh = ob.data
+                ob.data = mesh
 
-        for entity in [_ for _ in bsp.entities if hasattr(_, 'origin')]:
-            vec = tuple(map(float, entity.origin.split(' ')))
-            ob = bpy.data.objects.new(entity.classname + '.000', None)
-            ob.location = Vector(vec) * global_scale
-            ob.empty_display_size = 16 * global_scale
-            ob.empty_display_type = 'CUBE'
-            z_rotation = radians(float(entity.angle) if hasattr(entity, 'angle') else 0)
-            ob.rotation_euler = 0, 0, z_rotation
+                if not outdated_mesh.users:
+                    outdated_name = outdated_mesh.name
+                    bpy.data.meshes.remove(outdated_mesh)
+                    mesh.name = outdated_name
 
-            entity_subcollection = get_subcollection(entity_collection, entity.classname)
-            entity_subcollection.objects.link(ob)
-            ob.select_set(True)
+            else:
+                ob = bpy.data.objects.new(mesh_name, mesh)
+                ob['bsp_model'] = model_index
 
-    performance_monitor.step('Creating brush entities...')
+                if chunk:
+                    ob['bsp_chunk'] = chunk
 
-    brush_entities = {int(e.model.strip('*')): e for e in bsp.entities if hasattr(e, 'model') and e.model.startswith('*')}
-    brush_entities[0] = bsp.entities[0]
+                entity_subcollection = get_subcollection(brush_collection, brush_entities[model_index].classname)
+                entity_subcollection.objects.link(ob)
+                ob.select_set(True)
 
-    mesh_objects = []
+            ob.location = location
 
-    # Create mesh objects
-    for model_index, model in enumerate(bsp.models):
-        if model_index == 0 and not use_worldspawn_entity:
-            continue
+            if model_index in model_digests:
+                ob['bsp_hash'] = model_digests[model_index]
 
-        if model_index > 0 and not use_brush_entities:
-            break
+            return ob
 
-        entity = brush_entities.get(model_index)
-        if not entity:
-            continue
+        # Meshes of brush models by mesh_data_key digest
+        shared_meshes = {}
 
-        name = entity.classname
-        ob = bpy.data.objects.new(name, bpy.data.meshes.new(name))
-        bm = bmesh.new()
-        uv_layer = bm.loops.layers.uv.new()
+        # Prepare the geometry of the first model on the worker thread
+        geometry_futures = {}
+        hull_futures = {}
+        if model_indices:
+            geometry_futures[model_indices[0]] = prepare_mesh_data(model_indices[0])
+            hull_futures[model_indices[0]] = prepare_hull_data(model_indices[0])
 
-        def new_vertex(vertex):
-            bv = bm.verts.new(vertex)
-            bv.co = global_matrix @ bv.co
+        # Create mesh objects
+        for index, model_index in enumerate(model_indices):
+            # Prepare the next model while this one is built
+            if index + 1 < len(model_indices):
+                next_index = model_indices[index + 1]
+                geometry_futures[next_index] = prepare_mesh_data(next_index)
+                hull_futures[next_index] = prepare_hull_data(next_index)
 
-            return bv
+            geometry_future = geometry_futures.pop(model_index)
+            hull_future = hull_futures.pop(model_index)
+            while wait((geometry_future, hull_future), timeout=0.01).not_done:
+                yield completed_steps / total_steps
 
-        def process_vertices(vertices):
-            """Helper function to create Blender vertices from a sequence of
-            tuples.
+            entity = brush_entities[model_index]
+            name = entity.classname
 
-            Args:
-                vertices: A sequence of three-tuples
+            for chunk, mesh_data in geometry_future.result():
+                # Every face was excluded
+                if not len(mesh_data.face_indices):
+                    continue
 
-            Returns:
-                A sequence of Blender vertices
-            """
-            return [new_vertex(v) for v in vertices]
+                mesh_name = f'{name}.{chunk}' if chunk else name
+                location = (0, 0, 0)
+                key = None
 
-        def get_material_index(name):
-            """Get the material slot index of the given material name. If the
-            material is not currently assigned to the mesh, it will be added.
+                if share_duplicate_meshes and model_index > 0:
+                    key, offset = mesh_data_key(bsp, mesh_data)
+                    mesh_data = mesh_data._replace(vertices=mesh_data.vertices - offset)
+                    location = tuple(offset * global_scale)
 
-            Args:
-                name: The name of the material
+                mesh = shared_meshes.get(key)
 
-            Returns:
-                The index of the material in the object's material slots
-            """
-            material = ob.data.materials.get(name)
-            if not material:
-                ob.data.materials.append(bpy.data.materials[name])
-                material = ob.data.materials.get(name)
+                if mesh is None:
+                    mesh = create_mesh(
+                        mesh_name,
+                        bsp,
+                        mesh_data,
+                        global_scale,
+                        material_names,
+                        atlas,
+                        atlas_material_names
+                    )
 
-            return ob.data.materials[:].index(material)
+                    if key:
+                        shared_meshes[key] = mesh
 
-        for face in model.faces:
-            if not face.vertices:
-                continue
+                ob = place_mesh(model_index, chunk, mesh_name, mesh, location)
+                mesh_objects.append((mesh_data.face_indices, ob))
 
-            bface = bm.faces.new(process_vertices(face.vertices))
-            bface.material_index = get_material_index(face.texture_name)
+            for hull, hull_data in hull_future.result():
+                if not len(hull_data.loop_totals):
+                    continue
 
-            for uv, loop in zip(face.uvs, bface.loops):
-                loop[uv_layer].uv = uv
+                chunk = f'hull{hull}'
+                mesh_name = f'{name}.{chunk}'
+                ob = place_mesh(model_index, chunk, mesh_name, create_hull_mesh(mesh_name, hull_data, global_scale))
+                ob.display_type = 'WIRE'
+                ob.hide_render = True
 
-        bm.to_mesh(ob.data)
-        bm.free()
+            yield progress()
 
-        entity_subcollection = get_subcollection(brush_collection, ob.name)
-        entity_subcollection.objects.link(ob)
-        ob.select_set(True)
+        # Models and chunks no longer in the file
+        remove_objects(previous_objects.values())
 
-        mesh_objects.append((model, ob))
+        # Only lightmaps still need the face data. The model digests and
+        # meshes were the last users of the miptexture names, and nothing
+        # needs the BSP tree
+        if load_lightmap:
+            bsp.release(
+                'miptextures', 'node_array', 'leaf_array', 'mark_surface_array', 'clip_node_array', 'visibility_rows'
+            )
 
-    if load_lightmap:
-        from . import block_packer as atlas_packer
+        else:
+            bsp.release()
 
-        performance_monitor.step('Creating lightmaps...')
+        if load_lightmap and lightmap_mode == 'COLORS':
+            performance_monitor.step('Creating lightmap colors...')
 
-        for model, ob in mesh_objects:
-            bm = bmesh.new()
-            bm.from_mesh(ob.data)
-            lightmap_layer = bm.loops.layers.uv.new('LightMap')
+            for face_indices, ob in mesh_objects:
+                colors = bsp.lightmap_colors(face_indices)
 
-            individual_lightmaps = []
+                # Validation can drop degenerate polygons
+                if len(colors) == len(ob.data.loops):
+                    add_lightmap_colors(ob.data, colors)
 
-            for face, bface in zip(model.faces, bm.faces):
-                if not face.vertices:
-                    continue
+                yield progress()
 
-                individual_lightmaps.append(face.lightmap_image)
+        elif load_lightmap:
+            from . import block_packer as atlas_packer
 
-            atlas_size, atlas_offset = atlas_packer.pack(individual_lightmaps)
+            performance_monitor.step('Creating lightmaps...')
 
-            lightmap_image = bpy.data.images.new(f'{ob.name}.lightmap', atlas_size[0], atlas_size[1])
-            pixels = numpy.array(lightmap_image.pixels[:])
-            w, h = atlas_size
-            pixels = pixels.reshape((h, w * 4))
+            for face_indices, ob in mesh_objects:
+                loop_count = int(bsp.face_array['number_of_edges'][face_indices].sum())
 
-            for lm, offset in zip(individual_lightmaps, atlas_offset):
-                if not offset:
+                # Validation can drop degenerate polygons, which leaves no
+                # way to match faces to polygons
+                if len(face_indices) != len(ob.data.polygons) or loop_count != len(ob.data.loops):
+                    yield progress()
                     continue
 
-                size, lightmap_pixels = lm
-                lightmap_pixels = numpy.array(lightmap_pixels)
-                lightmap_pixels = lightmap_pixels.reshape((size[1], size[0] * 4))
-                x, y = offset
-                pixels[y:y + size[1], x * 4:x * 4 + (size[0] * 4)] = lightmap_pixels
+                bm = bmesh.new()
+                bm.from_mesh(ob.data)
+                lightmap_layer = bm.loops.layers.uv.new('LightMap')
 
-            pixels = pixels.reshape(len(lightmap_image.pixels))
-            lightmap_image.pixels[:] = pixels
+                faces = [bsp.get_face(i) for i in face_indices]
+                individual_lightmaps = [face.lightmap_luxels for face in faces]
 
-            for face, bface, offset, lm in zip(model.faces, bm.faces, atlas_offset, individual_lightmaps):
-                if not face.vertices:
-                    continue
+                atlas_size, atlas_offset = atlas_packer.pack(individual_lightmaps)
+
+                outdated_image = None
+                if is_update:
+                    outdated_image = outdated_datablock(bpy.data.images, f'{ob.name}.lightmap', ob['bsp_hash'])
+
+                lightmap_image = create_lightmap_image(
+                    f'{ob.name}.lightmap',
+                    atlas_size,
+                    individual_lightmaps,
+                    atlas_offset,
+                    storage=lightmap_storage
+                )
+
+                # Updates swap lightmaps in as soon as they are made, so a
+                # cancelled update keeps them
+                if not is_update:
+                    created_datablocks.append((bpy.data.images, lightmap_image))
+
+                if 'bsp_hash' in ob:
+                    lightmap_image['bsp_hash'] = ob['bsp_hash']
+
+                for face, bface, offset in zip(faces, bm.faces, atlas_offset):
+                    if not offset:
+                        continue
+
+                    ox, oy = offset
+                    ox /= atlas_size[0]
+                    oy /= atlas_size[1]
+                    offset = ox, oy
+
+                    for uv, loop in zip(face.lightmap_uvs, bface.loops):
+                        u, v = uv
+                        u /= atlas_size[0]
+                        v /= atlas_size[1]
+                        u += offset[0]
+                        v += offset[1]
+
+                        loop[lightmap_layer].uv = u, v
+
+                bm.to_mesh(ob.data)
+                bm.free()
+
+                if outdated_image:
+                    replace_datablock(bpy.data.images, outdated_image, lightmap_image)
+
+                yield progress()
+
+        if is_update:
+            # Textures that changed leave their previous versions unused
+            remove_unused_materials([*created_materials.values(), *created_images.values()])
+
+            # Give replacements the names their previous versions had
+            renames = [(bpy.data.materials, n, m) for n, m in created_materials.items()]
+            renames += [(bpy.data.images, n, i) for n, i in created_images.items() if n not in missing_images]
+
+            for datablocks, name, datablock in renames:
+                if datablock.name != name and name not in datablocks:
+                    datablock.name = name
+
+                    if isinstance(datablock, bpy.types.Image) and datablock.packed_file:
+                        datablock.filepath_raw = f'//{bpy.path.clean_name(name)}.png'
+
+        yield 1.0
+
+    except BaseException:
+        # Cancelled or failed, remove the partial import along with the
+        # images, materials and node groups it made. Datablocks shared by
+        # hash with earlier imports are never removed. A cancelled update
+        # keeps the parts already updated, so only its unused datablocks go.
+        if not is_update:
+            remove_collection(root_collection)
 
-                ox, oy = offset
-                ox /= atlas_size[0]
-                oy /= atlas_size[1]
-                offset = ox, oy
+        # Materials before the node groups and images they use
+        created_datablocks.sort(key=lambda d: not isinstance(d[1], bpy.types.Material))
+        remove_datablocks(created_datablocks, unused_only=is_update)
 
-                for uv, loop in zip(face.lightmap_uvs, bface.loops):
-                    u, v = uv
-                    u /= atlas_size[0]
-                    v /= atlas_size[1]
-                    u += offset[0]
-                    v += offset[1]
+        raise
 
-                    loop[lightmap_layer].uv = u, v
+    finally:
+        executor.shutdown(wait=False)
 
-            bm.to_mesh(ob.data)
-            bm.free()
+        # Drop the file data now rather than whenever the generator is
+        # collected
+        if bsp_future.done() and not bsp_future.exception():
+            bsp_future.result().close()
 
     performance_monitor.pop_scope()
     performance_monitor.pop_scope('Import finished.')
@@ -0,0 +1,396 @@
+"""This module describes the on-disk layout of each supported BSP format.
+
+Each format registers a Schema that declares its lumps as NumPy structured
+dtypes. Lumps are read straight from the file bytes with numpy.frombuffer and
+widened to a common layout, so the same vectorized code handles every format.
+
+Supported formats:
+    BSP29: Vanilla Quake.
+
+    BSP2: Quake with 32-bit indices and float bounding boxes.
+
+    2PSB: The RMQ variant of BSP2 with 16-bit bounding boxes.
+
+    BSP30: Half-Life. Lighting is RGB and miptextures carry their own
+        palette.
+"""
+import struct
+
+from collections import namedtuple
+
+import numpy
+
+__all__ = ['BadBspFile', 'Schema', 'Lumps', 'schemas', 'register', 'identify', 'is_bspfile', 'read_directory']
+
+
+class BadBspFile(Exception):
+    pass
+
+
+lump_names = (
+    'entities',
+    'planes',
+    'miptextures',
+    'vertexes',
+    'visibilities',
+    'nodes',
+    'texture_infos',
+    'faces',
+    'lighting',
+    'clip_nodes',
+    'leafs',
+    'mark_surfaces',
+    'edges',
+    'surf_edges',
+    'models'
+)
+
+header_size = 4 + 8 * len(lump_names)
+
+# Common in-memory layouts. Every format's lumps are widened to these.
+plane_dtype = numpy.dtype([
+    ('normal', '<f4', 3),
+    ('distance', '<f4'),
+    ('type', '<i4')
+])
+
+vertex_dtype = numpy.dtype(('<f4', 3))
+
+node_dtype = numpy.dtype([
+    ('plane_number', '<i4'),
+    ('children', '<i4', 2),
+    ('bounding_box_min', '<f4', 3),
+    ('bounding_box_max', '<f4', 3),
+    ('first_face', '<i4'),
+    ('number_of_faces', '<i4')
+])
+
+texture_info_dtype = numpy.dtype([
+    ('s', '<f4', 3),
+    ('s_offset', '<f4'),
+    ('t', '<f4', 3),
+    ('t_offset', '<f4'),
+    ('miptexture_number', '<i4'),
+    ('flags', '<i4')
+])
+
+face_dtype = numpy.dtype([
+    ('plane_number', '<i4'),
+    ('side', '<i4'),
+    ('first_edge', '<i4'),
+    ('number_of_edges', '<i4'),
+    ('texture_info', '<i4'),
+    ('styles', '<u1', 4),
+    ('light_offset', '<i4')
+])
+
+clip_node_dtype = numpy.dtype([
+    ('plane_number', '<i4'),
+    ('children', '<i4', 2)
+])
+
+leaf_dtype = numpy.dtype([
+    ('contents', '<i4'),
+    ('visibility_offset', '<i4'),
+    ('bounding_box_min', '<f4', 3),
+    ('bounding_box_max', '<f4', 3),
+    ('first_mark_surface', '<i4'),
+    ('number_of_mark_surfaces', '<i4'),
+    ('ambient_level', '<u1', 4)
+])
+
+mark_surface_dtype = numpy.dtype('<i4')
+
+edge_dtype = numpy.dtype(('<i4', 2))
+
+surf_edge_dtype = numpy.dtype('<i4')
+
+model_dtype = numpy.dtype([
+    ('bounding_box_min', '<f4', 3),
+    ('bounding_box_max', '<f4', 3),
+    ('origin', '<f4', 3),
+    ('head_node', '<i4', 4),
+    ('visleafs', '<i4'),
+    ('first_face', '<i4'),
+    ('number_of_faces', '<i4')
+])
+
+miptexture_header_dtype = numpy.dtype([
+    ('name', 'S16'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('offsets', '<u4', 4)
+])
+
+common_dtypes = {
+    'planes': plane_dtype,
+    'vertexes': vertex_dtype,
+    'nodes': node_dtype,
+    'texture_infos': texture_info_dtype,
+    'faces': face_dtype,
+    'clip_nodes': clip_node_dtype,
+    'leafs': leaf_dtype,
+    'mark_surfaces': mark_surface_dtype,
+    'edges': edge_dtype,
+    'surf_edges': surf_edge_dtype,
+    'models': model_dtype
+}
+
+
+def _layout(bounds, index, child='<i4', face_count=None):
+    """Builds the node, face, clip node, leaf, mark surface and edge dtypes of
+    a Quake format from the types of its variable width fields.
+
+    Args:
+        bounds: The type of node and leaf bounding boxes
+
+        index: The type of face, edge and mark surface indices
+
+        child: The type of node and clip node children
+
+        face_count: The type of node face ranges. Defaults to index.
+    """
+    signed_index = index.replace('u', 'i')
+    face_count = face_count or index
+
+    return {
+        'nodes': numpy.dtype([
+            ('plane_number', '<i4'),
+            ('children', child, 2),
+            ('bounding_box_min', bounds, 3),
+            ('bounding_box_max', bounds, 3),
+            ('first_face', face_count),
+            ('number_of_faces', face_count)
+        ]),
+        'faces': numpy.dtype([
+            ('plane_number', signed_index),
+            ('side', signed_index),
+            ('first_edge', '<i4'),
+            ('number_of_edges', signed_index),
+            ('texture_info', signed_index),
+            ('styles', '<u1', 4),
+            ('light_offset', '<i4')
+        ]),
+        'clip_nodes': numpy.dtype([
+            ('plane_number', '<i4'),
+            ('children', child, 2)
+        ]),
+        'leafs': numpy.dtype([
+            ('contents', '<i4'),
+            ('visibility_offset', '<i4'),
+            ('bounding_box_min', bounds, 3),
+            ('bounding_box_max', bounds, 3),
+            ('first_mark_surface', index),
+            ('number_of_mark_surfaces', index),
+            ('ambient_level', '<u1', 4)
+        ]),
+        'mark_surfaces': numpy.dtype(index),
+        'edges': numpy.dtype((index, 2))
+    }
+
+
+Schema = namedtuple('Schema', 'name identity dtypes lighting_channels has_palettes')
+"""The layout of a BSP format.
+
+Attributes:
+    name: A display name for the format.
+
+    identity: The first four bytes of the file.
+
+    dtypes: A dict of lump names to on-disk dtypes. Lumps missing from the
+        dict are raw bytes.
+
+    lighting_channels: The number of bytes per lightmap sample.
+
+    has_palettes: True if each miptexture is followed by its own palette.
+"""
+
+schemas = {}
+"""Registered schemas keyed by identity."""
+
+
+def register(schema):
+    """Adds a schema to the registry."""
+    schemas[schema.identity] = schema
+
+    return schema
+
+
+def _quake_dtypes(**kwargs):
+    dtypes = dict(common_dtypes)
+    dtypes.update(_layout(**kwargs))
+
+    return dtypes
+
+
+bsp29 = register(Schema(
+    'BSP29',
+    struct.pack('<i', 29),
+    _quake_dtypes(bounds='<i2', index='<u2', child='<i2'),
+    1,
+    False
+))
+
+bsp2 = register(Schema(
+    'BSP2',
+    b'BSP2',
+    _quake_dtypes(bounds='<f4', index='<u4'),
+    1,
+    False
+))
+
+bsp2rmq = register(Schema(
+    '2PSB',
+    b'2PSB',
+    _quake_dtypes(bounds='<i2', index='<u4'),
+    1,
+    False
+))
+
+bsp30 = register(Schema(
+    'BSP30',
+    struct.pack('<i', 30),
+    _quake_dtypes(bounds='<i2', index='<u2', child='<i2'),
+    3,
+    True
+))
+
+
+def identify(data):
+    """Finds the schema of the given file data.
+
+    Args:
+        data: The file bytes, or at least the first four of them
+
+    Returns:
+        A Schema or None
+    """
+    return schemas.get(bytes(data[:4]))
+
+
+def is_bspfile(filename):
+    """Quickly see if a file is a bsp file of a registered format by checking
+    the magic number.
+
+    Args:
+        filename: File to check as string or file-like object.
+
+    Returns:
+        True if given file's magic number is recognized.
+    """
+    try:
+        if hasattr(filename, 'read'):
+            position = filename.tell()
+            filename.seek(0)
+            data = filename.read(4)
+            filename.seek(position)
+
+        else:
+            with open(filename, 'rb') as file:
+                data = file.read(4)
+
+        return identify(data) is not None
+
+    except Exception:
+        return False
+
+
+def read_directory(file):
+    """Reads the schema and lump directory of a BSP file without reading
+    any lumps.
+
+    Args:
+        file: A binary file-like object positioned anywhere
+
+    Returns:
+        A (Schema, directory) pair. The directory is a dict of lump names to
+        (offset, length) pairs.
+    """
+    file.seek(0)
+    data = file.read(header_size)
+    schema = identify(data)
+
+    if schema is None or len(data) < header_size:
+        raise BadBspFile('Unrecognized BSP identity: %r' % bytes(data[:4]))
+
+    directory = dict(zip(
+        lump_names,
+        numpy.frombuffer(data, '<i4', count=2 * len(lump_names), offset=4).reshape(-1, 2).tolist()
+    ))
+
+    return schema, directory
+
+
+def widen(array, dtype):
+    """Converts an on-disk lump array to its common layout field by field."""
+    if array.dtype == dtype:
+        return array
+
+    if dtype.names is None:
+        return array.astype(dtype.base)
+
+    result = numpy.empty(len(array), dtype=dtype)
+
+    for name in dtype.names:
+        result[name] = array[name]
+
+    return result
+
+
+class Lumps:
+    """The lumps of a BSP file of any registered format.
+
+    Attributes:
+        schema: The Schema of the file.
+    """
+
+    def __init__(self, data):
+        self.schema = identify(data)
+
+        if self.schema is None:
+            raise BadBspFile('Unrecognized BSP identity: %r' % bytes(data[:4]))
+
+        self._data = data
+        self._directory = dict(zip(
+            lump_names,
+            numpy.frombuffer(data, '<i4', count=2 * len(lump_names), offset=4).reshape(-1, 2).tolist()
+        ))
+
+    @classmethod
+    def open(cls, file):
+        """Reads a BSP file.
+
+        Args:
+            file: A path or file-like object
+        """
+        if hasattr(file, 'read'):
+            file.seek(0)
+            return cls(file.read())
+
+        with open(file, 'rb') as fp:
+            return cls(fp.read())
+
+    def close(self):
+        """Releases the file data. Arrays already returned by array stay
+        valid."""
+        self._data = None
+
+    def raw(self, name):
+        """The bytes of the given lump as a memoryview."""
+        if self._data is None:
+            raise ValueError('I/O operation on a closed BSP file')
+
+        offset, length = self._directory[name]
+
+        return memoryview(self._data)[offset:offset + length]
+
+    def array(self, name):
+        """The given lump as an array in its common layout."""
+        if self._data is None:
+            raise ValueError('I/O operation on a closed BSP file')
+
+        offset, length = self._directory[name]
+        dtype = self.schema.dtypes[name]
+        array = numpy.frombuffer(self._data, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+
+        return widen(array, common_dtypes[name])
@@ -23,11 +23,32 @@ def node_group(name):
     return decorator
 
 
+def new_socket(group, in_out, socket_type, name):
+    """Adds an input or output socket to a node group with either the node
+    group interface API of Blender 4.0+ or the older inputs and outputs
+    collections."""
+    if hasattr(group, 'interface'):
+        return group.interface.new_socket(name, in_out=in_out, socket_type=socket_type)
+
+    sockets = group.inputs if in_out == 'INPUT' else group.outputs
+
+    return sockets.new(socket_type, name)
+
+
+def socket_identifier(group, name):
+    """Gets the identifier of a node group input, used to set modifier
+    inputs."""
+    if hasattr(group, 'interface'):
+        return group.interface.items_tree[name].identifier
+
+    return group.inputs[name].identifier
+
+
 @node_group('Unlit BSDF')
 def unlit_bsdf():
     group = bpy.data.node_groups.new(type='ShaderNodeTree', name='Unlit BSDF')
-    group.inputs.new('NodeSocketColor', 'Color')
-    group.outputs.new('NodeSocketShader', 'Shader')
+    new_socket(group, 'INPUT', 'NodeSocketColor', 'Color')
+    new_socket(group, 'OUTPUT', 'NodeSocketShader', 'Shader')
 
     # Group input node
     input_node = group.nodes.new('NodeGroupInput')
@@ -51,8 +72,8 @@ def unlit_bsdf():
 @node_group('Lightmapped BSDF')
 def lightmapped_bsdf():
     group = bpy.data.node_groups.new(type='ShaderNodeTree', name='Lightmapped BSDF')
-    group.inputs.new('NodeSocketColor', 'Color')
-    group.outputs.new('NodeSocketShader', 'Shader')
+    new_socket(group, 'INPUT', 'NodeSocketColor', 'Color')
+    new_socket(group, 'OUTPUT', 'NodeSocketShader', 'Shader')
 
     # Group input node
     input_node = group.nodes.new('NodeGroupInput')
@@ -76,8 +97,8 @@ def lightmapped_bsdf():
 @node_group('Unlit Alpha Mask BSDF')
 def unlit_alpha_mask_bsdf():
     group = bpy.data.node_groups.new(type='ShaderNodeTree', name='Unlit Alpha Mask BSDF')
-    group.inputs.new('NodeSocketColor', 'Color')
-    group.outputs.new('NodeSocketShader', 'Shader')
+    new_socket(group, 'INPUT', 'NodeSocketColor', 'Color')
+    new_socket(group, 'OUTPUT', 'NodeSocketShader', 'Shader')
 
     # Group input node
     input_node = group.nodes.new('NodeGroupInput')
@@ -131,8 +152,8 @@ def unlit_alpha_mask_bsdf():
 @node_group('Scalar Multiply')
 def scalar_multiply():
     group = bpy.data.node_groups.new(type='ShaderNodeTree', name='Scalar Multiply')
-    group.inputs.new('NodeSocketVector', 'Vector')
-    group.inputs.new('NodeSocketFloat', 'Scalar')
+    new_socket(group, 'INPUT', 'NodeSocketVector', 'Vector')
+    new_socket(group, 'INPUT', 'NodeSocketFloat', 'Scalar')
 
     # Group input node
     input_node = group.nodes.new('NodeGroupInput')
@@ -165,7 +186,7 @@ def scalar_multiply():
     combine_xyz_node.location = 600, 0
 
     # Group output node
-    group.outputs.new('NodeSocketVector', 'Vector')
+    new_socket(group, 'OUTPUT', 'NodeSocketVector', 'Vector')
     output_node = group.nodes.new('NodeGroupOutput')
     output_node.location = 800, 0
 
@@ -188,8 +209,8 @@ def scalar_multiply():
 @node_group('Non-Zero')
 def non_zero():
     group = bpy.data.node_groups.new(type='ShaderNodeTree', name='Non-Zero')
-    group.inputs.new('NodeSocketFloat', 'Value')
-    group.inputs.new('NodeSocketFloat', 'Value')
+    new_socket(group, 'INPUT', 'NodeSocketFloat', 'Value')
+    new_socket(group, 'OUTPUT', 'NodeSocketFloat', 'Value')
 
     # Group input node
     input_node = group.nodes.new('NodeGroupInput')
@@ -229,4 +250,46 @@ def non_zero():
     group.links.new(add_node.outputs[0], divide_node.inputs[1])
     group.links.new(divide_node.outputs[0], output_node.inputs[0])
 
-    return group
\ No newline at end of file
+    return group
+
+
+@node_group('Entity Instances')
+def entity_instances():
+    """Geometry nodes group that instances a cube on every point, rotated by
+    the point's 'rotation' attribute. Requires Blender 3.2 or newer."""
+    group = bpy.data.node_groups.new(type='GeometryNodeTree', name='Entity Instances')
+    new_socket(group, 'INPUT', 'NodeSocketGeometry', 'Geometry')
+    new_socket(group, 'INPUT', 'NodeSocketFloat', 'Size')
+    new_socket(group, 'OUTPUT', 'NodeSocketGeometry', 'Geometry')
+
+    # Group input node
+    input_node = group.nodes.new('NodeGroupInput')
+    input_node.location = 0, 0
+
+    # Cube to instance
+    cube_node = group.nodes.new('GeometryNodeMeshCube')
+    cube_node.location = 200, -150
+
+    # Rotation attribute
+    rotation_node = group.nodes.new('GeometryNodeInputNamedAttribute')
+    rotation_node.data_type = 'FLOAT_VECTOR'
+    rotation_node.inputs['Name'].default_value = 'rotation'
+    rotation_node.location = 200, -300
+
+    # Instance on points node
+    instance_node = group.nodes.new('GeometryNodeInstanceOnPoints')
+    instance_node.location = 400, 0
+
+    # Group output node
+    output_node = group.nodes.new('NodeGroupOutput')
+    output_node.location = 600, 0
+
+    # Make links
+    rotation_output = next(o for o in rotation_node.outputs if o.enabled)
+    group.links.new(input_node.outputs['Geometry'], instance_node.inputs['Points'])
+    group.links.new(input_node.outputs['Size'], cube_node.inputs['Size'])
+    group.links.new(cube_node.outputs['Mesh'], instance_node.inputs['Instance'])
+    group.links.new(rotation_output, instance_node.inputs['Rotation'])
+    group.links.new(instance_node.outputs['Instances'], output_node.inputs['Geometry'])
+
+    return group
@@ -1,13 +1,16 @@
 if 'bpy' in locals():
     import importlib as il
-    il.reload(import_bsp)
-    il.reload(export_bsp)
+    import sys
+
+    # Heavy modules are imported on first use, so only reload loaded ones
+    for name in ('import_bsp', 'export_bsp'):
+        if f'{__package__}.{name}' in sys.modules:
+            il.reload(sys.modules[f'{__package__}.{name}'])
+
     # print('io_scene_bsp.operators: reload ready')
 
-else:
-    from . import import_bsp
-    from . import export_bsp
 
+import time
 
 import bpy
 
@@ -15,7 +18,8 @@ from bpy.props import (
     StringProperty,
     BoolProperty,
     EnumProperty,
-    FloatProperty
+    FloatProperty,
+    IntProperty
 )
 
 from bpy_extras.io_utils import (
@@ -23,13 +27,16 @@ from bpy_extras.io_utils import (
     ExportHelper,
 )
 
+from .patch import import_module
+
 
 class ImportBSP(bpy.types.Operator, ImportHelper):
     """Load a Quake BSP File"""
 
     bl_idname = 'import_scene.bsp'
     bl_label = 'Import BSP'
-    bl_options = {'UNDO', 'PRESET'}
+    # Undo steps are pushed by push_undo so they can be skipped
+    bl_options = {'PRESET'}
 
     filename_ext = '.bsp'
     filter_glob: StringProperty(
@@ -61,12 +68,135 @@ class ImportBSP(bpy.types.Operator, ImportHelper):
         default=True
     )
 
+    exclude_texture_classes: EnumProperty(
+        name='Exclude Textures',
+        description='Skip faces with these kinds of textures',
+        items=(
+            ('SKY', 'Sky', 'Sky textures (sky*)'),
+            ('LIQUID', 'Liquid', 'Turbulent textures (*water, *slime, *lava, *teleport)'),
+            ('FENCE', 'Fence', 'Alpha masked textures ({*)'),
+            ('TRIGGER', 'Trigger', 'Trigger texture'),
+            ('CLIP', 'Clip', 'Clip texture'),
+        ),
+        options={'ENUM_FLAG'},
+        default=set()
+    )
+
+    exclude_entities: StringProperty(
+        name='Exclude Entities',
+        description='Comma separated classname patterns of entities to skip, '
+                    'for example trigger_*',
+        default=''
+    )
+
+    point_entity_mode: EnumProperty(
+        name='Point Entities',
+        description='How point entities are represented',
+        items=(
+            ('EMPTIES', 'Empties', 'One empty per entity'),
+            ('POINTS', 'Point Clouds', 'One mesh per classname with a vertex '
+                                      'per entity and per point attributes'),
+            ('INSTANCES', 'Instances', 'Point clouds that instance a cube on '
+                                       'every entity with geometry nodes'),
+        ),
+        default='EMPTIES'
+    )
+
+    visible_from: StringProperty(
+        name='Visible From',
+        description='Only import geometry potentially visible from a point '
+                    'given as "x y z", or from the point entities with this '
+                    'classname or targetname, for example info_player_start. '
+                    'Empty to import everything',
+        default=''
+    )
+
+    worldspawn_chunking: EnumProperty(
+        name='Split Worldspawn',
+        description='Split worldspawn into several objects so Blender only '
+                    'draws and evaluates the visible parts',
+        items=(
+            ('NONE', 'None', 'Import worldspawn as a single object'),
+            ('GRID', 'Grid', 'Split worldspawn by a world space grid'),
+            ('NODES', 'BSP Nodes', 'Split worldspawn by subtrees of its BSP tree'),
+        ),
+        default='NONE'
+    )
+
+    chunk_size: FloatProperty(
+        name='Chunk Size',
+        description='Size of a grid cell in map units',
+        min=16.0, max=65536.0,
+        default=1024.0
+    )
+
+    chunk_depth: IntProperty(
+        name='Chunk Depth',
+        description='Depth in the BSP tree of the subtrees used as chunks. '
+                    'Up to 2^depth objects are created',
+        min=0, max=16,
+        default=3
+    )
+
+    merge_coplanar_faces: BoolProperty(
+        name='Merge Coplanar Faces',
+        description='Merge adjacent faces that share a plane and texture into '
+                    'larger polygons. Useful for lightweight previews. '
+                    'Lightmaps are not loaded',
+        default=False
+    )
+
+    collision_hulls: EnumProperty(
+        name='Collision Hulls',
+        description='Rebuild collision hulls from the clip nodes as wireframe '
+                    'objects',
+        items=(
+            ('HULL1', 'Hull 1', 'Player sized collision hull'),
+            ('HULL2', 'Hull 2', 'Large monster sized collision hull'),
+            ('HULL3', 'Hull 3', 'Crouching player collision hull (Half-Life)'),
+        ),
+        options={'ENUM_FLAG'},
+        default=set()
+    )
+
+    share_duplicate_meshes: BoolProperty(
+        name='Share Duplicate Meshes',
+        description='Brush models with identical geometry, such as repeated '
+                    'doors, share one mesh and are placed by their object '
+                    'location. Not available with lightmaps',
+        default=False
+    )
+
     load_lightmap: BoolProperty(
         name='Load Lightmap Data',
         description='Load lightmap data',
         default=False
     )
 
+    lightmap_mode: EnumProperty(
+        name='Lightmap Mode',
+        description='How lightmaps are added to the meshes',
+        items=(
+            ('ATLAS', 'Atlas', 'Pack lightmaps into an image per object with '
+                               'a second UV layer'),
+            ('COLORS', 'Color Attribute', 'Sample lightmaps at every face '
+                                          'corner into a color attribute. '
+                                          'Faster and lighter, for previews'),
+        ),
+        default='ATLAS'
+    )
+
+    lightmap_storage: EnumProperty(
+        name='Lightmap Storage',
+        description='Precision of the lightmap atlas images',
+        items=(
+            ('BYTE', 'Byte', 'One byte per channel, like the luxels in the file'),
+            ('FLOAT', 'Float', 'Float image with the same values in the 0 to 1 '
+                               'range. Uses four times the memory'),
+        ),
+        default='BYTE'
+    )
+
     use_principled_shader: BoolProperty(
         name='Use Principled BSDF Shader',
         description='Use Principled BSDF shader for material. Otherwise a '
@@ -74,16 +204,243 @@ class ImportBSP(bpy.types.Operator, ImportHelper):
         default=True
     )
 
+    texture_storage: EnumProperty(
+        name='Textures',
+        description='How imported textures are stored',
+        items=(
+            ('PACK', 'Pack', 'Pack textures into the .blend file'),
+            ('EXTERNAL', 'External Cache', 'Write textures once to an on-disk '
+                                           'cache and reference them as external files'),
+        ),
+        default='PACK'
+    )
+
+    texture_cache_directory: StringProperty(
+        name='Texture Cache',
+        description='Directory for cached textures. If empty, a directory in '
+                    'the Blender user datafiles is used',
+        subtype='DIR_PATH',
+        default=''
+    )
+
+    group_animated_textures: BoolProperty(
+        name='Group Animated Textures',
+        description='Combine the frames of animated textures into one image '
+                    'strip and one animated material',
+        default=True
+    )
+
+    use_texture_atlas: BoolProperty(
+        name='Texture Atlas',
+        description='Bake textures into a few atlas materials to reduce '
+                    'draw calls. Faces that tile their texture keep their '
+                    'own material',
+        default=False
+    )
+
+    atlas_page_size: EnumProperty(
+        name='Atlas Size',
+        description='Maximum width and height of each atlas page',
+        items=(
+            ('1024', '1024', ''),
+            ('2048', '2048', ''),
+            ('4096', '4096', ''),
+            ('8192', '8192', ''),
+        ),
+        default='2048'
+    )
+
+    mip_level: IntProperty(
+        name='Mip Level',
+        description='Mip level to decode textures from. Each level halves '
+                    'the texture width and height',
+        min=0, max=3,
+        default=0
+    )
+
+    max_texture_size: IntProperty(
+        name='Max Texture Size',
+        description='Decode a smaller mip level for textures larger than '
+                    'this. Zero for no limit',
+        min=0, max=4096,
+        default=0
+    )
+
+    update_existing: BoolProperty(
+        name='Update Existing',
+        description='Update a previous import of this file, rebuilding only '
+                    'the brush models, images and materials that changed',
+        default=False
+    )
+
+    fit_import_time: BoolProperty(
+        name='Fit Import Time',
+        description='Switch lightmaps to color attributes or skip them, and '
+                    'decode smaller texture mip levels until the estimated '
+                    'import time fits the time limit. Very large worldspawns '
+                    'are also split into chunks',
+        default=False
+    )
+
+    max_import_time: FloatProperty(
+        name='Time Limit',
+        description='Import time in seconds to fit in. Longer estimated '
+                    'imports show a warning',
+        min=1.0, max=3600.0,
+        default=60.0
+    )
+
+    use_undo: BoolProperty(
+        name='Undo Step',
+        description='Add an undo step for the import. Without one, big '
+                    'imports finish sooner and skip an undo snapshot of '
+                    'everything imported, but can\'t be undone',
+        default=True
+    )
+
+    use_progressive_import: BoolProperty(
+        name='Progressive Import',
+        description='Import in small steps to keep Blender responsive and '
+                    'show progress. Press Esc to cancel',
+        default=False
+    )
+
+    # Seconds of import work done per timer event
+    time_budget = 1 / 30
+
     def execute(self, context):
-        keywords = self.as_keywords(ignore=("filter_glob",))
-        from . import import_bsp
+        keywords = self.as_keywords(ignore=("filter_glob", "use_progressive_import", "fit_import_time", "max_import_time", "use_undo"))
+        import_bsp = import_module('import_bsp')
+
+        self.check_import_time(keywords)
+
+        if not self.use_progressive_import:
+            result = import_bsp.load(self, context, **keywords)
+            self.push_undo(result)
+
+            return result
+
+        self._steps = import_bsp.load_steps(self, context, **keywords)
+
+        window_manager = context.window_manager
+        self._timer = window_manager.event_timer_add(0.001, window=context.window)
+        window_manager.modal_handler_add(self)
+        window_manager.progress_begin(0, 1)
+
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self._steps.close()
+            self.finish(context)
+            self.report({'WARNING'}, 'BSP import cancelled')
+
+            return {'CANCELLED'}
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        deadline = time.perf_counter() + self.time_budget
+
+        try:
+            while time.perf_counter() < deadline:
+                progress = next(self._steps)
 
-        return import_bsp.load(self, context, **keywords)
+        except StopIteration as result:
+            self.finish(context)
+            self.push_undo(result.value)
+
+            return result.value
+
+        except Exception:
+            self.finish(context)
+            raise
+
+        context.window_manager.progress_update(progress)
+
+        return {'RUNNING_MODAL'}
+
+    def push_undo(self, result):
+        """Adds an undo step for a finished import, unless use_undo is off."""
+        if self.use_undo and 'FINISHED' in result:
+            bpy.ops.ed.undo_push(message=self.bl_label)
+
+    def check_import_time(self, keywords):
+        """Warns about imports estimated to take longer than the time limit,
+        or downgrades the keywords to fit it when fit_import_time is set."""
+        api = import_module('api')
+
+        try:
+            counts = api.import_counts(self.filepath)
+
+        except (OSError, ValueError, api.lumps.BadBspFile):
+            # Unreadable files are reported by the importer
+            return
+
+        if self.fit_import_time:
+            changes = api.fit_import_options(counts, keywords, self.max_import_time)
+            keywords.update(changes)
+
+            if changes:
+                changes = ', '.join(f'{k}={v}' for k, v in changes.items())
+                self.report({'INFO'}, f'Import options changed to fit the time limit: {changes}')
+
+        estimate = api.estimate_import(counts, **keywords)
+
+        if estimate.seconds > self.max_import_time:
+            self.report({'WARNING'}, f'Import estimated to take {estimate.seconds / 60:.1f} minutes')
+
+    def finish(self, context):
+        window_manager = context.window_manager
+        window_manager.event_timer_remove(self._timer)
+        window_manager.progress_end()
 
     def draw(self, context):
         pass
 
 
+class ReloadBSPImage(bpy.types.Operator):
+    """Reload textures imported at a reduced mip level at full resolution"""
+
+    bl_idname = 'image.bsp_reload_full_resolution'
+    bl_label = 'Reload BSP Texture at Full Resolution'
+    bl_options = {'UNDO'}
+
+    image_name: StringProperty(
+        name='Image',
+        description='Image to reload. If empty, the image in the active '
+                    'image editor is used'
+    )
+
+    use_all_images: BoolProperty(
+        name='All Images',
+        description='Reload every BSP texture imported at a reduced mip level',
+        default=False
+    )
+
+    def execute(self, context):
+        if self.use_all_images:
+            images = [i for i in bpy.data.images if i.get('bsp_mip_level', 0) > 0]
+
+        elif self.image_name:
+            images = [bpy.data.images.get(self.image_name)]
+
+        else:
+            images = [getattr(context, 'edit_image', None)]
+
+        images = [i for i in images if i is not None and i.get('bsp_filepath')]
+
+        if not images:
+            self.report({'WARNING'}, 'No BSP textures to reload')
+            return {'CANCELLED'}
+
+        import_bsp = import_module('import_bsp')
+        reloaded = sum(import_bsp.reload_image(i) for i in images)
+        self.report({'INFO'}, f'Reloaded {reloaded} of {len(images)} textures')
+
+        return {'FINISHED'}
+
+
 class ExportBSP(bpy.types.Operator, ExportHelper):
     """Save a Quake BSP File"""
 
@@ -92,20 +449,31 @@ class ExportBSP(bpy.types.Operator, ExportHelper):
     bl_options = {'PRESET'}
 
     filename_ext = '.bsp'
-    filter_glob = StringProperty(
+    filter_glob: StringProperty(
         default='*.bsp',
         options={'HIDDEN'},
     )
 
     check_extension = True
 
+    use_selection: BoolProperty(
+        name='Selection Only',
+        description='Export selected objects only',
+        default=False
+    )
+
+    global_scale: FloatProperty(
+        name='Scale',
+        description='Scale used when the BSP was imported. Vertex positions '
+                    'are divided by it',
+        min=0.001, max=1000.0,
+        default=1.0 / 32.0,
+    )
+
     def execute(self, context):
-        from . import export_bsp
+        export_bsp = import_module('export_bsp')
 
         ignore_attrs = (
-            'axis_forward',
-            'axis_up',
-            'global_scale',
             'check_existing',
             'filter_glob'
         )
@@ -124,11 +492,27 @@ def menu_func_export(self, context):
                          text='Quake BSP (.bsp)')
 
 
+def menu_func_image(self, context):
+    self.layout.operator(ReloadBSPImage.bl_idname)
+
+
 def register():
     bpy.utils.register_class(ImportBSP)
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
 
+    bpy.utils.register_class(ReloadBSPImage)
+    bpy.types.IMAGE_MT_image.append(menu_func_image)
+
+    bpy.utils.register_class(ExportBSP)
+    bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
+
 
 def unregister():
     bpy.utils.unregister_class(ImportBSP)
-    bpy.types.TOPBAR_MT_file_import.remove(menu_func_export)
\ No newline at end of file
+    bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
+
+    bpy.utils.unregister_class(ReloadBSPImage)
+    bpy.types.IMAGE_MT_image.remove(menu_func_image)
+
+    bpy.utils.unregister_class(ExportBSP)
+    bpy.types.TOPBAR_MT_file_export.remove(menu_func_export)
\ No newline at end of file
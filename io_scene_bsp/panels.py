@@ -1,5 +1,17 @@
+import os
+
+from functools import lru_cache
+
 import bpy
 
+from .patch import import_module
+
+
+@lru_cache(maxsize=4)
+def cached_import_counts(filepath, mtime):
+    """Counts the work in a BSP file once per file modification."""
+    return import_module('api').import_counts(filepath)
+
 
 class BSP_PT_import_include(bpy.types.Panel):
     bl_space_type = 'FILE_BROWSER'
@@ -27,6 +39,17 @@ class BSP_PT_import_include(bpy.types.Panel):
         sublayout.prop(operator, 'use_brush_entities', text='Brush')
         sublayout.prop(operator, 'use_point_entities', text='Point')
 
+        sublayout = layout.row()
+        sublayout.enabled = operator.use_point_entities
+        sublayout.prop(operator, 'point_entity_mode')
+
+        layout.prop(operator, 'exclude_entities')
+        layout.prop(operator, 'visible_from')
+
+        layout.label(text="Exclude Textures")
+        sublayout = layout.column()
+        sublayout.prop(operator, 'exclude_texture_classes')
+
 
 class BSP_PT_import_transform(bpy.types.Panel):
     bl_space_type = 'FILE_BROWSER'
@@ -52,11 +75,173 @@ class BSP_PT_import_transform(bpy.types.Panel):
         layout.prop(operator, 'global_scale')
 
 
+class BSP_PT_import_geometry(bpy.types.Panel):
+    bl_space_type = 'FILE_BROWSER'
+    bl_region_type = 'TOOL_PROPS'
+    bl_label = "Geometry"
+    bl_parent_id = "FILE_PT_operator"
+
+    @classmethod
+    def poll(cls, context):
+        sfile = context.space_data
+        operator = sfile.active_operator
+
+        return operator.bl_idname == 'IMPORT_SCENE_OT_bsp'
+
+    def draw(self, context):
+        layout = self.layout
+        layout.use_property_split = True
+        layout.use_property_decorate = False
+
+        sfile = context.space_data
+        operator = sfile.active_operator
+
+        layout.prop(operator, 'merge_coplanar_faces')
+        layout.prop(operator, 'collision_hulls')
+        layout.prop(operator, 'share_duplicate_meshes')
+        layout.prop(operator, 'worldspawn_chunking')
+
+        if operator.worldspawn_chunking == 'GRID':
+            layout.prop(operator, 'chunk_size')
+
+        elif operator.worldspawn_chunking == 'NODES':
+            layout.prop(operator, 'chunk_depth')
+
+
+class BSP_PT_import_options(bpy.types.Panel):
+    bl_space_type = 'FILE_BROWSER'
+    bl_region_type = 'TOOL_PROPS'
+    bl_label = "Options"
+    bl_parent_id = "FILE_PT_operator"
+
+    @classmethod
+    def poll(cls, context):
+        sfile = context.space_data
+        operator = sfile.active_operator
+
+        return operator.bl_idname == 'IMPORT_SCENE_OT_bsp'
+
+    def draw(self, context):
+        layout = self.layout
+        layout.use_property_split = True
+        layout.use_property_decorate = False
+
+        sfile = context.space_data
+        operator = sfile.active_operator
+
+        layout.prop(operator, 'update_existing')
+        layout.prop(operator, 'use_progressive_import')
+        layout.prop(operator, 'use_undo')
+
+
+class BSP_PT_import_textures(bpy.types.Panel):
+    bl_space_type = 'FILE_BROWSER'
+    bl_region_type = 'TOOL_PROPS'
+    bl_label = "Textures"
+    bl_parent_id = "FILE_PT_operator"
+
+    @classmethod
+    def poll(cls, context):
+        sfile = context.space_data
+        operator = sfile.active_operator
+
+        return operator.bl_idname == 'IMPORT_SCENE_OT_bsp'
+
+    def draw(self, context):
+        layout = self.layout
+        layout.use_property_split = True
+        layout.use_property_decorate = False
+
+        sfile = context.space_data
+        operator = sfile.active_operator
+
+        layout.prop(operator, 'texture_storage')
+        layout.prop(operator, 'group_animated_textures')
+        layout.prop(operator, 'use_texture_atlas')
+
+        sublayout = layout.column()
+        sublayout.enabled = operator.use_texture_atlas
+        sublayout.prop(operator, 'atlas_page_size')
+        layout.prop(operator, 'mip_level')
+        layout.prop(operator, 'max_texture_size')
+        layout.prop(operator, 'load_lightmap')
+
+        sublayout = layout.column()
+        sublayout.enabled = operator.load_lightmap
+        sublayout.prop(operator, 'lightmap_mode')
+
+        sublayout = layout.column()
+        sublayout.enabled = operator.load_lightmap and operator.lightmap_mode == 'ATLAS'
+        sublayout.prop(operator, 'lightmap_storage')
+
+        sublayout = layout.column()
+        sublayout.enabled = operator.texture_storage == 'EXTERNAL'
+        sublayout.prop(operator, 'texture_cache_directory')
+
+
+class BSP_PT_import_estimate(bpy.types.Panel):
+    bl_space_type = 'FILE_BROWSER'
+    bl_region_type = 'TOOL_PROPS'
+    bl_label = "Estimate"
+    bl_parent_id = "FILE_PT_operator"
+
+    @classmethod
+    def poll(cls, context):
+        sfile = context.space_data
+        operator = sfile.active_operator
+
+        return operator.bl_idname == 'IMPORT_SCENE_OT_bsp'
+
+    def draw(self, context):
+        layout = self.layout
+        layout.use_property_split = True
+        layout.use_property_decorate = False
+
+        sfile = context.space_data
+        operator = sfile.active_operator
+
+        layout.prop(operator, 'fit_import_time')
+        layout.prop(operator, 'max_import_time')
+
+        api = import_module('api')
+
+        try:
+            filepath = operator.filepath
+            counts = cached_import_counts(filepath, os.path.getmtime(filepath))
+
+        except (OSError, ValueError, api.lumps.BadBspFile):
+            layout.label(text='No BSP file selected')
+            return
+
+        options = operator.as_keywords()
+
+        if operator.fit_import_time:
+            for name, value in api.fit_import_options(counts, options, operator.max_import_time).items():
+                layout.label(text=f'{name.replace("_", " ").title()}: {value}', icon='INFO')
+                options[name] = value
+
+        estimate = api.estimate_import(counts, **options)
+        minutes, seconds = divmod(round(estimate.seconds), 60)
+        duration = f'{minutes} min {seconds} s' if minutes else f'{max(seconds, 1)} s'
+        layout.label(text=f'About {duration}, {estimate.memory / 2 ** 20:.0f} MB')
+
+        if estimate.seconds > operator.max_import_time:
+            layout.label(text='Longer than the time limit', icon='ERROR')
+
+
 def register():
     bpy.utils.register_class(BSP_PT_import_include)
     bpy.utils.register_class(BSP_PT_import_transform)
+    bpy.utils.register_class(BSP_PT_import_geometry)
+    bpy.utils.register_class(BSP_PT_import_textures)
+    bpy.utils.register_class(BSP_PT_import_options)
+    bpy.utils.register_class(BSP_PT_import_estimate)
 
 
 def unregister():
     bpy.utils.unregister_class(BSP_PT_import_include)
     bpy.utils.unregister_class(BSP_PT_import_transform)
+    bpy.utils.unregister_class(BSP_PT_import_geometry)
+    bpy.utils.unregister_class(BSP_PT_import_textures)
+    bpy.utils.unregister_class(BSP_PT_import_options)
+    bpy.utils.unregister_class(BSP_PT_import_estimate)
@@ -1,3 +1,4 @@
+import importlib
 import os
 import sys
 
@@ -8,4 +9,18 @@ def ensure_modules_dir_on_path():
     if not modules_dir in sys.path:
         sys.path.append(modules_dir)
 
-    print(sys.path)
+
+def import_module(name):
+    """Imports one of the add-on's modules on first use. The bundled modules
+    directory is put on the path first, so heavy dependencies such as numpy
+    and vgio are only loaded when they are needed.
+
+    Args:
+        name: The module name relative to the package, such as 'import_bsp'
+
+    Returns:
+        The module
+    """
+    ensure_modules_dir_on_path()
+
+    return importlib.import_module(f'.{name}', __package__)
@@ -0,0 +1,52 @@
+"""This module provides a minimal PNG encoder for RGBA image data."""
+import struct
+import zlib
+
+import numpy
+
+__all__ = ['encode']
+
+
+signature = b'\x89PNG\r\n\x1a\n'
+
+
+def _chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+def encode(width, height, pixels, level=6):
+    """Encodes RGBA pixel data as a PNG.
+
+    Note:
+        The zlib compression step releases the GIL, so many images can be
+        encoded in parallel from a thread pool.
+
+    Args:
+        width: The width of the image.
+
+        height: The height of the image.
+
+        pixels: A sequence of RGBA byte values. Rows are expected bottom to
+            top, which is the order Blender uses for image pixels.
+
+        level: The zlib compression level.
+
+    Returns:
+        The PNG file as bytes.
+    """
+    rows = numpy.asarray(pixels, dtype=numpy.uint8).reshape(height, width * 4)
+
+    # Flip rows to top to bottom and prefix each with filter type 0
+    scanlines = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)
+    scanlines[:, 1:] = rows[::-1]
+
+    header = struct.pack('>2I5B', width, height, 8, 6, 0, 0, 0)
+
+    return b''.join((
+        signature,
+        _chunk(b'IHDR', header),
+        _chunk(b'IDAT', zlib.compress(scanlines.tobytes(), level)),
+        _chunk(b'IEND', b'')
+    ))
@@ -0,0 +1,123 @@
+"""This module bakes textures into atlas pages and remaps UVs into them."""
+from collections import namedtuple
+
+import numpy
+
+from . import atlas_packer
+from .api import Image
+
+__all__ = ['Atlas', 'Placement', 'build', 'remap_uvs']
+
+
+Placement = namedtuple('Placement', 'page x y width height')
+"""The location of a texture in an atlas page, in pixels from the bottom
+left corner."""
+
+Atlas = namedtuple('Atlas', 'pages placements')
+"""A set of atlas pages.
+
+Attributes:
+    pages: A list of Image objects.
+
+    placements: A dict of texture names to Placement objects.
+"""
+
+_Region = namedtuple('_Region', 'size')
+
+
+def _next_power_of_two(value):
+    return 1 << (max(int(value), 1) - 1).bit_length()
+
+
+def build(images, page_size=2048):
+    """Packs images into as few atlas pages as possible.
+
+    Args:
+        images: A dict of texture names to Image objects. Images larger than
+            a page are left out.
+
+        page_size: The maximum width and height of a page. Pages are
+            shrunk to the smallest power of two that fits their contents.
+
+    Returns:
+        An Atlas object
+    """
+    remaining = [
+        n for n, i in images.items()
+        if i is not None and 0 < i.width <= page_size and 0 < i.height <= page_size
+    ]
+    pages = []
+    placements = {}
+
+    while remaining:
+        regions = [_Region((images[n].width, images[n].height)) for n in remaining]
+        offsets = atlas_packer.pack(regions, (page_size, page_size)).offsets
+        placed = [(n, o) for n, o in zip(remaining, offsets) if o]
+
+        if not placed:
+            break
+
+        width = _next_power_of_two(max(o[0] + images[n].width for n, o in placed))
+        height = _next_power_of_two(max(o[1] + images[n].height for n, o in placed))
+        pixels = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+
+        for name, (x, y) in placed:
+            image = images[name]
+            pixels[y:y + image.height, x:x + image.width] = image.pixels.reshape(image.height, image.width, 4)
+            placements[name] = Placement(len(pages), x, y, image.width, image.height)
+
+        pages.append(Image(width, height, pixels.ravel()))
+        remaining = [n for n, o in zip(remaining, offsets) if not o]
+
+    return Atlas(pages, placements)
+
+
+def remap_uvs(atlas, texture_names, uvs, loop_totals, epsilon=1e-4):
+    """Moves UVs into the atlas. Only polygons whose UVs stay inside a single
+    texture tile can be remapped. Polygons that tile their texture keep their
+    UVs and should keep their own material.
+
+    Args:
+        atlas: An Atlas object
+
+        texture_names: The texture name of each polygon
+
+        uvs: An (N, 2) array of the texture coordinates of each loop
+
+        loop_totals: The number of loops of each polygon
+
+        epsilon: Tolerance for UVs on tile edges
+
+    Returns:
+        A two-tuple of the new UVs and the atlas page of each polygon, or
+        -1 for polygons that were not remapped.
+    """
+    polygon_count = len(loop_totals)
+
+    if not polygon_count:
+        return uvs, numpy.empty(0, dtype=numpy.int64)
+
+    # Placement of each polygon's texture
+    names, polygon_textures = numpy.unique(numpy.array(texture_names, dtype=object).astype(str), return_inverse=True)
+    table = numpy.array(
+        [atlas.placements[n] if n in atlas.placements else (-1, 0, 0, 1, 1) for n in names],
+        dtype=numpy.int64
+    ).reshape(-1, 5)
+    placements = table[polygon_textures.ravel()]
+    pages = placements[:, 0].copy()
+
+    # Polygons must fit inside one tile
+    loop_starts = numpy.cumsum(loop_totals) - loop_totals
+    minimums = numpy.minimum.reduceat(uvs, loop_starts, axis=0)
+    maximums = numpy.maximum.reduceat(uvs, loop_starts, axis=0)
+    tiles = numpy.floor(minimums + epsilon)
+    pages[numpy.any(maximums - tiles > 1 + epsilon, axis=1)] = -1
+
+    page_sizes = numpy.array([(p.width, p.height) for p in atlas.pages] + [(1, 1)], dtype=numpy.float64)
+    loop_pages = numpy.repeat(pages, loop_totals)
+    loop_placements = numpy.repeat(placements, loop_totals, axis=0)
+    local = numpy.clip(uvs - numpy.repeat(tiles, loop_totals, axis=0), 0, 1)
+
+    remapped = (loop_placements[:, 1:3] + local * loop_placements[:, 3:5]) / page_sizes[loop_pages]
+
+    return numpy.where((loop_pages >= 0)[:, numpy.newaxis], remapped, uvs), pages
@@ -0,0 +1,212 @@
+import os
+import random
+import sys
+
+import pytest
+
+bpy = pytest.importorskip('bpy')
+bsp29 = pytest.importorskip('vgio.quake.bsp.bsp29')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import io_scene_bsp
+
+texture_names = ('wall', 'floor', 'sky1', '*water', '+0slime', '+1slime', 'trigger')
+
+# Large enough for the brush model faces to fit in a single tile
+texture_sizes = {'wall': (128, 128), 'trigger': (128, 128)}
+
+entities = '''{
+"classname" "worldspawn"
+}
+{
+"classname" "info_player_start"
+"origin" "256 256 24"
+"angle" "90"
+}
+{
+"classname" "item_shells"
+"origin" "64 64 24"
+"angles" "30 45 0"
+}
+{
+"classname" "func_door"
+"model" "*1"
+}
+{
+"classname" "trigger_once"
+"model" "*2"
+}
+'''
+
+
+class MapBuilder:
+    """Builds a small BSP29 map: a textured room with a coplanar floor, a
+    door and a trigger. The worldspawn and door have box shaped clip hulls.
+    """
+
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.bsp = bsp29.Bsp()
+        self.bsp.version = 29
+        self.bsp.miptextures = [self.miptexture(n, *texture_sizes.get(n, (16, 16))) for n in texture_names]
+        self.bsp.planes = []
+        self.bsp.vertexes = []
+        self.bsp.texture_infos = []
+        self.bsp.faces = []
+        self.bsp.edges = [bsp29.Edge(0, 0)]
+        self.bsp.surf_edges = []
+        self.bsp.clip_nodes = []
+        self.bsp.nodes = []
+        self.bsp.leafs = [bsp29.Leaf(-2, -1, *[0] * 12)]
+        self.bsp.mark_surfaces = b''
+        self.bsp.visibilities = b''
+        self.bsp.models = []
+        self.bsp.entities = entities
+        self.bsp.lighting = bytes(self.random.randrange(256) for _ in range(64 * 64))
+        self._planes = {}
+        self._vertexes = {}
+        self._texture_infos = {}
+
+    def miptexture(self, name, width, height):
+        miptexture = bsp29.Miptexture()
+        miptexture.name = name
+        miptexture.width = width
+        miptexture.height = height
+        offsets = [40]
+
+        for level in range(1, 4):
+            offsets.append(offsets[-1] + (width >> level - 1) * (height >> level - 1))
+
+        miptexture.offsets = tuple(offsets)
+        miptexture.pixels = tuple(self.random.randrange(256) for _ in range(width * height * 85 // 64))
+
+        return miptexture
+
+    def plane(self, normal, distance):
+        key = normal, distance
+
+        if key not in self._planes:
+            axis = [abs(n) for n in normal].index(1)
+            self._planes[key] = len(self.bsp.planes)
+            self.bsp.planes.append(bsp29.Plane(*normal, distance, axis))
+
+        return self._planes[key]
+
+    def texture_info(self, name, axis):
+        key = name, axis
+
+        if key not in self._texture_infos:
+            s = [0, 0, 0]
+            t = [0, 0, 0]
+            s_axis, t_axis = [(1, 2), (0, 2), (0, 1)][axis]
+            s[s_axis] = 1
+            t[t_axis] = -1
+            self._texture_infos[key] = len(self.bsp.texture_infos)
+            self.bsp.texture_infos.append(bsp29.TextureInfo(*s, 0, *t, 0, texture_names.index(name), 0))
+
+        return self._texture_infos[key]
+
+    def quad(self, points, name):
+        first_edge = len(self.bsp.surf_edges)
+
+        for start, end in zip(points, points[1:] + points[:1]):
+            for point in start, end:
+                if point not in self._vertexes:
+                    self._vertexes[point] = len(self.bsp.vertexes)
+                    self.bsp.vertexes.append(bsp29.Vertex(*point))
+
+            self.bsp.edges.append(bsp29.Edge(self._vertexes[start], self._vertexes[end]))
+            self.bsp.surf_edges.append(len(self.bsp.edges) - 1)
+
+        a, b, c = points[:3]
+        u = [b[i] - a[i] for i in range(3)]
+        v = [c[i] - a[i] for i in range(3)]
+        normal = (u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2], u[0] * v[1] - u[1] * v[0])
+        axis = [abs(n) > 0 for n in normal].index(True)
+        normal = tuple(float(n > 0) - float(n < 0) for n in normal)
+        plane = self.plane(normal, float(sum(n * p for n, p in zip(normal, a))))
+
+        self.bsp.faces.append(bsp29.Face(plane, 0, first_edge, len(points), self.texture_info(name, axis), 0, 255, 255, 255, 0))
+
+    def box(self, minimum, maximum, names, inward=False):
+        x0, y0, z0 = minimum
+        x1, y1, z1 = maximum
+        quads = [
+            [(x0, y0, z0), (x0, y1, z0), (x1, y1, z0), (x1, y0, z0)],
+            [(x0, y0, z1), (x1, y0, z1), (x1, y1, z1), (x0, y1, z1)],
+            [(x0, y0, z0), (x1, y0, z0), (x1, y0, z1), (x0, y0, z1)],
+            [(x0, y1, z0), (x0, y1, z1), (x1, y1, z1), (x1, y1, z0)],
+            [(x0, y0, z0), (x0, y0, z1), (x0, y1, z1), (x0, y1, z0)],
+            [(x1, y0, z0), (x1, y1, z0), (x1, y1, z1), (x1, y0, z1)]
+        ]
+
+        for points, name in zip(quads, names):
+            if name:
+                self.quad(points[::-1] if inward else points, name)
+
+    def clip_box(self, minimum, maximum, inside, outside):
+        node = inside
+
+        for axis in range(3):
+            normal = [0, 0, 0]
+            normal[axis] = -1
+            self.bsp.clip_nodes.append(bsp29.ClipNode(self.plane(tuple(normal), -maximum[axis]), node, outside))
+            node = len(self.bsp.clip_nodes) - 1
+
+            normal[axis] = 1
+            self.bsp.clip_nodes.append(bsp29.ClipNode(self.plane(tuple(normal), minimum[axis]), node, outside))
+            node = len(self.bsp.clip_nodes) - 1
+
+        return node
+
+    def model(self, minimum, maximum, head_node=0):
+        first_face = sum(m.number_of_faces for m in self.bsp.models)
+        self.bsp.models.append(bsp29.Model(
+            *minimum, *maximum, 0, 0, 0,
+            0, head_node, 0, 0,
+            0, first_face, len(self.bsp.faces) - first_face
+        ))
+
+    def build(self):
+        for x in 0, 256:
+            for y in 0, 256:
+                self.quad([(x, y, 0), (x + 256, y, 0), (x + 256, y + 256, 0), (x, y + 256, 0)], 'floor')
+
+        self.box((0, 0, 0), (512, 512, 256), [None, 'sky1', 'wall', 'wall', 'wall', '+0slime'], inward=True)
+        self.quad([(100, 100, 8), (200, 100, 8), (200, 200, 8), (100, 200, 8)], '*water')
+        self.model((0, 0, 0), (512, 512, 256), self.clip_box((16, 16, 24), (496, 496, 224), -1, -2))
+
+        self.box((64, 32, 0), (96, 96, 128), ['wall'] * 6)
+        self.model((64, 32, 0), (96, 96, 128), self.clip_box((48, 16, -24), (112, 112, 160), -2, -1))
+
+        self.box((400, 32, 0), (432, 96, 128), ['trigger'] * 6)
+        self.model((400, 32, 0), (432, 96, 128))
+
+        return self.bsp
+
+
+@pytest.fixture
+def make_map(tmp_path):
+    """Writes a test map and returns its path. Maps built with different
+    seeds have the same geometry but different texture pixels."""
+
+    def make_map(name='test', seed=1):
+        filepath = str(tmp_path / f'{name}.bsp')
+
+        with open(filepath, 'w+b') as file:
+            MapBuilder(seed).build().save(file)
+
+        return filepath
+
+    return make_map
+
+
+@pytest.fixture(autouse=True)
+def blender():
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    io_scene_bsp.register()
+
+    yield bpy
+
+    io_scene_bsp.unregister()
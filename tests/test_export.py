@@ -0,0 +1,30 @@
+import bpy
+
+from io_scene_bsp import api
+
+
+def test_export_skips_hulls_and_point_clouds(make_map, tmp_path):
+    filepath = make_map()
+    bpy.ops.import_scene.bsp(filepath=filepath, collision_hulls={'HULL1'}, point_entity_mode='POINTS')
+    assert any(str(ob.get('bsp_chunk', '')).startswith('hull') for ob in bpy.data.objects)
+
+    export_filepath = str(tmp_path / 'export.bsp')
+    bpy.ops.export_scene.bsp(filepath=export_filepath)
+
+    with api.Bsp(filepath) as original, api.Bsp(export_filepath) as exported:
+        assert len(exported.face_array) == len(original.face_array)
+        assert len(exported.model_array) == len(original.model_array)
+        assert exported.model_array['number_of_faces'].tolist() == original.model_array['number_of_faces'].tolist()
+
+
+def test_export_keeps_brush_models_of_each_map(make_map, tmp_path):
+    bpy.ops.import_scene.bsp(filepath=make_map('first', seed=1))
+    bpy.ops.import_scene.bsp(filepath=make_map('second', seed=2))
+
+    export_filepath = str(tmp_path / 'export.bsp')
+    bpy.ops.export_scene.bsp(filepath=export_filepath)
+
+    with api.Bsp(make_map()) as original, api.Bsp(export_filepath) as exported:
+        face_counts = original.model_array['number_of_faces'].tolist()
+
+        assert exported.model_array['number_of_faces'].tolist() == [2 * face_counts[0]] + face_counts[1:] * 2
@@ -0,0 +1,95 @@
+import math
+
+import bpy
+
+from io_scene_bsp import import_bsp
+
+
+def atlas_polygon_count(ob):
+    materials = [m.name for m in ob.data.materials]
+
+    return sum('.atlas' in materials[p.material_index] for p in ob.data.polygons)
+
+
+def test_atlas_with_renamed_materials(make_map):
+    bpy.ops.import_scene.bsp(filepath=make_map('first', seed=1), use_texture_atlas=True)
+    first = atlas_polygon_count(bpy.data.objects['func_door'])
+
+    # The second map's textures differ, so its materials get new names
+    bpy.ops.import_scene.bsp(filepath=make_map('second', seed=2), use_texture_atlas=True)
+    second = atlas_polygon_count(bpy.data.objects['func_door.001'])
+
+    assert 'wall.001' in bpy.data.materials
+    assert first > 0
+    assert second == first
+
+
+def test_point_entity_angles(make_map):
+    bpy.ops.import_scene.bsp(filepath=make_map(), point_entity_mode='POINTS')
+    shells = bpy.data.objects['item_shells'].data.attributes['rotation'].data[0].vector
+    player = bpy.data.objects['info_player_start'].data.attributes['rotation'].data[0].vector
+
+    assert [round(math.degrees(a)) for a in shells] == [0, -30, 45]
+    assert [round(math.degrees(a)) for a in player] == [0, 0, 90]
+
+
+class Operator:
+    def __init__(self):
+        self.reports = []
+
+    def report(self, type, message):
+        self.reports.append((type, message))
+
+
+def datablock_names():
+    return {
+        'images': set(bpy.data.images.keys()),
+        'materials': set(bpy.data.materials.keys()),
+        'node_groups': set(bpy.data.node_groups.keys()),
+        'collections': set(bpy.data.collections.keys())
+    }
+
+
+def test_cancel_removes_created_datablocks(make_map):
+    filepath = make_map()
+    bpy.ops.import_scene.bsp(filepath=filepath)
+    before = datablock_names()
+
+    # Atlas pages, lightmaps and instance node groups are new, the texture
+    # images are shared with the first import
+    keywords = dict(
+        filepath=filepath,
+        use_texture_atlas=True,
+        load_lightmap=True,
+        point_entity_mode='INSTANCES'
+    )
+    step_count = sum(1 for _ in import_bsp.load_steps(Operator(), bpy.context, **keywords))
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    bpy.ops.import_scene.bsp(filepath=filepath)
+
+    for fraction in 0.3, 0.7, 0.95:
+        steps = import_bsp.load_steps(Operator(), bpy.context, **keywords)
+
+        for _ in range(int(step_count * fraction)):
+            next(steps)
+
+        steps.close()
+
+        assert datablock_names() == before
+
+
+def test_visible_from_without_visibility_data(make_map):
+    # The test map's worldspawn has a head node but no nodes, leafs or vis
+    operator = Operator()
+    result = import_bsp.load(operator, bpy.context, filepath=make_map(), visible_from='info_player_start')
+
+    assert result == {'FINISHED'}
+    assert any(type == {'WARNING'} and 'visibility' in message for type, message in operator.reports)
+    assert len(bpy.data.objects['worldspawn'].data.polygons) == 10
+
+
+def test_custom_shader_node_groups(make_map):
+    result = bpy.ops.import_scene.bsp(filepath=make_map(), use_principled_shader=False, load_lightmap=True)
+
+    assert result == {'FINISHED'}
+    assert {'Unlit BSDF', 'Lightmapped BSDF'} <= set(bpy.data.node_groups.keys())